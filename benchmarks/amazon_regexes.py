@@ -0,0 +1,92 @@
+# amazon_regexes.py
+#
+# Compares the per-email time taken by the Amazon retriever's regex extraction (order URL, order
+# IDs and price) using the compiled, searched patterns with the previous .*-prefixed patterns that
+# were re.match'ed against the whole email. Checks that both find the same results.
+#
+# Usage: python -m benchmarks.amazon_regexes [--repeat N] EML_FILE [EML_FILE ...]
+#
+
+import argparse
+import re
+import statistics
+import time
+from typing import Callable, List, Optional, Tuple
+
+from lib.amazon_tracking_retriever import AmazonTrackingRetriever
+from lib.parsed_email import ParsedEmail, parse_email
+
+LEGACY_FIRST_REGEX = r'.*href="(http[^"]*ship-?track[^"]*)"'
+LEGACY_SECOND_REGEX = r'.*<a hr[^"]*=[^"]*"(http[^"]*progress-tracker[^"]*)"'
+LEGACY_PRICE_REGEX = r'.*Shipment [Tt]otal: ?(\$[\d,]+\.\d{2})'
+LEGACY_ORDER_IDS_REGEX = r'(11\d-\d{7}-\d{7})'
+
+Extraction = Tuple[Optional[str], List[str], str]
+
+
+def legacy_extract(email: ParsedEmail) -> Extraction:
+  """The extraction that the Amazon retriever did before its patterns were compiled."""
+  email_str = email.content
+  match = re.match(LEGACY_FIRST_REGEX, str(email_str))
+  if not match:
+    match = re.match(LEGACY_SECOND_REGEX, str(email_str))
+  url = match.group(1) if match else None
+  order_ids = list(set(re.findall(LEGACY_ORDER_IDS_REGEX, email_str)))
+  match = re.match(LEGACY_PRICE_REGEX, email_str)
+  price = match.group(1) if match else ''
+  return url, order_ids, price
+
+
+def compiled_extract(email: ParsedEmail) -> Extraction:
+  # None of these methods use the retriever's state, so there's no need to construct one (which
+  # would connect to the mailbox).
+  retriever = AmazonTrackingRetriever.__new__(AmazonTrackingRetriever)
+  return (retriever.get_order_url_from_email(email), retriever.get_order_ids_from_email(email),
+          retriever.get_price_from_email(email))
+
+
+def time_extractor(extractor: Callable[[ParsedEmail], Extraction], emails: List[ParsedEmail],
+                   repeat: int) -> float:
+  """Returns the median time, in seconds, that the extractor takes to process all of the emails."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for email in emails:
+      extractor(email)
+    timings.append(time.perf_counter() - start)
+  return statistics.median(timings)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark Amazon email regexes')
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("files", nargs='+')
+  args = parser.parse_args()
+
+  emails = []
+  for filename in args.files:
+    with open(filename, 'rb') as f:
+      emails.append(parse_email(f.read()))
+  total_mb = sum(len(email.content) for email in emails) / 1024 / 1024
+  print(f"Extracting from {len(emails)} emails ({total_mb:.1f} MB decoded), "
+        f"median of {args.repeat} runs")
+
+  for filename, email in zip(args.files, emails):
+    legacy_url, legacy_order_ids, legacy_price = legacy_extract(email)
+    url, order_ids, price = compiled_extract(email)
+    # The legacy patterns found the last match in the email rather than the first.
+    if (legacy_url is None) != (url is None) or sorted(legacy_order_ids) != sorted(order_ids) or (
+        bool(legacy_price) != bool(price)):
+      print(f"Results differ for {filename}: {(legacy_url, legacy_order_ids, legacy_price)} vs "
+            f"{(url, order_ids, price)}")
+
+  legacy_seconds = time_extractor(legacy_extract, emails, args.repeat)
+  compiled_seconds = time_extractor(compiled_extract, emails, args.repeat)
+  for name, seconds in (("legacy", legacy_seconds), ("compiled", compiled_seconds)):
+    print(f"{name:>8}: {seconds * 1000:9.1f} ms total, "
+          f"{seconds * 1000 / len(emails):7.2f} ms/email, {total_mb / seconds:7.1f} MB/s")
+  print(f"Speedup: {legacy_seconds / compiled_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,77 @@
+# decode_emails.py
+#
+# Compares the single-pass MIME decoder with the previous decode-then-replace path on a set of
+# saved emails (e.g. large business account shipping emails exported from Gmail as .eml files).
+#
+# Usage: python -m benchmarks.decode_emails [--repeat N] EML_FILE [EML_FILE ...]
+#
+
+import argparse
+import base64
+import statistics
+import time
+from typing import Callable, List
+
+from lib.email_decoder import decode_email
+
+BASE_64_FLAG = 'Content-Transfer-Encoding: base64'
+
+
+def legacy_decode(raw_email: bytes) -> str:
+  """The decoding that get_trackings used before the MIME decoder, kept here for comparison."""
+  email_str = raw_email.decode('utf-8', errors='replace')
+  if BASE_64_FLAG in email_str:
+    for i in range(4):
+      repeated_equals = '=' * i
+      try:
+        email_str = str(base64.b64decode(email_str.split(BASE_64_FLAG)[-1] + repeated_equals))
+        break
+      except:
+        pass
+  email_str = email_str.replace('=3D', '=')
+  email_str = email_str.replace('=\r\n', '')
+  email_str = email_str.replace('\r\n', '')
+  email_str = email_str.replace('&amp;', '&')
+  email_str = email_str.replace(r'\r', '')
+  email_str = email_str.replace(r'\n', '')
+  return email_str
+
+
+def mime_decode(raw_email: bytes) -> str:
+  return decode_email(raw_email).content
+
+
+def time_decoder(decoder: Callable[[bytes], str], raw_emails: List[bytes], repeat: int) -> float:
+  """Returns the median time, in seconds, that the decoder takes to decode all of the emails."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for raw_email in raw_emails:
+      decoder(raw_email)
+    timings.append(time.perf_counter() - start)
+  return statistics.median(timings)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark email decoding')
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("files", nargs='+')
+  args = parser.parse_args()
+
+  raw_emails = []
+  for filename in args.files:
+    with open(filename, 'rb') as f:
+      raw_emails.append(f.read())
+  total_mb = sum(len(raw_email) for raw_email in raw_emails) / 1024 / 1024
+  print(f"Decoding {len(raw_emails)} emails ({total_mb:.1f} MB), median of {args.repeat} runs")
+
+  legacy_seconds = time_decoder(legacy_decode, raw_emails, args.repeat)
+  mime_seconds = time_decoder(mime_decode, raw_emails, args.repeat)
+  for name, seconds in (("legacy", legacy_seconds), ("mime", mime_seconds)):
+    print(f"{name:>8}: {seconds * 1000:9.1f} ms total, "
+          f"{seconds * 1000 / len(raw_emails):7.2f} ms/email, {total_mb / seconds:7.1f} MB/s")
+  print(f"Speedup: {legacy_seconds / mime_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+  main()
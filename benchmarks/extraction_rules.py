@@ -0,0 +1,105 @@
+# extraction_rules.py
+#
+# Compares the per-email time taken to find all of the fields of each merchant's extraction rules
+# by scanning with each rule, as the rule sets do, and by scanning once with all of a rule set's
+# patterns combined into a single alternation. Checks that both find the same values.
+#
+# Usage: python -m benchmarks.extraction_rules [--repeat N] EML_FILE [EML_FILE ...]
+#
+
+import argparse
+import re
+import statistics
+import time
+from typing import Callable, Dict, List
+
+from lib.amazon_tracking_retriever import AmazonTrackingRetriever
+from lib.bestbuy_tracking_retriever import BestBuyTrackingRetriever
+from lib.email_decoder import decode_email
+from lib.extraction_rules import RuleSet
+
+RULE_SETS = [AmazonTrackingRetriever.extraction_rules, BestBuyTrackingRetriever.extraction_rules]
+
+
+def per_rule_scan(rule_set: RuleSet, text: str) -> Dict[str, List[str]]:
+  matches = rule_set.scan(text)
+  return {name: matches.all(name) for name in rule_set.fields}
+
+
+class CombinedScanner:
+  """
+  Finds every rule's matches with one scan of an alternation of all of the rules' patterns. Each
+  pattern is in a lookahead so that one rule's match doesn't hide another's that overlaps it.
+  """
+
+  def __init__(self, rule_set: RuleSet) -> None:
+    self.rules = rule_set.rules
+    self.regex = re.compile("|".join(
+        f"(?=(?P<_{index}>{rule.regex.pattern}))" for index, rule in enumerate(self.rules)))
+    self.groups = [self.regex.groupindex[f"_{index}"] for index in range(len(self.rules))]
+
+  def scan(self, text: str) -> Dict[str, List[str]]:
+    values: List[List[str]] = [[] for _ in self.rules]
+    # Like re.finditer, a rule's next match can't start before the end of its previous one.
+    ends = [0] * len(self.rules)
+    for match in self.regex.finditer(text):
+      start = match.start()
+      index = int(match.lastgroup[1:])
+      rule = self.rules[index]
+      if start >= ends[index]:
+        values[index].append(match.group(self.groups[index] + rule.group))
+        ends[index] = max(match.end(self.groups[index]), start + 1)
+      # Only the first rule that matches here is reported, so later ones are checked directly.
+      for later in range(index + 1, len(self.rules)):
+        later_match = self.rules[later].regex.match(text, start) if start >= ends[later] else None
+        if later_match:
+          values[later].append(later_match.group(self.rules[later].group))
+          ends[later] = max(later_match.end(), start + 1)
+    fields: Dict[str, List[str]] = {}
+    for rule, rule_values in zip(self.rules, values):
+      fields.setdefault(rule.name, []).extend(rule_values)
+    return fields
+
+
+def time_scan(scan: Callable[[str], Dict[str, List[str]]], emails: List[str], repeat: int) -> float:
+  """Returns the median time, in seconds, that scanning all emails takes."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for email in emails:
+      scan(email)
+    timings.append(time.perf_counter() - start)
+  return statistics.median(timings)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark extraction rule scans')
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("files", nargs='+')
+  args = parser.parse_args()
+
+  emails = []
+  for filename in args.files:
+    with open(filename, 'rb') as f:
+      emails.append(decode_email(f.read()).content)
+  total_mb = sum(len(email) for email in emails) / 1024 / 1024
+  print(f"Scanning {len(emails)} emails ({total_mb:.1f} MB decoded), "
+        f"median of {args.repeat} runs")
+
+  for rule_set in RULE_SETS:
+    combined = CombinedScanner(rule_set)
+    for filename, email in zip(args.files, emails):
+      if per_rule_scan(rule_set, email) != combined.scan(email):
+        print(f"Results differ for {filename} with {rule_set.name}")
+
+    per_rule_seconds = time_scan(lambda email: per_rule_scan(rule_set, email), emails, args.repeat)
+    combined_seconds = time_scan(combined.scan, emails, args.repeat)
+    print(f"{rule_set.name} ({len(rule_set.rules)} rules):")
+    for name, seconds in (("per rule", per_rule_seconds), ("combined", combined_seconds)):
+      print(f"{name:>10}: {seconds * 1000:9.1f} ms total, "
+            f"{seconds * 1000 / len(emails):7.2f} ms/email, {total_mb / seconds:7.1f} MB/s")
+    print(f"Combined speedup: {per_rule_seconds / combined_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,95 @@
+# group_resolver.py
+#
+# Compares the per-email time taken to find an email's buying group with the GroupResolver and
+# with the previous per-call loop over every group's keys and except terms, using the groups in
+# config.yml (or the corpus's groups with --corpus-groups). Checks that both find the same groups.
+# The resolver only makes a single pass over each email if there are enough groups for it to be
+# worthwhile and pyahocorasick is installed.
+#
+# Usage: python -m benchmarks.group_resolver [--repeat N] [--corpus-groups] EML_FILE [EML_FILE ...]
+#
+
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from lib.email_decoder import decode_email
+from lib.group_resolver import GroupResolver
+
+CORPUS_EXPECTED_FILENAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'corpus', 'expected.json')
+
+
+def legacy_get_group(groups_config: Dict[str, Any], raw_email: str) -> Tuple[Optional[str], bool]:
+  """The group lookup that the email retrievers did before GroupResolver, kept for comparison."""
+  raw_email = raw_email.upper()
+  for group in groups_config.keys():
+    group_conf = groups_config[group]
+    if any([str(except_elem).upper() in raw_email for except_elem in group_conf.get('except', [])]):
+      continue
+
+    reconcile = bool(group_conf['reconcile']) if 'reconcile' in group_conf else True
+    group_keys = group_conf['keys']
+    if isinstance(group_keys, str):
+      group_keys = [group_keys]
+    for group_key in group_keys:
+      if str(group_key).upper() in raw_email:
+        return group, reconcile
+  return None, True
+
+
+def time_lookup(lookup: Callable[[str], Any], emails: List[str], repeat: int) -> float:
+  """Returns the median time, in seconds, that looking up the groups of all emails takes."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for email in emails:
+      lookup(email)
+    timings.append(time.perf_counter() - start)
+  return statistics.median(timings)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark buying group lookups')
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--corpus-groups", action="store_true")
+  parser.add_argument("files", nargs='+')
+  args = parser.parse_args()
+
+  if args.corpus_groups:
+    with open(CORPUS_EXPECTED_FILENAME, 'r') as f:
+      groups_config = json.load(f)['groups']
+  else:
+    from lib.config import open_config
+    groups_config = open_config()['groups']
+
+  emails = []
+  for filename in args.files:
+    with open(filename, 'rb') as f:
+      emails.append(decode_email(f.read()).content)
+  resolver = GroupResolver(groups_config)
+  total_mb = sum(len(email) for email in emails) / 1024 / 1024
+  print(f"Finding groups of {len(emails)} emails ({total_mb:.1f} MB decoded) among "
+        f"{len(groups_config)} groups, {'with' if resolver.automaton else 'without'} "
+        f"an automaton, median of {args.repeat} runs")
+
+  for filename, email in zip(args.files, emails):
+    legacy_result = legacy_get_group(groups_config, email)
+    result = resolver.get_group(email)
+    if legacy_result != result:
+      print(f"Results differ for {filename}: {legacy_result} vs {result}")
+
+  legacy_seconds = time_lookup(lambda email: legacy_get_group(groups_config, email), emails,
+                               args.repeat)
+  resolver_seconds = time_lookup(resolver.get_group, emails, args.repeat)
+  for name, seconds in (("legacy", legacy_seconds), ("resolver", resolver_seconds)):
+    print(f"{name:>8}: {seconds * 1000:9.1f} ms total, "
+          f"{seconds * 1000 / len(emails):7.2f} ms/email, {total_mb / seconds:7.1f} MB/s")
+  print(f"Speedup: {legacy_seconds / resolver_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+  main()
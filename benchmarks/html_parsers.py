@@ -0,0 +1,106 @@
+# html_parsers.py
+#
+# Times the DOM-based extractors (Amazon items and delivery dates, Amazon personal order totals
+# and cancelled items) with each installed HTML parser, and checks that every parser extracts
+# exactly what html.parser does. Each email is parsed from scratch by every parser.
+#
+# Usage: python -m benchmarks.html_parsers [--repeat N] EML_FILE [EML_FILE ...]
+#
+
+import argparse
+import importlib
+import statistics
+import time
+from typing import Any, Dict, List, Tuple
+
+from lib.amazon_tracking_retriever import AmazonTrackingRetriever
+from lib.cancelled_items_retriever import CancFmt, CancQty, get_cancelled_items_from_email
+from lib.email_decoder import DecodedEmail, decode_email
+from lib.html_dom import HTML_PARSER, LXML, PARSERS, SELECTOLAX
+from lib.order_info import OrderInfoRetriever
+from lib.parsed_email import ParsedEmail
+
+# The module that each parser needs.
+PARSER_MODULES = {SELECTOLAX: 'selectolax.lexbor', LXML: 'lxml', HTML_PARSER: 'html.parser'}
+
+
+def get_installed_parsers() -> List[str]:
+  parsers = []
+  for parser in PARSERS:
+    try:
+      importlib.import_module(PARSER_MODULES[parser])
+      parsers.append(parser)
+    except ImportError:
+      pass
+  return parsers
+
+
+def _capture(extractor, *args) -> Any:
+  """Runs the extractor, returning the exception's type instead if it raises."""
+  try:
+    return extractor(*args)
+  except Exception as e:
+    return e.__class__.__name__
+
+
+def extract(email: ParsedEmail) -> Tuple[Any, ...]:
+  # None of the extractors use their object's state, so there's no need to construct them (which
+  # would connect to the mailbox).
+  retriever = AmazonTrackingRetriever.__new__(AmazonTrackingRetriever)
+  orders = ['order-1', 'order-2', 'order-3']
+  return (
+      _capture(retriever.get_items_from_email, email),
+      _capture(retriever.get_delivery_date_from_email, email),
+      _capture(OrderInfoRetriever.get_personal_amazon_totals, None, None, email, orders),
+      _capture(get_cancelled_items_from_email, email, (CancFmt.VOLUNTARY, CancQty.YES)),
+      _capture(get_cancelled_items_from_email, email, (CancFmt.INVOLUNTARY, CancQty.NO)),
+  )
+
+
+def time_parser(parser: str, emails: List[DecodedEmail], repeat: int) -> float:
+  """Returns the median time, in seconds, that parsing and extracting from all emails takes."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for email in emails:
+      extract(ParsedEmail(email.message, email.content, parser))
+    timings.append(time.perf_counter() - start)
+  return statistics.median(timings)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark HTML parsers')
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("files", nargs='+')
+  args = parser.parse_args()
+
+  emails = []
+  for filename in args.files:
+    with open(filename, 'rb') as f:
+      emails.append(decode_email(f.read()))
+  total_mb = sum(len(email.content) for email in emails) / 1024 / 1024
+  parsers = get_installed_parsers()
+  print(f"Parsing {len(emails)} emails ({total_mb:.1f} MB decoded) with {', '.join(parsers)}, "
+        f"median of {args.repeat} runs")
+
+  expected = [extract(ParsedEmail(email.message, email.content, HTML_PARSER)) for email in emails]
+  mismatches: Dict[str, int] = {}
+  for parser_name in parsers:
+    for filename, email, expected_result in zip(args.files, emails, expected):
+      result = extract(ParsedEmail(email.message, email.content, parser_name))
+      if repr(result) != repr(expected_result):
+        mismatches[parser_name] = mismatches.get(parser_name, 0) + 1
+        print(f"{parser_name} differs from {HTML_PARSER} for {filename}:\n"
+              f"  {result}\n  {expected_result}")
+
+  baseline_seconds = time_parser(HTML_PARSER, emails, args.repeat)
+  for parser_name in parsers:
+    seconds = baseline_seconds if parser_name == HTML_PARSER else time_parser(
+        parser_name, emails, args.repeat)
+    print(f"{parser_name:>12}: {seconds * 1000 / len(emails):7.2f} ms/email, "
+          f"{total_mb / seconds:6.2f} MB/s, {baseline_seconds / seconds:5.2f}x, "
+          f"{mismatches.get(parser_name, 0)} mismatches")
+
+
+if __name__ == "__main__":
+  main()
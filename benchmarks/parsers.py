@@ -0,0 +1,237 @@
+# parsers.py
+#
+# Runs every extractor over the checked-in corpus of anonymized emails (benchmarks/corpus) with
+# each installed HTML parser, checking the results against the golden values in
+# corpus/expected.json and reporting emails/sec, the time saved by parsing only the fragments that
+# the extractors need, and peak memory per parser. Exits with a non-zero status if any parser
+# extracts something other than the golden values, so it can be run after any change to the
+# extractors or parsers.
+#
+# Amazon tracking numbers need a browser, so for Amazon shipping emails the fields that go into
+# their Trackings (and the order URL that the browser would load) are checked instead.
+#
+# Usage: python -m benchmarks.parsers [--repeat N] [--parsers PARSER [PARSER ...]]
+#
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from lib.amazon_tracking_retriever import AmazonTrackingRetriever
+from lib.bestbuy_tracking_retriever import BestBuyTrackingRetriever
+from lib.cancelled_items_retriever import CancFmt, CancQty, get_cancelled_items_from_email
+from lib.email_decoder import decode_email
+from lib.email_tracking_retriever import EmailTrackingRetriever
+from lib.group_resolver import GroupResolver
+from lib.group_site_manager import get_bfmr_costs_from_email
+from lib.order_info import OrderInfoRetriever
+from lib.parsed_email import ParsedEmail, parse_email
+from benchmarks.html_parsers import get_installed_parsers
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+EXPECTED_FILENAME = os.path.join(CORPUS_DIR, 'expected.json')
+# Delivery dates don't have a year, so they're parsed as being in the current one.
+YEAR_PLACEHOLDER = 'YEAR'
+
+# An extractor takes an email's name, its raw bytes, the HTML parser to use, the config and the
+# email's entry in expected.json, and returns what was extracted.
+Extractor = Callable[[str, bytes, str, Dict[str, Any], Dict[str, Any]], Any]
+
+
+def _new_retriever(cls, config) -> EmailTrackingRetriever:
+  # Constructing a retriever connects to the mailbox, which the extractors don't need.
+  retriever = cls.__new__(cls)
+  retriever.config = config
+  retriever.args = argparse.Namespace(seen=False)
+  retriever.group_resolver = GroupResolver(config['groups'])
+  retriever.driver = None
+  return retriever
+
+
+def extract_amazon_shipping(name, raw_email, parser, config, entry) -> Dict[str, Any]:
+  retriever = _new_retriever(AmazonTrackingRetriever, config)
+  email = parse_email(raw_email, parser)
+  result = vars(retriever.extract_fields(email)).copy()
+  result['url'] = retriever.get_order_url_from_email(email)
+  return result
+
+
+def extract_amazon_transfer(name, raw_email, parser, config, entry) -> Tuple[str, str]:
+  retriever = _new_retriever(AmazonTrackingRetriever, config)
+  return retriever.get_transfer_from_email(decode_email(raw_email).content)
+
+
+def extract_bestbuy_shipping(name, raw_email, parser, config, entry) -> List[Dict[str, Any]]:
+  retriever = _new_retriever(BestBuyTrackingRetriever, config)
+  success, trackings = retriever.get_trackings_from_email(name, parse_email(raw_email, parser), 0)
+  if not success:
+    raise Exception(f"Incomplete trackings: {trackings}")
+  return sorted((vars(tracking) for tracking in trackings), key=lambda t: t['tracking_number'])
+
+
+def extract_amazon_order(name, raw_email, parser, config, entry) -> Dict[str, Any]:
+  retriever = OrderInfoRetriever.__new__(OrderInfoRetriever)
+  return retriever.get_amazon_order_totals_from_email(name, parse_email(raw_email, parser))
+
+
+def extract_bestbuy_order(name, raw_email, parser, config, entry) -> Dict[str, Any]:
+  retriever = OrderInfoRetriever.__new__(OrderInfoRetriever)
+  return retriever.get_bb_order_total_from_email(entry['orderId'], name,
+                                                 parse_email(raw_email, parser))
+
+
+def extract_cancellation(name, raw_email, parser, config, entry) -> List[str]:
+  canc_info = (CancFmt[entry['cancFmt']], CancQty[entry['cancQty']])
+  return get_cancelled_items_from_email(parse_email(raw_email, parser), canc_info)
+
+
+def extract_bfmr(name, raw_email, parser, config, entry) -> Dict[Tuple[str], Any]:
+  # BFMR emails are always parsed with html.parser, so this is the same for every parser.
+  return {tracking[0]: info for tracking, info in get_bfmr_costs_from_email(raw_email).items()}
+
+
+EXTRACTORS: Dict[str, Extractor] = {
+    'amazon_shipping': extract_amazon_shipping,
+    'amazon_transfer': extract_amazon_transfer,
+    'bestbuy_shipping': extract_bestbuy_shipping,
+    'amazon_order': extract_amazon_order,
+    'bestbuy_order': extract_bestbuy_order,
+    'cancellation': extract_cancellation,
+    'bfmr': extract_bfmr,
+}
+
+
+def to_json(value: Any) -> Any:
+  """
+  Converts an extraction result into what json.load would give for it, so that it can be compared
+  with expected.json: sets become sorted lists, value objects become dicts and costs are rounded
+  to the cent.
+  """
+  if isinstance(value, (set, frozenset)):
+    return sorted(to_json(v) for v in value)
+  if isinstance(value, (list, tuple)):
+    return [to_json(v) for v in value]
+  if isinstance(value, dict):
+    return {str(k): to_json(v) for k, v in value.items()}
+  if isinstance(value, float):
+    return round(value, 2)
+  if isinstance(value, (str, int, bool)) or value is None:
+    return value
+  return to_json(vars(value))
+
+
+def fill_year(value: Any) -> Any:
+  if isinstance(value, str):
+    return value.replace(YEAR_PLACEHOLDER, str(datetime.date.today().year))
+  if isinstance(value, list):
+    return [fill_year(v) for v in value]
+  if isinstance(value, dict):
+    return {k: fill_year(v) for k, v in value.items()}
+  return value
+
+
+def extract(name: str, raw_email: bytes, parser: str, config: Dict[str, Any],
+            entry: Dict[str, Any]) -> Any:
+  # Extractors log what they find, which would drown out the report.
+  with contextlib.redirect_stdout(io.StringIO()):
+    return EXTRACTORS[entry['kind']](name, raw_email, parser, config, entry)
+
+
+def check_parser(parser: str, emails: Dict[str, bytes], config: Dict[str, Any],
+                 entries: Dict[str, Dict[str, Any]]) -> int:
+  """Prints each email whose extraction differs from the golden values, returning how many did."""
+  mismatches = 0
+  for name, raw_email in emails.items():
+    expected = fill_year(entries[name]['expected'])
+    try:
+      result = to_json(extract(name, raw_email, parser, config, entries[name]))
+    except Exception as e:
+      result = f"{e.__class__.__name__}: {e}"
+    if result != expected:
+      mismatches += 1
+      print(f"{parser}: {name} doesn't match expected.json:\n  got      {result}\n"
+            f"  expected {expected}")
+  return mismatches
+
+
+def time_parser(parser: str, emails: Dict[str, bytes], config: Dict[str, Any],
+                entries: Dict[str, Dict[str, Any]], repeat: int) -> float:
+  """Returns the median time, in seconds, that extracting from the whole corpus takes."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for name, raw_email in emails.items():
+      extract(name, raw_email, parser, config, entries[name])
+    timings.append(time.perf_counter() - start)
+  return statistics.median(timings)
+
+
+def measure_memory(parser: str, emails: Dict[str, bytes], config: Dict[str, Any],
+                   entries: Dict[str, Dict[str, Any]]) -> Tuple[float, int]:
+  """
+  Returns the mean and the largest peak, in bytes, of the memory allocated while extracting from
+  each email. This is a separate pass from the timing, as tracing allocations slows everything
+  down.
+  """
+  peaks = []
+  for name, raw_email in emails.items():
+    # Tracing is restarted for each email, as resetting just the peak needs Python 3.9.
+    tracemalloc.start()
+    try:
+      extract(name, raw_email, parser, config, entries[name])
+      peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+      tracemalloc.stop()
+  return statistics.mean(peaks), max(peaks)
+
+
+def main():
+  installed_parsers = get_installed_parsers()
+  parser = argparse.ArgumentParser(description='Benchmark email parsing on the golden corpus')
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--parsers", nargs='+', choices=installed_parsers, default=installed_parsers)
+  args = parser.parse_args()
+
+  with open(EXPECTED_FILENAME, 'r') as f:
+    golden = json.load(f)
+  config = {'groups': golden['groups']}
+  entries = golden['emails']
+  emails = {}
+  for name in sorted(entries):
+    with open(os.path.join(CORPUS_DIR, name), 'rb') as f:
+      emails[name] = f.read()
+  total_kb = sum(len(raw_email) for raw_email in emails.values()) / 1024
+  print(f"Extracting from {len(emails)} emails ({total_kb:.0f} KB) with "
+        f"{', '.join(args.parsers)}, median of {args.repeat} runs")
+
+  total_mismatches = 0
+  for parser_name in args.parsers:
+    # Extraction is checked and timed both with fragments cut out and with whole emails parsed.
+    ParsedEmail.cut_fragments = False
+    mismatches = check_parser(parser_name, emails, config, entries)
+    whole_seconds = time_parser(parser_name, emails, config, entries, args.repeat)
+    ParsedEmail.cut_fragments = True
+    mismatches += check_parser(parser_name, emails, config, entries)
+    total_mismatches += mismatches
+    seconds = time_parser(parser_name, emails, config, entries, args.repeat)
+    mean_peak, max_peak = measure_memory(parser_name, emails, config, entries)
+    print(f"{parser_name:>12}: {len(emails) / seconds:8.1f} emails/s, "
+          f"{seconds * 1000 / len(emails):6.2f} ms/email "
+          f"({(whole_seconds - seconds) * 1000 / len(emails):5.2f} ms/email saved by fragments), "
+          f"peak memory {mean_peak / 1024:6.1f} KB/email (max {max_peak / 1024:6.1f} KB), "
+          f"{mismatches} mismatches")
+
+  if total_mismatches:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
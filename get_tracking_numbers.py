@@ -6,20 +6,36 @@
 # Optional parameters:
 #   --seen    Re-process already read emails.
 #   --days N  Set the lookback period to N days instead of using the configured
-#             value.
+#             value. If that reaches further back than the last successful
+#             run's search, the whole lookback period is searched.
+#   --full-scan  Search the whole lookback period instead of only the emails
+#                that arrived since the last successful run.
+#   --watch   Keep running, processing new shipping emails within seconds of
+#             their arrival (using IMAP IDLE) instead of exiting.
+#
+# If several email accounts are configured, they're all searched concurrently.
 
 import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import lib.email_auth as email_auth
 from lib import util
+from lib.checkpoint import EMAIL_SINK, OUTPUT_SINK, PORTALS_SINK, SHEETS_SINK, Checkpoint
 from lib.amazon_tracking_retriever import AmazonTrackingRetriever
 from lib.bestbuy_tracking_retriever import BestBuyTrackingRetriever
 from lib.config import open_config
 from lib.driver_creator import DriverCreator
 from lib.email_sender import EmailSender
 from lib.group_site_manager import GroupSiteManager
+from lib.mail_watcher import MailWatcher
 from lib.tracking_output import TrackingOutput
 from lib.tracking_uploader import TrackingUploader
 
+# How long we wait after a new email arrives in --watch mode before processing new emails.
+DEFAULT_WATCH_BATCH_SECONDS = 10
+
 
 def send_error_email(email_sender, subject):
   email_sender.send_email_content(subject, util.get_traceback_lines())
@@ -29,34 +45,106 @@ def main():
   parser = argparse.ArgumentParser(description='Get tracking #s script')
   parser.add_argument("--seen", action="store_true")
   parser.add_argument("--days")
+  parser.add_argument("--watch", action="store_true")
   args, _ = parser.parse_known_args()
+  if args.watch and args.seen:
+    parser.error("--watch can't be combined with --seen")
 
   driver_creator = DriverCreator()
 
   config = open_config()
-  email_config = config['email']
-  email_sender = EmailSender(email_config)
-
-  tracking_output = TrackingOutput(config)
-  existing_trackings = tracking_output.get_existing_trackings()
-
-  print("Retrieving Amazon tracking numbers from email ...")
-  amazon_tracking_retriever = AmazonTrackingRetriever(config, args, driver_creator)
+  accounts = email_auth.get_email_accounts(config)
+  # Notifications are always sent from the primary account.
+  email_sender = EmailSender(accounts[0])
+
+  checkpoint = Checkpoint()
+  # Each account has its own retrievers, and so its own connections and sync state.
+  retrievers = [(AmazonTrackingRetriever(config, args, driver_creator, checkpoint, account),
+                 BestBuyTrackingRetriever(config, args, driver_creator, checkpoint, account))
+                for account in accounts]
+
+  if not args.watch:
+    process_emails(config, args, driver_creator, email_sender, checkpoint, retrievers)
+    return
+
+  # Catch up on everything that arrived while we weren't watching, then process new emails in
+  # small batches as they arrive. Searches are incremental, so each batch is cheap to find.
+  batch_seconds = float(config.get('watchBatchSeconds', DEFAULT_WATCH_BATCH_SECONDS))
+  # Each account is watched on its own thread, since watching blocks on the account's connection.
+  # The threads are daemons, so their connections are simply dropped when we exit.
+  new_mail = threading.Event()
+  for account in accounts:
+    threading.Thread(
+        target=watch_for_new_mail, args=(MailWatcher(account), new_mail), daemon=True).start()
+  while True:
+    try:
+      process_emails(config, args, driver_creator, email_sender, checkpoint, retrievers)
+    except Exception as e:
+      # The emails were already marked as unread (and an error email sent), so they'll be
+      # retried along with the next batch.
+      print(f"Error processing emails: {e.__class__.__name__}: {str(e)}\n"
+            f"{util.get_traceback_lines()}")
+    print("Waiting for new emails...")
+    new_mail.wait()
+    # Give emails that arrive together (e.g. several shipments of one order) a moment to all
+    # arrive, so that they're processed as one batch.
+    time.sleep(batch_seconds)
+    new_mail.clear()
+
+
+def watch_for_new_mail(watcher: MailWatcher, new_mail: threading.Event) -> None:
+  while True:
+    watcher.wait_for_new_mail()
+    new_mail.set()
+
+
+def retrieve_trackings(email_sender, amazon_tracking_retriever, bestbuy_tracking_retriever):
+  username = amazon_tracking_retriever.email_config['username']
+  print(f"Retrieving Amazon tracking numbers from {username} ...")
   try:
     trackings = amazon_tracking_retriever.get_trackings()
   except:
-    send_error_email(email_sender, "Error retrieving Amazon emails")
+    send_error_email(email_sender, f"Error retrieving Amazon emails from {username}")
     raise
 
-  print("Retrieving Best Buy tracking numbers from email ...")
-  bestbuy_tracking_retriever = BestBuyTrackingRetriever(config, args, driver_creator)
+  print(f"Retrieving Best Buy tracking numbers from {username} ...")
   try:
     trackings.update(bestbuy_tracking_retriever.get_trackings())
   except:
-    send_error_email(email_sender, "Error retrieving Best Buy emails")
+    send_error_email(email_sender, f"Error retrieving Best Buy emails from {username}")
     raise
+  return trackings
+
+
+def process_emails(config, args, driver_creator, email_sender, checkpoint, retrievers):
+  """
+  Retrieves trackings from each account's emails concurrently (though accounts take turns with
+  the browser), then sends all of them to the sinks in a single pass. retrievers is a list of
+  (Amazon, Best Buy) retriever pairs, one per account.
+  """
+  all_retrievers = [retriever for pair in retrievers for retriever in pair]
+  tracking_output = TrackingOutput(config)
+  existing_trackings = tracking_output.get_existing_trackings()
 
-  amazon_tracking_retriever.add_transferred_trackings(existing_trackings, trackings)
+  # Leaving the executor waits for every account, so that each one's progress is checkpointed
+  # before any error is raised.
+  with ThreadPoolExecutor(max_workers=len(retrievers)) as executor:
+    futures = [executor.submit(retrieve_trackings, email_sender, *pair) for pair in retrievers]
+  trackings = {}
+  for future in futures:
+    trackings.update(future.result())
+
+  for amazon_tracking_retriever, _ in retrievers:
+    amazon_tracking_retriever.add_transferred_trackings(existing_trackings, trackings)
+  # Include everything parsed by a failed previous run, even if its emails weren't found again.
+  for tracking in checkpoint.get_all_trackings():
+    trackings.setdefault(tracking.tracking_number, tracking)
+  if args.watch and not trackings:
+    # Most new emails aren't shipping emails, so skip the uploads when there's nothing to upload.
+    for retriever in all_retrievers:
+      retriever.save_sync_state()
+    checkpoint.clear()
+    return
 
   try:
     existing_tracking_nos = set([t.tracking_number for t in existing_trackings])
@@ -65,11 +153,14 @@ def main():
           f"(out of {len(trackings)} total) from emails.")
     new_trackings = [trackings[n] for n in new_tracking_nos]
 
+    # Each sink only gets the trackings that it hasn't already accepted in a failed previous run.
     # We only need to process new tracking numbers if there are any;
     # otherwise skip straight to processing existing locally stored data.
-    if new_trackings:
+    trackings_to_email = checkpoint.get_pending(EMAIL_SINK, new_trackings)
+    if trackings_to_email:
       try:
-        email_sender.send_email(new_trackings)
+        email_sender.send_email(trackings_to_email)
+        checkpoint.mark_done(EMAIL_SINK, trackings_to_email)
       except Exception as e:
         # When running --seen, we're often processing a very large number of emails that can
         # take a long time, and the Tracking Numbers email isn't too important to us (but the
@@ -84,8 +175,10 @@ def main():
 
     print("Uploading all tracking numbers...")
     group_site_manager = GroupSiteManager(config, driver_creator)
+    trackings_to_upload = checkpoint.get_pending(PORTALS_SINK, trackings.values())
     try:
-      group_site_manager.upload(trackings.values())
+      group_site_manager.upload(trackings_to_upload)
+      checkpoint.mark_done(PORTALS_SINK, trackings_to_upload)
     except:
       send_error_email(email_sender, "Error uploading tracking numbers")
       if args.seen:
@@ -93,13 +186,15 @@ def main():
       else:
         raise
 
-    reconcilable_trackings = [t for t in new_trackings if t.reconcile]
+    reconcilable_trackings = checkpoint.get_pending(SHEETS_SINK,
+                                                    [t for t in new_trackings if t.reconcile])
 
     # Also only add new trackings to the sheet
     print("Adding results to Google Sheets")
     tracking_uploader = TrackingUploader(config)
     try:
       tracking_uploader.upload_trackings(reconcilable_trackings)
+      checkpoint.mark_done(SHEETS_SINK, reconcilable_trackings)
     except:
       send_error_email(email_sender, "Error uploading to Google Sheets")
       if args.seen:
@@ -109,19 +204,25 @@ def main():
 
     print("Writing results to file")
     try:
-      tracking_output.save_trackings(new_trackings)
+      trackings_to_save = checkpoint.get_pending(OUTPUT_SINK, new_trackings)
+      tracking_output.save_trackings(trackings_to_save)
+      checkpoint.mark_done(OUTPUT_SINK, trackings_to_save)
     except:
       send_error_email(email_sender, "Error writing output file")
       raise
+    for retriever in all_retrievers:
+      retriever.save_sync_state()
+    checkpoint.clear()
     print("Done")
   except:
     print("Exception thrown after looking at the emails.")
     if not args.seen:
       print("Marking all relevant emails as unread to reset.")
-    amazon_tracking_retriever.back_out_of_all()
-    bestbuy_tracking_retriever.back_out_of_all()
+    for retriever in all_retrievers:
+      retriever.back_out_of_all()
     if not args.seen:
       print("Marked all as unread.")
+    print("Progress was checkpointed, so the next run will skip the work that was already done.")
     raise
 
 
@@ -6,9 +6,11 @@ import glob
 
 from typing import List, Optional, Callable, Dict, Tuple
 
+import lib.email_auth as email_auth
 from lib.config import open_config
 from lib.driver_creator import DriverCreator
 from lib.email_sender import EmailSender
+from lib.group_resolver import GroupResolver
 from lib.group_site_manager import GroupSiteManager, clean_csv_tracking
 from lib.objects_to_sheet import ObjectsToSheet
 from lib.tracking import Tracking
@@ -16,22 +18,18 @@ from lib.tracking_output import TrackingOutput
 from lib.tracking_uploader import TrackingUploader
 
 config = open_config()
+# Built on first use, as other scripts import this module without needing it.
+group_resolver: Optional[GroupResolver] = None
 
 
 def get_group(address: str) -> Tuple[Optional[str], bool]:
-  address = address.upper()
-  for group in config['groups'].keys():
-    group_conf = config['groups'][group]
-    reconcile = bool(group_conf['reconcile']) if 'reconcile' in group_conf else True
-    group_keys = config['groups'][group]['keys']
-    if isinstance(group_keys, str):
-      group_keys = [group_keys]
-    for group_key in group_keys:
-      if str(group_key).upper() in address:
-        return group, reconcile
-  if len(address) > 3:
-    print(f"No group from address {address}:")
-  return None, True
+  global group_resolver
+  if group_resolver is None:
+    group_resolver = GroupResolver(config['groups'])
+  group, reconcile = group_resolver.get_address_group(address)
+  if group is None and len(address) > 3:
+    print(f"No group from address {address.upper()}:")
+  return group, reconcile
 
 
 def get_ship_date(ship_date_str: str) -> str:
@@ -214,7 +212,7 @@ def main():
   print(f"Number of new-to-us trackings: {len(new_trackings)}")
 
   new_tracking_objects = [trackings_after_save[t] for t in new_trackings]
-  email_config = config['email']
+  email_config = email_auth.get_email_accounts(config)[0]
   email_sender = EmailSender(email_config)
   email_sender.send_email(new_tracking_objects)
 
@@ -1,17 +1,21 @@
 import datetime
 import os
 import re
+import threading
 import time
 from typing import Dict, List, Optional, Tuple
 
 from selenium.webdriver.chrome.webdriver import WebDriver
 from tqdm import tqdm
-from bs4 import BeautifulSoup
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 from import_report import do_with_wait
 from lib.driver_creator import DriverCreator
-from lib.email_tracking_retriever import EmailTrackingRetriever, get_email_content
+from lib.email_decoder import decode_email
+from lib.email_tracking_retriever import EmailTrackingRetriever
+from lib.extraction_rules import Rule, RuleSet
+from lib.html_dom import Anchor
+from lib.parsed_email import ParsedEmail
 from lib.tracking import Tracking
 
 
@@ -47,28 +51,46 @@ def find_old_tracking_by_order(order_id: str, existing_trackings: List[Tracking]
 
 class AmazonTrackingRetriever(EmailTrackingRetriever):
 
-  first_regex = r'.*href="(http[^"]*ship-?track[^"]*)"'
-  second_regex = r'.*<a hr[^"]*=[^"]*"(http[^"]*progress-tracker[^"]*)"'
-  price_regex = r'.*Shipment [Tt]otal: ?(\$[\d,]+\.\d{2})'
-  order_ids_regex = r'(11\d-\d{7}-\d{7})'
+  parser_version = 1
+  # Accounts take turns with the browser: each one's login can prompt on stdin (and log into the
+  # same Amazon account), and Chrome won't open a profile that another driver is using.
+  browser_lock = threading.Lock()
+
+  # Patterns are searched for, rather than matched with a leading .*, which backtracks through
+  # the whole email (often hundreds of KB for business emails).
+  extraction_rules = RuleSet("Amazon", [
+      Rule('order_url', r'href="(http[^"]*ship-?track[^"]*)"', 1),
+      Rule('order_url', r'<a hr[^"]*=[^"]*"(http[^"]*progress-tracker[^"]*)"', 1),
+      Rule('price', r'Shipment [Tt]otal: ?(\$[\d,]+\.\d{2})', 1),
+      Rule('order_id', r'11\d-\d{7}-\d{7}'),
+      Rule('ups_tracking', r'1Z[A-Z0-9]{16}'),
+  ])
+  item_regex = re.compile(r'(.*Qty: \d+)')
+  tracking_id_regex = re.compile(r'Tracking ID: ([a-zA-Z0-9]+)')
   li_regex = re.compile(r"\d+\.\s+")
+  # The parts of the email that the DOM-based extractors need, so that only they're parsed.
+  items_anchors = (Anchor('orderIdPrefix', 'span'),)
+  delivery_date_anchors = (Anchor('criticalInfo'), Anchor('arrivalDate'))
 
   def add_transferred_trackings(self, existing_trackings: List[Tracking],
                                 new_trackings: Dict[str, Tracking]) -> None:
     print("Finding transferred trackings")
-    mail = self.get_all_mail_folder()
-    seen_filter = '(SEEN)' if self.args.seen else '(UNSEEN)'
-    status, search_response = mail.uid('SEARCH', None, seen_filter,
-                                       '(SUBJECT "We\'ve Transferred Your Amazon Package to UPS")')
-    email_ids = search_response[0].decode('utf-8').split()
+    email_ids = self.backend.search([[('SUBJECT', "We've Transferred Your Amazon Package to UPS")]],
+                                    self.get_state_criteria())
     if not email_ids:
       return
     failed_ids: List[str] = []
-    for email_id in tqdm(email_ids, desc="Processing transfers", unit="email"):
+    succeeded_ids: List[str] = []
+    for email_id, raw_email in tqdm(
+        self.backend.fetch(email_ids),
+        total=len(email_ids),
+        desc="Processing transfers",
+        unit="email"):
       try:
-        content = get_email_content(email_id, mail)
-        order_id = re.findall(self.order_ids_regex, content)[0]
-        new_tracking_number = re.findall('1Z[A-Z0-9]{16}', content)[0]
+        if raw_email is None:
+          raise Exception(f"Could not fetch email with ID {email_id}")
+        order_id, new_tracking_number = self.get_transfer_from_email(
+            decode_email(raw_email).content)
         old_tracking = find_old_tracking_by_order(order_id, existing_trackings, new_trackings)
         if not old_tracking:
           print(f"Couldn't find old tracking for order {order_id}, skipping")
@@ -79,58 +101,56 @@ class AmazonTrackingRetriever(EmailTrackingRetriever):
                                 old_tracking.merchant, old_tracking.reconcile,
                                 old_tracking.delivery_date)
         new_trackings[new_tracking_number] = new_tracking
+        succeeded_ids.append(email_id)
+        if self.checkpoint:
+          self.checkpoint.add_email_trackings(self.get_checkpoint_key(email_id), [new_tracking])
       except Exception as e:
         print(f"Exception when getting transferred tracking: {e}")
         failed_ids.append(email_id)
-    if self.args.seen:
-      self.mark_emails_as_unread(failed_ids)
+    self.record_results(succeeded_ids, failed_ids)
 
-  def get_order_url_from_email(self, raw_email):
-    match = re.match(self.first_regex, str(raw_email))
-    if not match:
-      match = re.match(self.second_regex, str(raw_email))
-    return match.group(1) if match else None
+  def get_transfer_from_email(self, email_str: str) -> Tuple[str, str]:
+    """Returns the order ID and new UPS tracking number from a package transfer email."""
+    matches = self.extraction_rules.scan(email_str)
+    return matches.all('order_id')[0], matches.all('ups_tracking')[0]
 
-  def get_order_ids_from_email(self, raw_email):
-    matches = re.findall(self.order_ids_regex, raw_email)
-    return list(set(matches))
+  def get_order_url_from_email(self, email: ParsedEmail):
+    return email.matches(self.extraction_rules).first('order_url')
 
-  def get_price_from_email(self, raw_email):
+  def get_order_ids_from_email(self, email: ParsedEmail):
+    return list(set(email.matches(self.extraction_rules).all('order_id')))
+
+  def get_price_from_email(self, email: ParsedEmail):
     # Price isn't necessary, so if we can't find it don't raise an exception
-    match = re.match(self.price_regex, raw_email)
-    if match:
-      return match.group(1)
-    return ''
+    return email.matches(self.extraction_rules).first('price') or ''
 
   def get_subject_searches(self):
-    return [["Your AmazonSmile order", "has shipped"], ["Your Amazon.com order", "has shipped"], ["Shipped", "this Amazon delivery"],
-            ["Shipped: Now arriving early"]]
+    return [["Your AmazonSmile order", "has shipped"], ["Your Amazon.com order", "has shipped"],
+            ["Shipped", "this Amazon delivery"], ["Shipped: Now arriving early"]]
 
   def get_merchant(self) -> str:
     return "Amazon"
 
-  def get_items_from_email(self, email_str):
-    item_regex = r'(.*Qty: \d+)'
-    soup = BeautifulSoup(email_str, features="html.parser")
-    order_prefix_span = soup.find("span", {"class": "orderIdPrefix"})
+  def get_items_from_email(self, email: ParsedEmail):
+    order_prefix_span = email.fragment_dom(self.items_anchors).find("span", class_="orderIdPrefix")
 
     if not order_prefix_span:
       # grouped-order shipments don't have item breakdowns but they do have total-price, so use that
-      return self.get_price_from_email(email_str)
+      return self.get_price_from_email(email)
 
     all_lis = order_prefix_span.find_all('li')
 
     item_descriptions = []
     for li in all_lis:
-      txt = li.getText().strip()
-      item_match = re.match(item_regex, txt)
+      txt = li.text.strip()
+      item_match = self.item_regex.match(txt)
       if item_match:
         item_descriptions.append(item_match.group(1))
     return ",".join(item_descriptions)
 
-  def get_tracking_numbers_from_email(self, raw_email, from_email: str,
+  def get_tracking_numbers_from_email(self, email: ParsedEmail, from_email: str,
                                       to_email: str) -> List[Tuple[str, Optional[str]]]:
-    url = self.get_order_url_from_email(raw_email)
+    url = self.get_order_url_from_email(email)
     if not url:
       return []
     # First, attempt with the pre-existing not-logged-in driver
@@ -201,8 +221,7 @@ class AmazonTrackingRetriever(EmailTrackingRetriever):
     self.load_url(driver, amazon_url)
     try:
       element = driver.find_element_by_xpath("//*[contains(text(), 'Tracking ID')]")
-      regex = r'Tracking ID: ([a-zA-Z0-9]+)'
-      match = re.match(regex, element.text)
+      match = self.tracking_id_regex.match(element.text)
       if not match:
         return []
       tracking_number = match.group(1).upper()
@@ -212,15 +231,15 @@ class AmazonTrackingRetriever(EmailTrackingRetriever):
         shipping_status = primary_status_elems[0].get_attribute("textContent").strip(" \t\n\r")
       else:
         shipping_status = driver.find_element_by_css_selector(
-          'section.promise-card h1.pt-promise-main-slot').text
+            'section.promise-card h1.pt-promise-main-slot').text
       return [(tracking_number, shipping_status)]
     except:
       # swallow this and continue on
       return []
 
-  def get_delivery_date_from_email(self, email_str):
-    soup = BeautifulSoup(email_str, features="html.parser")
-    critical_info = soup.find(id='criticalInfo')
+  def get_delivery_date_from_email(self, email: ParsedEmail):
+    dom = email.fragment_dom(self.delivery_date_anchors)
+    critical_info = dom.find(id='criticalInfo')
     # biz email
     if critical_info:
       tds = critical_info.find_all('td')
@@ -230,7 +249,7 @@ class AmazonTrackingRetriever(EmailTrackingRetriever):
           return date
       return ''
     # personal email
-    arrival_date_elem = soup.find(class_='arrivalDate')
+    arrival_date_elem = dom.find(class_='arrivalDate')
     if not arrival_date_elem:
       return ''
     return _parse_date(arrival_date_elem.text)
@@ -246,9 +265,11 @@ class AmazonTrackingRetriever(EmailTrackingRetriever):
     driver.get('https://www.amazon.com/gp/your-account/order-history/ref=ppx_yo_dt_b_orders')
     if 'amazon' in config:
       print("Signing into Amazon ...")
-      driver.find_element_by_css_selector('input[type="email"]').send_keys(config['amazon']['email'])
+      driver.find_element_by_css_selector('input[type="email"]').send_keys(
+          config['amazon']['email'])
       driver.find_element_by_css_selector('input[type="submit"]').click()
-      driver.find_element_by_css_selector('input[type="password"]').send_keys(config['amazon']['password'])
+      driver.find_element_by_css_selector('input[type="password"]').send_keys(
+          config['amazon']['password'])
       driver.find_element_by_css_selector('input[type="submit"]').click()
 
       orders_containers = driver.find_elements_by_id('ordersContainer')
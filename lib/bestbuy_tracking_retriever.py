@@ -1,32 +1,33 @@
-import re
 from typing import Tuple, Optional, List
 
 from lib.email_tracking_retriever import EmailTrackingRetriever
+from lib.extraction_rules import Rule, RuleSet
+from lib.parsed_email import ParsedEmail
 
 
 class BestBuyTrackingRetriever(EmailTrackingRetriever):
 
-  tracking_regexes = [
-      r'[^0-9A-Z](1Z[0-9A-Z]{16})[^0-9A-Z]',
-      r'Tracking #[<>br \/]*<a href="[^>]*>([A-Za-z0-9.]{10,27})<\/a>',
-      r'>Tracking #: ([0-9A-Z]{10,27})<', r'color:[^>]+>([0-9][0-9A-Z]{10,27})<\/a>'
-  ]
-  order_id_regex = r'(BBY(?:01|TX)-\d{12})'
+  parser_version = 1
 
-  def get_order_ids_from_email(self, raw_email):
+  extraction_rules = RuleSet("Best Buy", [
+      Rule('tracking', r'[^0-9A-Z](1Z[0-9A-Z]{16})[^0-9A-Z]', 1),
+      Rule('tracking', r'Tracking #[<>br \/]*<a href="[^>]*>([A-Za-z0-9.]{10,27})<\/a>', 1),
+      Rule('tracking', r'>Tracking #: ([0-9A-Z]{10,27})<', 1),
+      Rule('tracking', r'color:[^>]+>([0-9][0-9A-Z]{10,27})<\/a>', 1),
+      Rule('order_id', r'BBY(?:01|TX)-\d{12}'),
+  ])
+
+  def get_order_ids_from_email(self, email: ParsedEmail):
     result = set()
-    result.add(self._get_order_id(raw_email))
+    result.add(email.matches(self.extraction_rules).first('order_id'))
     return result
 
-  def get_price_from_email(self, raw_email):
+  def get_price_from_email(self, email: ParsedEmail):
     return None  # not implementable
 
-  def get_tracking_numbers_from_email(self, raw_email, from_email: str,
+  def get_tracking_numbers_from_email(self, email: ParsedEmail, from_email: str,
                                       to_email: str) -> List[Tuple[str, Optional[str]]]:
-    all_trackings = set()
-    for regex in self.tracking_regexes:
-      for match in re.finditer(regex, raw_email):
-        all_trackings.add(match.group(1))
+    all_trackings = set(email.matches(self.extraction_rules).all('tracking'))
     # The second part of the tuple here is the shipping status, which would need
     # to be retrieved from a shipping status web page (like it is for Amazon).
     return [(t, '') for t in all_trackings]
@@ -38,14 +39,8 @@ class BestBuyTrackingRetriever(EmailTrackingRetriever):
   def get_merchant(self) -> str:
     return "Best Buy"
 
-  def _get_order_id(self, raw_email):
-    match = re.search(self.order_id_regex, raw_email)
-    if not match:
-      return None
-    return match.group(1)
-
-  def get_items_from_email(self, email_str):
+  def get_items_from_email(self, email: ParsedEmail):
     return ""
 
-  def get_delivery_date_from_email(self, data):
+  def get_delivery_date_from_email(self, email: ParsedEmail):
     return ""
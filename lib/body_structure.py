@@ -0,0 +1,163 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from lib.email_decoder import decode_text
+
+FETCH_START_REGEX = re.compile(rb'^\d+ \(')
+LITERAL_REGEX = re.compile(rb'\{(\d+)\}$')
+UID_REGEX = re.compile(rb'UID (\d+)')
+HEADER_NAME_REGEX = re.compile(rb'^([^:\s]+):')
+
+# Headers that describe the encoding of the original message, which don't apply to the message
+# that we build out of a single decoded part.
+REPLACED_HEADERS = {b'content-type', b'content-transfer-encoding', b'mime-version'}
+
+
+class TextPart:
+  """
+  A value class that describes the text part of an email that we want to fetch, as found in its
+  BODYSTRUCTURE.
+  """
+
+  def __init__(self, number: str, subtype: str, encoding: str, charset: str) -> None:
+    self.number = number
+    self.subtype = subtype
+    self.encoding = encoding
+    self.charset = charset
+
+  def __str__(self) -> str:
+    return (f'{{number: {self.number}, subtype: {self.subtype}, encoding: {self.encoding}, '
+            f'charset: {self.charset}}}')
+
+  __repr__ = __str__
+
+
+def _quote_bytes(value: bytes) -> bytes:
+  return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def join_fetch_lines(data) -> List[bytes]:
+  """
+  imaplib splits FETCH responses that contain literals into several items. This joins them back
+  into one line per message, with literals inlined as quoted strings.
+  """
+  lines: List[bytes] = []
+  for part in data:
+    if isinstance(part, tuple):
+      text = LITERAL_REGEX.sub(b'', part[0]) + _quote_bytes(part[1])
+    elif isinstance(part, bytes):
+      text = part
+    else:
+      continue
+    if FETCH_START_REGEX.match(text) or not lines:
+      lines.append(text)
+    else:
+      lines[-1] += text
+  return lines
+
+
+def _parse_sexp(text: bytes, pos: int) -> Tuple[Any, int]:
+  """Parses one IMAP value (a parenthesized list, quoted string, NIL or atom) starting at pos."""
+  while text[pos:pos + 1] == b' ':
+    pos += 1
+  char = text[pos:pos + 1]
+  if char == b'(':
+    result = []
+    pos += 1
+    while True:
+      while text[pos:pos + 1] == b' ':
+        pos += 1
+      if text[pos:pos + 1] in (b')', b''):
+        return result, pos + 1
+      value, pos = _parse_sexp(text, pos)
+      result.append(value)
+  if char == b'"':
+    value = bytearray()
+    pos += 1
+    while pos < len(text) and text[pos:pos + 1] != b'"':
+      if text[pos:pos + 1] == b'\\':
+        pos += 1
+      value += text[pos:pos + 1]
+      pos += 1
+    return bytes(value).decode('utf-8', errors='replace'), pos + 1
+  end = pos
+  while end < len(text) and text[end:end + 1] not in (b' ', b'(', b')'):
+    end += 1
+  atom = text[pos:end].decode('utf-8', errors='replace')
+  return (None if atom.upper() == 'NIL' else atom), end
+
+
+def parse_bodystructure_response(data) -> Dict[str, list]:
+  """Parses the response of a UID FETCH (BODYSTRUCTURE) command into a dict of UID to structure."""
+  result = {}
+  for line in join_fetch_lines(data):
+    uid_match = UID_REGEX.search(line)
+    index = line.find(b'BODYSTRUCTURE ')
+    if not uid_match or index < 0:
+      continue
+    structure, _ = _parse_sexp(line, index + len(b'BODYSTRUCTURE '))
+    result[uid_match.group(1).decode('utf-8')] = structure
+  return result
+
+
+def _get_text_parts(structure: list, number: str) -> List[TextPart]:
+  if not structure:
+    return []
+  if isinstance(structure[0], list):
+    # A multipart body lists its children first, followed by its subtype and extension data.
+    result = []
+    for i, child in enumerate(structure):
+      if not isinstance(child, list):
+        break
+      result.extend(_get_text_parts(child, f'{number}.{i + 1}' if number else str(i + 1)))
+    return result
+  if len(structure) < 6 or str(structure[0]).upper() != 'TEXT':
+    return []
+  params = structure[2] if isinstance(structure[2], list) else []
+  charset = 'utf-8'
+  for i in range(0, len(params) - 1, 2):
+    if str(params[i]).upper() == 'CHARSET' and params[i + 1]:
+      charset = params[i + 1]
+  # Every message has at least one part number, even if it isn't multipart.
+  return [
+      TextPart(number or '1',
+               str(structure[1]).lower(),
+               str(structure[5] or '7BIT').upper(), charset)
+  ]
+
+
+def find_text_part(structure: list) -> Optional[TextPart]:
+  """Returns the first HTML part of the email, or its first plain text part if there's no HTML."""
+  text_parts = _get_text_parts(structure, '')
+  for subtype in ('html', 'plain'):
+    for text_part in text_parts:
+      if text_part.subtype == subtype:
+        return text_part
+  return None
+
+
+def decode_part(part_bytes: bytes, text_part: TextPart) -> str:
+  return decode_text(part_bytes, text_part.encoding, text_part.charset)
+
+
+def build_text_message(header_bytes: bytes, text: str, subtype: str) -> bytes:
+  """
+  Builds a single-part message out of the original headers and the decoded text of one part, so
+  that it can be handled exactly like a full RFC822 message.
+  """
+  lines = []
+  skipping = False
+  for line in header_bytes.rstrip(b'\r\n').split(b'\r\n'):
+    if line[:1] in (b' ', b'\t'):
+      # A folded continuation of the previous header.
+      if not skipping:
+        lines.append(line)
+      continue
+    name_match = HEADER_NAME_REGEX.match(line)
+    skipping = bool(name_match) and name_match.group(1).lower() in REPLACED_HEADERS
+    if not skipping:
+      lines.append(line)
+  lines.append(b'MIME-Version: 1.0')
+  lines.append(f'Content-Type: text/{subtype}; charset="utf-8"'.encode('utf-8'))
+  lines.append(b'Content-Transfer-Encoding: 8bit')
+  return b'\r\n'.join(lines) + b'\r\n\r\n' + text.encode('utf-8')
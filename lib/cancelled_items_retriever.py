@@ -1,18 +1,20 @@
-import email
-import quopri
 import re
 import sys
 import traceback
 import lib.email_auth as email_auth
 from tenacity import retry, stop_after_attempt, wait_exponential
 
-from bs4 import BeautifulSoup
 from enum import Enum
 
+from lib import search_planner
 from lib.debounce import debounce
+from lib.email_fetcher import EmailFetcher
+from lib.html_dom import Anchor
+from lib.mailbox_sync import MailboxSync
 from lib.object_retriever import ObjectRetriever
+from lib.parsed_email import ParsedEmail, parse_email
 from tqdm import tqdm
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 CANCELLATIONS_FILENAME = "cancellations.pickle"
 
@@ -28,13 +30,19 @@ class CancQty(Enum):
   NO = 2
 
 
-def get_cancelled_items_from_email(raw_email, canc_info: Tuple[CancFmt, CancQty]) -> List[str]:
-  soup = BeautifulSoup(
-      quopri.decodestring(raw_email), features="html.parser", from_encoding="iso-8859-1")
+CancInfo = Tuple[CancFmt, CancQty]
+
+# The cancelled items are listed in the table around their header, so only it needs parsing.
+CANCELLED_ITEMS_ANCHORS = (Anchor('Canceled Items', 'table', 1),)
+
+
+def get_cancelled_items_from_email(parsed_email: ParsedEmail,
+                                   canc_info: Tuple[CancFmt, CancQty]) -> List[str]:
+  dom = parsed_email.fragment_dom(CANCELLED_ITEMS_ANCHORS)
   if canc_info[0] == CancFmt.VOLUNTARY:
-    cancelled_header = soup.find("h3", text="Canceled Items")
+    cancelled_header = dom.find("h3", text="Canceled Items")
   elif canc_info[0] == CancFmt.INVOLUNTARY:
-    cancelled_header = soup.find("span", text="Canceled Items")
+    cancelled_header = dom.find("span", text="Canceled Items")
   elif canc_info[0] == CancFmt.IRRELEVANT:
     return []
   else:
@@ -50,28 +58,78 @@ def get_cancelled_items_from_email(raw_email, canc_info: Tuple[CancFmt, CancQty]
   return cancelled_items
 
 
+def get_cancellation_categories() -> List[Tuple[search_planner.SearchTerms, CancInfo]]:
+  subject_searches = {
+      ('Your Amazon.com order', 'has been canceled'): (CancFmt.IRRELEVANT, CancQty.NO),
+      ('Your Amazon.com Order', 'Has Been Canceled'): (CancFmt.IRRELEVANT, CancQty.NO),
+      ('Your Amazon.com Order', 'Has Been Cancelled'): (CancFmt.IRRELEVANT, CancQty.NO),
+      ('Your AmazonSmile order', 'has been canceled'): (CancFmt.IRRELEVANT, CancQty.NO),
+      ('Your AmazonSmile order', 'has been cancelled'): (CancFmt.IRRELEVANT, CancQty.NO),
+      ('Item canceled for your Amazon.com order',): (CancFmt.IRRELEVANT, CancQty.NO),
+      ('items have been cancelled from your AmazonSmile order',):
+          (CancFmt.IRRELEVANT, CancQty.NO),
+      ('Information from Amazon.com',): (CancFmt.IRRELEVANT, CancQty.NO),
+      (
+          "Successful cancellation of",
+          "from your AmazonSmile order",
+      ): (CancFmt.VOLUNTARY, CancQty.YES),
+      (
+          "Successful cancellation of",
+          "from your Amazon.com order",
+      ): (CancFmt.VOLUNTARY, CancQty.YES),
+      ("Partial item(s) cancellation from your Amazon.com order",):
+          (CancFmt.VOLUNTARY, CancQty.NO),
+      ("item has been canceled from your AmazonSmile order",): (CancFmt.INVOLUNTARY, CancQty.NO),
+      ("items have been canceled from your AmazonSmile order",):
+          (CancFmt.INVOLUNTARY, CancQty.NO),
+      ("items have been canceled from your Amazon.com order",): (CancFmt.INVOLUNTARY, CancQty.NO),
+      ("item has been canceled from your Amazon.com order",): (CancFmt.INVOLUNTARY, CancQty.NO)
+  }
+  categories = [(search_planner.subject_terms(search_terms), canc_info)
+                for search_terms, canc_info in subject_searches.items()]
+  # Bit of a hack, but we only care about this search term if it comes from a particular address.
+  # Ignore it otherwise.
+  categories.append(([('SUBJECT', 'Your Amazon.com Order('), ('FROM', 'no-reply@amazon.com')],
+                     (CancFmt.IRRELEVANT, CancQty.NO)))
+
+  return categories
+
+
 class CancelledItemsRetriever:
 
   def __init__(self, config):
+    self.config = config
     self.retriever = ObjectRetriever(config)
     # map of {email_id: {order_id: cancelled_items}}
     self.email_id_dict = self.retriever.load(CANCELLATIONS_FILENAME)
+    self.mailbox_sync = MailboxSync(config, "cancellation emails")
 
   # returns map of order_id ->
   def get_cancelled_items(self) -> Dict[str, List[str]]:
-    mail = self.load_mail()
-    all_email_ids = self.get_all_email_ids(mail)
+    email_ids = self.get_all_email_ids()
+
+    new_email_ids = [email_id for email_id in email_ids if email_id not in self.email_id_dict]
+    canc_infos = self.get_cancellation_infos(new_email_ids)
+    fetcher = EmailFetcher(self.config)
+    for email_id, raw_email in tqdm(
+        fetcher.fetch(new_email_ids),
+        total=len(new_email_ids),
+        desc="Fetching cancellations",
+        unit="email"):
+      email_result = self.get_cancellations_from_email(email_id, raw_email, canc_infos[email_id])
+      if email_result:
+        self.email_id_dict[email_id] = email_result
+        self.flush()
+
+    # Emails without results are searched again next time, as they were before incremental search.
+    all_email_ids = self.mailbox_sync.get_all_matched_ids()
+    self.mailbox_sync.save(
+        [email_id for email_id in email_ids if email_id not in self.email_id_dict])
 
     result = {}
-    for email_id, canc_info in tqdm(
-        all_email_ids.items(), desc="Fetching cancellations", unit="email"):
+    for email_id in all_email_ids:
       if email_id not in self.email_id_dict:
-        email_result = self.get_cancellations_from_email(mail, email_id, canc_info)
-        if email_result:
-          self.email_id_dict[email_id] = email_result
-          self.flush()
-        else:
-          continue
+        continue
 
       order_to_cancelled_items = self.email_id_dict[email_id]
       for order_id in order_to_cancelled_items:
@@ -82,85 +140,48 @@ class CancelledItemsRetriever:
     return result
 
   @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=2, max=120))
-  def get_all_email_ids(self, mail) -> Dict[str, Tuple[CancFmt, CancQty]]:
-    subject_searches = {
-        ('Your Amazon.com order', 'has been canceled'): (CancFmt.IRRELEVANT, CancQty.NO),
-        ('Your Amazon.com Order', 'Has Been Canceled'): (CancFmt.IRRELEVANT, CancQty.NO),
-        ('Your Amazon.com Order', 'Has Been Cancelled'): (CancFmt.IRRELEVANT, CancQty.NO),
-        ('Your AmazonSmile order', 'has been canceled'): (CancFmt.IRRELEVANT, CancQty.NO),
-        ('Your AmazonSmile order', 'has been cancelled'): (CancFmt.IRRELEVANT, CancQty.NO),
-        ('Item canceled for your Amazon.com order',): (CancFmt.IRRELEVANT, CancQty.NO),
-        ('items have been cancelled from your AmazonSmile order',):
-            (CancFmt.IRRELEVANT, CancQty.NO),
-        ('Information from Amazon.com',): (CancFmt.IRRELEVANT, CancQty.NO),
-        (
-            "Successful cancellation of",
-            "from your AmazonSmile order",
-        ): (CancFmt.VOLUNTARY, CancQty.YES),
-        (
-            "Successful cancellation of",
-            "from your Amazon.com order",
-        ): (CancFmt.VOLUNTARY, CancQty.YES),
-        ("Partial item(s) cancellation from your Amazon.com order",):
-            (CancFmt.VOLUNTARY, CancQty.NO),
-        ("item has been canceled from your AmazonSmile order",): (CancFmt.INVOLUNTARY, CancQty.NO),
-        ("items have been canceled from your AmazonSmile order",):
-            (CancFmt.INVOLUNTARY, CancQty.NO),
-        ("items have been canceled from your Amazon.com order",): (CancFmt.INVOLUNTARY, CancQty.NO),
-        ("item has been canceled from your Amazon.com order",): (CancFmt.INVOLUNTARY, CancQty.NO)
-    }
-    result_ids = dict()
-    for search_terms, canc_info in subject_searches.items():
-      search_terms = [f'(SUBJECT "{phrase}")' for phrase in search_terms]
-      status, response = mail.uid('SEARCH', None, *search_terms)
-      email_ids = response[0].decode('utf-8').split()
-      for email_id in email_ids:
-        result_ids[email_id] = canc_info
-
-    # Bit of a hack, but we only care about this search term if it comes from a particular address.
-    # Ignore it otherwise.
-    search_terms = [f'(SUBJECT "Your Amazon.com Order(")', '(FROM "no-reply@amazon.com")']
-    status, response = mail.uid('SEARCH', None, *search_terms)
-    email_ids = response[0].decode('utf-8').split()
-    for email_id in email_ids:
-      result_ids[email_id] = (CancFmt.IRRELEVANT, CancQty.NO)
-
-    return result_ids
+  def get_all_email_ids(self) -> List[str]:
+    """
+    Returns the IDs of all cancellation emails that have arrived since the last search, plus those
+    that we couldn't get results from last time.
+    """
+    return email_auth.run_in_all_mail(lambda mail: self.mailbox_sync.search(
+        mail, [terms for terms, _ in get_cancellation_categories()]))
 
   @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=2, max=120))
-  def get_cancellations_from_email(self, mail, email_id: str,
+  def get_cancellation_infos(self, email_ids: List[str]) -> Dict[str, Tuple[CancFmt, CancQty]]:
+    """
+    Maps each email to the format of the search that found it, using only the email's headers.
+    """
+    if not email_ids:
+      return {}
+    headers = EmailFetcher(self.config).fetch_headers(email_ids, ['SUBJECT', 'FROM'])
+    return search_planner.categorize(headers, get_cancellation_categories(),
+                                     (CancFmt.IRRELEVANT, CancQty.NO))
+
+  def get_cancellations_from_email(self, email_id: str, raw_email: Optional[bytes],
                                    canc_info: Tuple[CancFmt, CancQty]) -> Dict[str, List[str]]:
-    try:
-      result, data = mail.uid("FETCH", email_id, "(RFC822)")
-    except Exception as e:
-      print(
-          f"Received exception with message '{str(e)}' when processing cancellation email with ID {email_id}"
-      )
-      traceback.print_exc(file=sys.stdout)
+    if raw_email is None:
+      print(f"Could not fetch cancellation email with ID {email_id}")
       print("Continuing...")
       return {}
+    parsed_email = None
     try:
-      raw_email = data[0][1]
-      orders = set(re.findall("(\d{3}-\d{7}-\d{7})", str(raw_email)))
+      parsed_email = parse_email(raw_email)
+      orders = set(re.findall("(\d{3}-\d{7}-\d{7})", parsed_email.content))
       if not orders:
         return {}
-      cancelled_items = get_cancelled_items_from_email(raw_email, canc_info)
+      cancelled_items = get_cancelled_items_from_email(parsed_email, canc_info)
       return {order: cancelled_items for order in orders}
     except Exception as e:
-      msg = email.message_from_string(str(data[0][1], 'utf-8'))
+      subject = parsed_email.message['Subject'] if parsed_email else None
       print(
-          f"Received exception with message '{str(e)}' when processing cancellation email with subject {msg['Subject']}:"
+          f"Received exception with message '{str(e)}' when processing cancellation email with subject {subject}:"
       )
       traceback.print_exc(file=sys.stdout)
       print("Continuing...")
       return {}
 
-  @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=2, max=120))
-  def load_mail(self):
-    mail = email_auth.email_authentication()
-    mail.select('"[Gmail]/All Mail"')
-    return mail
-
   @retry(stop=stop_after_attempt(4), wait=wait_exponential(multiplier=1, min=2, max=120))
   @debounce(2)
   def flush(self) -> None:
@@ -0,0 +1,113 @@
+import os
+import pickle
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+from lib.object_retriever import OUTPUT_FOLDER
+from lib.tracking import Tracking
+
+CHECKPOINT_FILENAME = "tracking_checkpoint.pickle"
+
+# The downstream sinks that trackings are sent to, in the order that they're sent.
+EMAIL_SINK = "email"
+PORTALS_SINK = "portals"
+SHEETS_SINK = "sheets"
+OUTPUT_SINK = "output"
+
+
+class Checkpoint:
+  """
+  Records the progress of a get_tracking_numbers run locally: the trackings parsed out of each
+  email, and which downstream sinks have accepted which trackings. If a run fails partway
+  through, the next run reuses the parsed trackings instead of fetching and parsing those emails
+  again (including any Selenium page loads), and skips sinks that already accepted them.
+
+  The checkpoint is cleared once a run completes. It's only ever written locally, since it's
+  written after every email. Each email's trackings are appended to the file as a record of their
+  own, so that backfills of many emails don't rewrite the whole file each time; the file is
+  compacted into a single record whenever a sink accepts trackings.
+  """
+
+  def __init__(self, filename: str = CHECKPOINT_FILENAME) -> None:
+    self.path = os.path.join(OUTPUT_FOLDER, filename)
+    self.lock = threading.Lock()
+    # email ID -> trackings parsed from that email
+    self.email_trackings: Dict[str, List[Tracking]] = {}
+    # sink -> tracking numbers that the sink has accepted
+    self.sink_tracking_numbers: Dict[str, Set[str]] = {}
+    if os.path.exists(self.path):
+      self._load()
+      print(f"Resuming from a checkpoint with {len(self.email_trackings)} processed emails")
+
+  def _load(self) -> None:
+    """Replays the checkpoint's records: a compacted state, then any emails added since."""
+    truncated = False
+    with open(self.path, 'rb') as stream:
+      while True:
+        try:
+          record = pickle.load(stream)
+        except EOFError:
+          break
+        except Exception as e:
+          # The last record may have been cut short by a crash; its email is just parsed again.
+          print(f"Ignoring the end of the checkpoint, which couldn't be read: {e}")
+          truncated = True
+          break
+        if isinstance(record, dict):
+          self.email_trackings = record['email_trackings']
+          self.sink_tracking_numbers = record['sink_tracking_numbers']
+        else:
+          email_id, trackings = record
+          self.email_trackings[email_id] = trackings
+    if truncated:
+      # Records appended after the unreadable one would be unreadable too.
+      self._flush()
+
+  def get_email_trackings(self, email_id: str) -> Optional[List[Tracking]]:
+    """Returns the trackings parsed from the email by a previous run, if it got that far."""
+    return self.email_trackings.get(email_id)
+
+  def get_all_trackings(self) -> List[Tracking]:
+    return [tracking for trackings in self.email_trackings.values() for tracking in trackings]
+
+  def add_email_trackings(self, email_id: str, trackings: List[Tracking]) -> None:
+    with self.lock:
+      self.email_trackings[email_id] = trackings
+      if not os.path.exists(OUTPUT_FOLDER):
+        os.mkdir(OUTPUT_FOLDER)
+      with open(self.path, 'ab') as stream:
+        pickle.dump((email_id, trackings), stream)
+
+  def get_pending(self, sink: str, trackings: Iterable[Tracking]) -> List[Tracking]:
+    """Returns the given trackings that the sink hasn't accepted yet."""
+    done = self.sink_tracking_numbers.get(sink, set())
+    return [tracking for tracking in trackings if tracking.tracking_number not in done]
+
+  def mark_done(self, sink: str, trackings: Iterable[Tracking]) -> None:
+    with self.lock:
+      self.sink_tracking_numbers.setdefault(sink, set()).update(
+          tracking.tracking_number for tracking in trackings)
+      self._flush()
+
+  def clear(self) -> None:
+    with self.lock:
+      self.email_trackings = {}
+      self.sink_tracking_numbers = {}
+      if os.path.exists(self.path):
+        os.remove(self.path)
+
+  def _flush(self) -> None:
+    """
+    Writes the whole checkpoint as a single record, replacing the file atomically so that a crash
+    never leaves a truncated file.
+    """
+    if not os.path.exists(OUTPUT_FOLDER):
+      os.mkdir(OUTPUT_FOLDER)
+    tmp_path = f"{self.path}.tmp"
+    with open(tmp_path, 'wb') as stream:
+      pickle.dump(
+          {
+              'email_trackings': self.email_trackings,
+              'sink_tracking_numbers': self.sink_tracking_numbers
+          }, stream)
+    os.replace(tmp_path, self.path)
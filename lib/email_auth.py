@@ -3,9 +3,20 @@
 # Combine standard login with option of OAuth2.0
 #
 
+import atexit
 import base64
+import imaplib
+import re
+import select
 import smtplib
+import socket
+import ssl
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from imaplib import IMAP4_SSL
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
 from googleapiclient.discovery import build
 from httplib2 import Http
@@ -14,26 +25,386 @@ from oauth2client import file, client, tools
 from lib.config import open_config
 
 CONFIG = open_config()
-EMAIL_CONFIG = CONFIG['email']
 GMAIL_URL = "https://mail.google.com/"
 IMAPURL = "imap.gmail.com"
 SMTPURL = "smtp.gmail.com"
 SMTPPORT = "587"
+ALL_MAIL_FOLDER = '"[Gmail]/All Mail"'
+OAUTH_STORAGE_FILENAME = 'storage.json'
+
+
+def get_email_accounts(config) -> List[Dict[str, Any]]:
+  """
+  Returns the configured email accounts. The email section can be a single account or a list of
+  them; the first account is the primary one, which sends emails.
+  """
+  accounts = config['email']
+  return accounts if isinstance(accounts, list) else [accounts]
+
+
+EMAIL_CONFIG = get_email_accounts(CONFIG)[0]
 USERNAME = EMAIL_CONFIG["username"]
 
 
-def email_authentication() -> IMAP4_SSL:
-  mail = IMAP4_SSL(IMAPURL)
-  if "password" in EMAIL_CONFIG and EMAIL_CONFIG["password"]:
-    mail.login(EMAIL_CONFIG['username'], EMAIL_CONFIG['password'])
+def qualify(name: str, account: Optional[Dict[str, Any]] = None) -> str:
+  """
+  Qualifies a name used in local caches and saved state with the account that it belongs to. The
+  primary account's names are left as they are, so that its existing caches and state stay valid.
+  """
+  if not account or account['username'] == USERNAME:
+    return name
+  return f"{name} ({account['username']})"
+
+# The number of idle connections kept open by the session pool.
+DEFAULT_POOL_SIZE = 2
+# Connections that have been idle for longer than this are health-checked with a NOOP before they
+# are handed out again.
+HEALTH_CHECK_INTERVAL_SECONDS = 60
+# How long the All Mail folder's UIDVALIDITY is trusted before it's fetched again, so that a change
+# is noticed by long-running processes (e.g. in watch mode) before cached emails are looked up.
+UIDVALIDITY_MAX_AGE_SECONDS = 5 * 60
+MAX_ATTEMPTS = 2
+
+CONNECTION_ERRORS = (ConnectionError, socket.error, imaplib.IMAP4.abort)
+# The amount of compressed data that we read from the socket at a time.
+READ_CHUNK_SIZE = 64 * 1024
+
+# COMPRESS (RFC 4978) isn't one of the commands that imaplib knows about.
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+_T = TypeVar('_T')
+
+
+class TrafficCounters:
+  """
+  Counts the bytes sent and received over all IMAP connections in the process, both as seen by
+  imaplib and as sent over the wire (i.e. after compression), to measure the bandwidth saved.
+  """
+
+  def __init__(self) -> None:
+    self.lock = threading.Lock()
+    self.sent_bytes = 0
+    self.sent_wire_bytes = 0
+    self.received_bytes = 0
+    self.received_wire_bytes = 0
+
+  def add_sent(self, data_bytes: int, wire_bytes: int) -> None:
+    with self.lock:
+      self.sent_bytes += data_bytes
+      self.sent_wire_bytes += wire_bytes
+
+  def add_received(self, data_bytes: int, wire_bytes: int) -> None:
+    with self.lock:
+      self.received_bytes += data_bytes
+      self.received_wire_bytes += wire_bytes
+
+  def __str__(self) -> str:
+    saved = 1 - self.received_wire_bytes / self.received_bytes if self.received_bytes else 0
+    return (f"IMAP traffic: received {self.received_bytes / 1024 / 1024:.1f} MB as "
+            f"{self.received_wire_bytes / 1024 / 1024:.1f} MB over the wire ({saved:.0%} saved), "
+            f"sent {self.sent_bytes / 1024:.1f} KB as {self.sent_wire_bytes / 1024:.1f} KB")
+
+
+TRAFFIC_COUNTERS = TrafficCounters()
+
+
+class ImapConnection(IMAP4_SSL):
+  """
+  An IMAP4_SSL connection that can compress its traffic with COMPRESS=DEFLATE (RFC 4978), and that
+  counts its traffic in TRAFFIC_COUNTERS.
+  """
+
+  def __init__(self, host: str) -> None:
+    self.compressor = None
+    self.decompressor = None
+    # Decompressed data that hasn't been read yet.
+    self.decompressed = bytearray()
+    super().__init__(host)
+
+  def enable_compression(self) -> bool:
+    """
+    Starts compressing the connection if the server supports it. Call this after authenticating,
+    since servers may only advertise COMPRESS=DEFLATE to authenticated clients.
+    """
+    _, data = self.capability()
+    self.capabilities = tuple(data[-1].decode('utf-8').upper().split())
+    if 'COMPRESS=DEFLATE' not in self.capabilities:
+      return False
+    status, _ = self._simple_command('COMPRESS', 'DEFLATE')
+    if status != 'OK':
+      return False
+    # Raw deflate streams, without zlib headers.
+    self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    self.decompressor = zlib.decompressobj(-15)
+    return True
+
+  def send(self, data: bytes) -> None:
+    wire_data = data
+    if self.compressor:
+      wire_data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    TRAFFIC_COUNTERS.add_sent(len(data), len(wire_data))
+    super().send(wire_data)
+
+  def read(self, size: int) -> bytes:
+    if not self.decompressor:
+      data = super().read(size)
+      TRAFFIC_COUNTERS.add_received(len(data), len(data))
+      return data
+    while len(self.decompressed) < size:
+      self._read_chunk()
+    data = bytes(self.decompressed[:size])
+    del self.decompressed[:size]
+    TRAFFIC_COUNTERS.add_received(len(data), 0)
+    return data
+
+  def readline(self) -> bytes:
+    if not self.decompressor:
+      line = super().readline()
+      TRAFFIC_COUNTERS.add_received(len(line), len(line))
+      return line
+    searched = 0
+    while True:
+      end = self.decompressed.find(b'\n', searched)
+      if end >= 0:
+        break
+      if len(self.decompressed) > imaplib._MAXLINE:
+        raise self.error(f"got more than {imaplib._MAXLINE} bytes")
+      searched = len(self.decompressed)
+      self._read_chunk()
+    line = bytes(self.decompressed[:end + 1])
+    del self.decompressed[:end + 1]
+    TRAFFIC_COUNTERS.add_received(len(line), 0)
+    return line
+
+  def wait_for_data(self, timeout: float) -> bool:
+    """
+    Waits up to timeout seconds for something to read, returning whether there is. Data that's
+    already been received (and is waiting to be decrypted, read or decompressed) counts, so the
+    socket is only waited on once all of that has been read.
+    """
+    deadline = time.monotonic() + timeout
+    while not self._has_received_data():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      # Readable doesn't necessarily mean there's data for us (it may be a TLS record that's
+      # only for the TLS layer), so we check again.
+      select.select([self.sock], [], [], remaining)
+    return True
+
+  def _has_received_data(self) -> bool:
+    if self.decompressed or self.sock.pending():
+      return True
+    # Peeking at the buffered file reads from the socket if its buffer is empty, so the socket
+    # is made non-blocking while we peek to see whether there's anything in either.
+    timeout = self.sock.gettimeout()
+    self.sock.setblocking(False)
+    try:
+      return bool(self.file.peek())
+    except (ssl.SSLWantReadError, BlockingIOError):
+      return False
+    finally:
+      self.sock.settimeout(timeout)
+
+  def _read_chunk(self) -> None:
+    """Reads whatever compressed data is available (at least one byte) and decompresses it."""
+    chunk = self.file.read1(READ_CHUNK_SIZE)
+    if not chunk:
+      raise self.abort("socket error: EOF")
+    # Wire bytes are counted here, and decompressed bytes as they're read.
+    TRAFFIC_COUNTERS.add_received(0, len(chunk))
+    self.decompressed += self.decompressor.decompress(chunk)
+
+
+def email_authentication(account: Optional[Dict[str, Any]] = None) -> IMAP4_SSL:
+  """Logs in to the given account, or to the primary account if none is given."""
+  account = account or EMAIL_CONFIG
+  mail = ImapConnection(IMAPURL)
+  if "password" in account and account["password"]:
+    mail.login(account['username'], account['password'])
   else:
-    creds = get_oauth_credentials()
+    creds = get_oauth_credentials(account)
     client_credentials = creds.get_access_token().access_token
-    authstring = f"user={USERNAME}\1auth=Bearer {client_credentials}\1\1"
+    authstring = f"user={account['username']}\1auth=Bearer {client_credentials}\1\1"
     mail.authenticate('XOAUTH2', lambda x: authstring)
+  if CONFIG.get('imapCompression', True):
+    mail.enable_compression()
+  return mail
+
+
+def all_mail_authentication(account: Optional[Dict[str, Any]] = None) -> IMAP4_SSL:
+  mail = email_authentication(account)
+  mail.select(ALL_MAIL_FOLDER)
   return mail
 
 
+class ImapSessionPool:
+  """
+  A small pool of authenticated IMAP connections with the All Mail folder already selected, shared
+  by all of an account's email consumers in the process so that we don't log in again for every
+  operation.
+
+  Connections are leased exclusively with session() (or acquire()/release()). If all connections
+  are leased, a new one is opened rather than blocking; at most `size` idle connections are kept.
+  """
+
+  def __init__(self,
+               size: int = DEFAULT_POOL_SIZE,
+               connect: Callable[[], IMAP4_SSL] = all_mail_authentication) -> None:
+    self.size = size
+    self.connect = connect
+    self.lock = threading.Lock()
+    # (connection, time of last use) tuples
+    self.idle: List[Tuple[IMAP4_SSL, float]] = []
+    self.uidvalidity: Optional[str] = None
+    # When the UIDVALIDITY was last fetched.
+    self.uidvalidity_time = 0.0
+
+  def reserve(self, size: int) -> None:
+    """Makes sure that the pool keeps at least this many idle connections, e.g. one per worker."""
+    with self.lock:
+      self.size = max(self.size, size)
+
+  def acquire(self) -> IMAP4_SSL:
+    while True:
+      with self.lock:
+        if not self.idle:
+          break
+        mail, last_used = self.idle.pop()
+      if time.monotonic() - last_used < HEALTH_CHECK_INTERVAL_SECONDS or _is_healthy(mail):
+        return mail
+      _close_quietly(mail)
+    return self.connect()
+
+  def release(self, mail: IMAP4_SSL, broken: bool = False) -> None:
+    if not broken:
+      with self.lock:
+        if len(self.idle) < self.size:
+          self.idle.append((mail, time.monotonic()))
+          return
+    _close_quietly(mail)
+
+  @contextmanager
+  def session(self) -> Iterator[IMAP4_SSL]:
+    """
+    Leases a connection for the duration of the with block. Connections that hit a connection
+    error are discarded instead of being returned to the pool.
+    """
+    mail = self.acquire()
+    broken = False
+    try:
+      yield mail
+    except CONNECTION_ERRORS:
+      broken = True
+      raise
+    finally:
+      self.release(mail, broken)
+
+  def run(self, fn: Callable[[IMAP4_SSL], _T]) -> _T:
+    """
+    Runs fn with a leased connection, transparently retrying with a fresh connection if the
+    connection was lost.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+      try:
+        with self.session() as mail:
+          return fn(mail)
+      except CONNECTION_ERRORS:
+        if attempt >= MAX_ATTEMPTS - 1:
+          raise
+        # Re-initializing the IMAP connection and retrying should fix most
+        # connection-related errors.
+        # See https://stackoverflow.com/questions/7575943/eof-error-in-imaplib
+        print(f"IMAP connection lost; reconnecting (attempt {attempt + 1}).")
+
+  def get_uidvalidity(self) -> str:
+    """
+    Returns the UIDVALIDITY of the All Mail folder, which is fetched again if it's older than
+    UIDVALIDITY_MAX_AGE_SECONDS (every mailbox status fetch, e.g. before a search, refreshes it).
+    """
+    if (not self.uidvalidity or
+        time.monotonic() - self.uidvalidity_time >= UIDVALIDITY_MAX_AGE_SECONDS):
+      self.get_mailbox_status()
+    return self.uidvalidity
+
+  def get_mailbox_status(self) -> Dict[str, int]:
+    """
+    Returns the current UIDVALIDITY and UIDNEXT of the All Mail folder, plus HIGHESTMODSEQ if the
+    server supports CONDSTORE.
+    """
+
+    def get_status(mail: IMAP4_SSL):
+      items = ['UIDVALIDITY', 'UIDNEXT']
+      if 'CONDSTORE' in mail.capabilities:
+        items.append('HIGHESTMODSEQ')
+      return mail.status(ALL_MAIL_FOLDER, f'({" ".join(items)})')
+
+    _, data = self.run(get_status)
+    status = {
+        item: int(value)
+        for item, value in re.findall(r'([A-Z]+) (\d+)', data[0].decode('utf-8').split('(', 1)[1])
+    }
+    self.uidvalidity = str(status['UIDVALIDITY'])
+    self.uidvalidity_time = time.monotonic()
+    return status
+
+  def close_all(self) -> None:
+    with self.lock:
+      idle = self.idle
+      self.idle = []
+    for mail, _ in idle:
+      _close_quietly(mail)
+
+
+def _is_healthy(mail: IMAP4_SSL) -> bool:
+  try:
+    status, _ = mail.noop()
+    return status == 'OK'
+  except (imaplib.IMAP4.error, *CONNECTION_ERRORS):
+    return False
+
+
+def _close_quietly(mail: IMAP4_SSL) -> None:
+  try:
+    mail.logout()
+  except Exception:
+    pass
+
+
+# username -> that account's session pool
+_session_pools: Dict[str, ImapSessionPool] = {}
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool(account: Optional[Dict[str, Any]] = None) -> ImapSessionPool:
+  """Returns the session pool of the given account (or the primary account if none is given)."""
+  account = account or EMAIL_CONFIG
+  with _session_pool_lock:
+    pool = _session_pools.get(account['username'])
+    if not pool:
+      pool = ImapSessionPool(
+          int(CONFIG.get('imapPoolSize', DEFAULT_POOL_SIZE)),
+          lambda: all_mail_authentication(account))
+      _session_pools[account['username']] = pool
+      atexit.register(pool.close_all)
+      if len(_session_pools) == 1:
+        atexit.register(_print_traffic)
+    return pool
+
+
+def _print_traffic() -> None:
+  if TRAFFIC_COUNTERS.received_bytes:
+    print(TRAFFIC_COUNTERS)
+
+
+def run_in_all_mail(fn: Callable[[IMAP4_SSL], _T], account: Optional[Dict[str, Any]] = None) -> _T:
+  """
+  Runs fn with a pooled connection with All Mail selected, retrying with a fresh connection if the
+  pooled one was dropped by the server. fn may be run twice, so it should only read.
+  """
+  return get_session_pool(account).run(fn)
+
+
 def send_email(recipients, message):
   if "password" in EMAIL_CONFIG and EMAIL_CONFIG["password"]:
     s = smtplib.SMTP(SMTPURL, SMTPPORT)
@@ -42,7 +413,7 @@ def send_email(recipients, message):
     s.sendmail(EMAIL_CONFIG['username'], recipients, message.as_string())
     s.quit()
   else:
-    creds = get_oauth_credentials()
+    creds = get_oauth_credentials(EMAIL_CONFIG)
     service = build('gmail', 'v1', credentials=creds)
     raw = base64.urlsafe_b64encode(message.as_bytes())
     raw = raw.decode()
@@ -51,12 +422,29 @@ def send_email(recipients, message):
     service.users().messages().send(userId=EMAIL_CONFIG['username'], body=message).execute()
 
 
-def get_oauth_credentials():
-  store = file.Storage('storage.json')
-  creds = store.get()
-  if not creds or creds.invalid:
-    flow = client.flow_from_clientsecrets('client_secret.json', GMAIL_URL)
-    creds = tools.run_flow(flow, store)
-  else:
-    creds.refresh(Http())
-  return creds
+def get_oauth_storage_filename(account: Dict[str, Any]) -> str:
+  """
+  Returns the file that the account's OAuth credentials are stored in. Each extra account gets its
+  own file, unless one is configured with oauthStorage.
+  """
+  if 'oauthStorage' in account:
+    return account['oauthStorage']
+  if account['username'] == USERNAME:
+    return OAUTH_STORAGE_FILENAME
+  return f"storage-{account['username']}.json"
+
+
+_oauth_lock = threading.Lock()
+
+
+def get_oauth_credentials(account: Optional[Dict[str, Any]] = None):
+  # Accounts log in concurrently, and only one authorization flow can run at a time.
+  with _oauth_lock:
+    store = file.Storage(get_oauth_storage_filename(account or EMAIL_CONFIG))
+    creds = store.get()
+    if not creds or creds.invalid:
+      flow = client.flow_from_clientsecrets('client_secret.json', GMAIL_URL)
+      creds = tools.run_flow(flow, store)
+    else:
+      creds.refresh(Http())
+    return creds
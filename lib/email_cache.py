@@ -0,0 +1,133 @@
+import hashlib
+import os
+import threading
+import zlib
+from typing import Dict, Optional, Tuple
+
+from lib.object_retriever import OUTPUT_FOLDER
+
+CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, "email_cache")
+DEFAULT_CACHE_SIZE_MB = 512
+
+# (mailbox, UIDVALIDITY, UID, fetched section, e.g. RFC822)
+CacheKey = Tuple[str, str, str, str]
+
+
+class EmailCache:
+  """
+  A local, size-bounded cache of compressed raw emails keyed by (mailbox, UIDVALIDITY, UID) and
+  the section of the email that was fetched.
+
+  A UID identifies the same immutable message for as long as the mailbox's UIDVALIDITY doesn't
+  change, so entries never need to be invalidated, only evicted. When the cache grows past its
+  maximum size, the least recently used entries are deleted first (using file modification
+  times, which are refreshed on every read).
+  """
+
+  def __init__(self, max_bytes: int, folder: str = CACHE_FOLDER) -> None:
+    self.max_bytes = max_bytes
+    self.folder = folder
+    self.lock = threading.Lock()
+    # filename -> (size, last use time)
+    self.entries: Dict[str, Tuple[int, float]] = {}
+    self.total_bytes = 0
+    if self.enabled():
+      self._load_index()
+
+  def enabled(self) -> bool:
+    return self.max_bytes > 0
+
+  def _load_index(self) -> None:
+    if not os.path.exists(self.folder):
+      os.makedirs(self.folder)
+    for filename in os.listdir(self.folder):
+      path = os.path.join(self.folder, filename)
+      if filename.endswith('.tmp'):
+        os.remove(path)
+        continue
+      stat = os.stat(path)
+      self.entries[filename] = (stat.st_size, stat.st_mtime)
+      self.total_bytes += stat.st_size
+
+  def get(self, key: CacheKey) -> Optional[bytes]:
+    if not self.enabled():
+      return None
+    filename = _get_filename(key)
+    with self.lock:
+      if filename not in self.entries:
+        return None
+    path = os.path.join(self.folder, filename)
+    try:
+      with open(path, 'rb') as stream:
+        compressed = stream.read()
+      os.utime(path)
+    except OSError:
+      self._forget(filename)
+      return None
+    with self.lock:
+      if filename in self.entries:
+        self.entries[filename] = (len(compressed), os.path.getmtime(path))
+    try:
+      return zlib.decompress(compressed)
+    except zlib.error:
+      self._forget(filename)
+      return None
+
+  def put(self, key: CacheKey, raw_email: bytes) -> None:
+    if not self.enabled():
+      return
+    filename = _get_filename(key)
+    path = os.path.join(self.folder, filename)
+    compressed = zlib.compress(raw_email)
+    # Write to a temporary file first so that a crash never leaves a truncated entry behind.
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as stream:
+      stream.write(compressed)
+    os.replace(tmp_path, path)
+    with self.lock:
+      previous_size = self.entries[filename][0] if filename in self.entries else 0
+      self.entries[filename] = (len(compressed), os.path.getmtime(path))
+      self.total_bytes += len(compressed) - previous_size
+      self._evict()
+
+  def _forget(self, filename: str) -> None:
+    with self.lock:
+      if filename in self.entries:
+        self.total_bytes -= self.entries.pop(filename)[0]
+    try:
+      os.remove(os.path.join(self.folder, filename))
+    except OSError:
+      pass
+
+  def _evict(self) -> None:
+    """Deletes the least recently used entries until we're under the size limit. Needs the lock."""
+    if self.total_bytes <= self.max_bytes:
+      return
+    for filename in sorted(self.entries, key=lambda f: self.entries[f][1]):
+      if self.total_bytes <= self.max_bytes:
+        break
+      self.total_bytes -= self.entries.pop(filename)[0]
+      try:
+        os.remove(os.path.join(self.folder, filename))
+      except OSError:
+        pass
+
+
+def _get_filename(key: CacheKey) -> str:
+  mailbox, uidvalidity, uid, section = key
+  mailbox_hash = hashlib.sha1(mailbox.encode('utf-8')).hexdigest()[:12]
+  return f"{mailbox_hash}-{uidvalidity}-{uid}-{section}.z"
+
+
+_email_cache: Optional[EmailCache] = None
+_email_cache_lock = threading.Lock()
+
+
+def get_email_cache(config) -> EmailCache:
+  """Returns the process-wide email cache, sized according to emailCacheSizeMb in the config."""
+  global _email_cache
+  with _email_cache_lock:
+    if not _email_cache:
+      size_mb = float(config.get('emailCacheSizeMb', DEFAULT_CACHE_SIZE_MB))
+      _email_cache = EmailCache(int(size_mb * 1024 * 1024))
+    return _email_cache
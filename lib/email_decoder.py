@@ -0,0 +1,121 @@
+import base64
+import binascii
+import quopri
+import re
+from email.message import Message
+from email.parser import BytesHeaderParser
+from typing import List, Tuple
+
+HEADER_END_REGEX = re.compile(rb'\r?\n\r?\n')
+
+HEADER_PARSER = BytesHeaderParser()
+
+
+class DecodedEmail:
+  """
+  A value class that holds an email's parsed headers plus its content, ready for the parsers.
+  """
+
+  def __init__(self, message: Message, content: str) -> None:
+    # Only the headers of the email are parsed; the message has no payload.
+    self.message = message
+    # The headers followed by every decoded text part of the email.
+    self.content = content
+
+  def __str__(self) -> str:
+    return f'{{subject: {self.message["Subject"]}, content length: {len(self.content)}}}'
+
+  __repr__ = __str__
+
+
+def decode_email(raw_email: bytes) -> DecodedEmail:
+  """
+  Walks the MIME tree of the raw email once, decoding each text part according to its declared
+  transfer encoding and charset. Attachments and other non-text parts are skipped.
+
+  Only headers go through the email package's (line by line) parser; bodies are split on their
+  multipart boundaries and decoded as whole byte strings.
+  """
+  message, body = _parse_entity(raw_email)
+  texts = [f'{name}: {value}' for name, value in message.items()]
+  _decode_entity(message, body, texts)
+  # The parsers expect content without line breaks.
+  content = ''.join(texts).replace('\r', '').replace('\n', '').replace('&amp;', '&')
+  return DecodedEmail(message, content)
+
+
+def decode_text(body: bytes, encoding: str, charset: str) -> str:
+  """Decodes a body with the given Content-Transfer-Encoding and charset."""
+  encoding = encoding.strip().lower()
+  if encoding == 'base64':
+    try:
+      body = base64.b64decode(body)
+    except binascii.Error:
+      # Some senders drop the trailing padding.
+      stripped = b''.join(body.split())
+      try:
+        body = base64.b64decode(stripped + b'=' * (-len(stripped) % 4))
+      except binascii.Error:
+        pass
+  elif encoding == 'quoted-printable':
+    body = quopri.decodestring(body)
+  try:
+    return body.decode(charset, errors='replace')
+  except LookupError:
+    return body.decode('utf-8', errors='replace')
+
+
+def _parse_entity(raw: bytes) -> Tuple[Message, bytes]:
+  """Splits a MIME entity into its parsed headers and its (still encoded) body."""
+  if raw.startswith(b'\r\n') or raw.startswith(b'\n'):
+    # An entity without any headers.
+    return HEADER_PARSER.parsebytes(b''), raw[raw.find(b'\n') + 1:]
+  match = HEADER_END_REGEX.search(raw)
+  if not match:
+    return HEADER_PARSER.parsebytes(raw), b''
+  return HEADER_PARSER.parsebytes(raw[:match.end()]), raw[match.end():]
+
+
+def _decode_entity(headers: Message, body: bytes, texts: List[str]) -> None:
+  content_type = headers.get_content_type()
+  if headers.get_content_maintype() == 'multipart':
+    boundary = headers.get_boundary()
+    if boundary:
+      for part in _split_multipart(body, boundary):
+        _decode_entity(*_parse_entity(part), texts)
+  elif content_type == 'message/rfc822':
+    # e.g. a forwarded email
+    _decode_entity(*_parse_entity(body), texts)
+  elif headers.get_content_maintype() == 'text':
+    if headers.get_content_disposition() != 'attachment':
+      texts.append(
+          decode_text(body, str(headers.get('Content-Transfer-Encoding', '7bit')),
+                      headers.get_content_charset() or 'utf-8'))
+
+
+def _split_multipart(body: bytes, boundary: str) -> List[bytes]:
+  """Returns the body parts between the boundary delimiters of a multipart body."""
+  delimiter = b'--' + boundary.encode('utf-8')
+  parts = []
+  start = None
+  pos = body.find(delimiter)
+  while pos >= 0:
+    line_end = body.find(b'\n', pos)
+    if line_end < 0:
+      line_end = len(body)
+    # Delimiters must be on a line of their own, optionally followed by "--" and whitespace.
+    suffix = body[pos + len(delimiter):line_end].rstrip(b' \t\r')
+    if (pos == 0 or body[pos - 1:pos] == b'\n') and suffix in (b'', b'--'):
+      if start is not None:
+        # The line break before the delimiter belongs to the delimiter.
+        part_end = pos - 2 if body[pos - 2:pos] == b'\r\n' else pos - 1
+        parts.append(body[start:part_end])
+      if suffix == b'--':
+        # The closing delimiter; anything after it is an epilogue.
+        return parts
+      start = line_end + 1
+    pos = body.find(delimiter, line_end)
+  if start is not None:
+    # The email was truncated before its closing delimiter.
+    parts.append(body[start:])
+  return parts
@@ -0,0 +1,255 @@
+import collections
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from tqdm import tqdm
+
+import lib.email_auth as email_auth
+from lib import body_structure, util
+from lib.email_cache import get_email_cache
+from lib.gmail_labels import get_processed_labels
+
+# The number of UIDs requested per UID FETCH command when fetching in batches.
+DEFAULT_BATCH_SIZE = 50
+# The number of connections that fetch batches at the same time.
+DEFAULT_FETCH_WORKERS = 1
+
+# The maximum number of UID ranges sent in a single command, which keeps command lines short.
+MAX_UID_RANGES_PER_COMMAND = 500
+
+UID_REGEX = re.compile(rb'UID (\d+)')
+SECTION_REGEX = re.compile(rb'(RFC822|BODY\[[^\]]*\])(?:<\d+>)? \{\d+\}$')
+
+
+def to_uid_sets(email_ids: Iterable[str],
+                max_ranges: int = MAX_UID_RANGES_PER_COMMAND) -> Iterator[str]:
+  """
+  Compresses UIDs into IMAP UID sets of consecutive ranges, e.g. ['3', '1', '2', '7'] into
+  '1:3,7', yielding one UID set per max_ranges ranges.
+  """
+  uids = sorted(set(int(email_id) for email_id in email_ids))
+  ranges = []
+  for uid in uids:
+    if ranges and ranges[-1][1] == uid - 1:
+      ranges[-1][1] = uid
+    else:
+      ranges.append([uid, uid])
+  for chunk in util.chunks(ranges, max_ranges):
+    yield ','.join(str(start) if start == end else f'{start}:{end}' for start, end in chunk)
+
+
+def parse_fetch_response(data) -> Dict[str, bytes]:
+  """
+  Parses the response of a multi-UID FETCH command into a dict of UID to message body.
+
+  imaplib returns a list in which each message is a (header, literal) tuple, followed by a
+  closing b')'. The UID is normally in the tuple header, but some servers send it after the
+  literal instead, in which case it is in the following element.
+  """
+  result = {}
+  pending_body = None
+  for part in data:
+    if isinstance(part, tuple):
+      pending_body = part[1]
+      match = UID_REGEX.search(part[0])
+      if match:
+        result[match.group(1).decode('utf-8')] = pending_body
+        pending_body = None
+    elif isinstance(part, bytes) and pending_body is not None:
+      match = UID_REGEX.search(part)
+      if match:
+        result[match.group(1).decode('utf-8')] = pending_body
+      pending_body = None
+  return result
+
+
+def parse_fetch_sections(data) -> Dict[str, Dict[str, bytes]]:
+  """
+  Parses the response of a FETCH command that requests several sections per message (e.g.
+  BODY[HEADER] and BODY[1]) into a dict of UID to a dict of section name to section contents.
+  """
+  result: Dict[str, Dict[str, bytes]] = {}
+  uid = None
+  sections: Dict[str, bytes] = {}
+  for part in data:
+    header = part[0] if isinstance(part, tuple) else part
+    if not isinstance(header, bytes):
+      continue
+    if body_structure.FETCH_START_REGEX.match(header):
+      if uid and sections:
+        result.setdefault(uid, {}).update(sections)
+      uid = None
+      sections = {}
+    uid_match = UID_REGEX.search(header)
+    if uid_match:
+      uid = uid_match.group(1).decode('utf-8')
+    section_match = SECTION_REGEX.search(header)
+    if isinstance(part, tuple) and section_match:
+      sections[section_match.group(1).decode('utf-8')] = part[1]
+  if uid and sections:
+    result.setdefault(uid, {}).update(sections)
+  return result
+
+
+class EmailFetcher:
+  """
+  Fetches raw emails in batches of UIDs, so that each round trip to the server retrieves many
+  emails instead of just one. Connections come from the shared IMAP session pool, and emails are
+  read through the local email cache so that each one is only downloaded once.
+
+  If emailPartialFetch is set in the config, only the headers and the HTML (or plain text) part of
+  each email are downloaded, and the result is a single-part message with that part decoded.
+  Partial fetches use BODY.PEEK, so unlike full fetches they don't mark emails as read. Neither do
+  full fetches if emails' processed state is tracked with Gmail labels (see gmail_labels).
+
+  With emailFetchWorkers set above 1, that many connections fetch disjoint batches concurrently.
+  Emails are fetched from the given account, or the primary account if none is given.
+  """
+
+  def __init__(self, config, account: Optional[Dict[str, Any]] = None) -> None:
+    self.batch_size = int(config.get('emailFetchBatchSize', DEFAULT_BATCH_SIZE))
+    self.partial = bool(config.get('emailPartialFetch', False))
+    # When processed state is kept in labels, read state is left alone entirely.
+    self.peek = self.partial or get_processed_labels(config) is not None
+    self.workers = max(1, int(config.get('emailFetchWorkers', DEFAULT_FETCH_WORKERS)))
+    self.pool = email_auth.get_session_pool(account)
+    self.cache_mailbox = email_auth.qualify(email_auth.ALL_MAIL_FOLDER, account)
+    # Keep a connection per worker open between batches.
+    self.pool.reserve(self.workers)
+    self.cache = get_email_cache(config)
+
+  def marks_seen(self) -> bool:
+    """Whether fetching an email marks it as read, as a full RFC822 fetch does."""
+    return not self.peek
+
+  def fetch_batch(self, email_ids: List[str]) -> Dict[str, bytes]:
+    """
+    Fetches the given UIDs with a single UID FETCH command, reconnecting on connection errors.
+    UIDs that the server doesn't return are absent from the result.
+    """
+    if not self.cache.enabled():
+      return self._fetch_from_server(email_ids)
+
+    uidvalidity = self.pool.get_uidvalidity()
+    section = 'TEXT' if self.partial else 'RFC822'
+    result = {}
+    for email_id in email_ids:
+      raw_email = self.cache.get((self.cache_mailbox, uidvalidity, email_id, section))
+      if raw_email is not None:
+        result[email_id] = raw_email
+    if result and self.marks_seen():
+      # Fetching an email from the server marks it as read, and callers rely on that, so do the
+      # same for the emails that we read from the cache.
+      for uid_set in to_uid_sets(result.keys()):
+        self.pool.run(lambda mail: mail.uid('STORE', uid_set, '+FLAGS', '(\\Seen)'))
+
+    missing_ids = [email_id for email_id in email_ids if email_id not in result]
+    if missing_ids:
+      fetched = self._fetch_from_server(missing_ids)
+      for email_id, raw_email in fetched.items():
+        self.cache.put((self.cache_mailbox, uidvalidity, email_id, section), raw_email)
+      result.update(fetched)
+    return result
+
+  def fetch_headers(self, email_ids: Iterable[str], fields: Sequence[str]) -> Dict[str, bytes]:
+    """
+    Fetches only the given header fields of the given UIDs, without marking them as read.
+    """
+    query = f'(BODY.PEEK[HEADER.FIELDS ({" ".join(fields)})])'
+    result = {}
+    for uid_set in to_uid_sets(email_ids):
+      _, data = self.pool.run(lambda mail: mail.uid('FETCH', uid_set, query))
+      result.update(parse_fetch_response(data))
+    return result
+
+  def _fetch_from_server(self, email_ids: List[str]) -> Dict[str, bytes]:
+    if self.partial:
+      return self._fetch_text_parts(email_ids)
+    query = '(BODY.PEEK[])' if self.peek else '(RFC822)'
+    result, data = self.pool.run(lambda mail: mail.uid('FETCH', ','.join(email_ids), query))
+    return parse_fetch_response(data)
+
+  def _fetch_text_parts(self, email_ids: List[str]) -> Dict[str, bytes]:
+    """
+    Asks for the BODYSTRUCTURE of each email, then fetches only its headers and its text part.
+    Emails are grouped by the number of their text part, so this takes one FETCH per part number
+    (usually one or two) rather than one per email.
+    """
+    _, data = self.pool.run(lambda mail: mail.uid('FETCH', ','.join(email_ids), '(BODYSTRUCTURE)'))
+    text_parts = {
+        email_id: body_structure.find_text_part(structure)
+        for email_id, structure in body_structure.parse_bodystructure_response(data).items()
+    }
+    ids_by_part_number = collections.defaultdict(list)
+    for email_id, text_part in text_parts.items():
+      ids_by_part_number[text_part.number if text_part else None].append(email_id)
+
+    result = {}
+    for part_number, part_email_ids in ids_by_part_number.items():
+      uid_set = ','.join(part_email_ids)
+      if part_number is None:
+        # There's no text part, so fall back to the whole message.
+        _, data = self.pool.run(lambda mail: mail.uid('FETCH', uid_set, '(BODY.PEEK[])'))
+        for email_id, sections in parse_fetch_sections(data).items():
+          if 'BODY[]' in sections:
+            result[email_id] = sections['BODY[]']
+        continue
+
+      query = f'(BODY.PEEK[HEADER] BODY.PEEK[{part_number}])'
+      _, data = self.pool.run(lambda mail: mail.uid('FETCH', uid_set, query))
+      for email_id, sections in parse_fetch_sections(data).items():
+        part_bytes = sections.get(f'BODY[{part_number}]')
+        if 'BODY[HEADER]' not in sections or part_bytes is None:
+          continue
+        text_part = text_parts[email_id]
+        result[email_id] = body_structure.build_text_message(
+            sections['BODY[HEADER]'], body_structure.decode_part(part_bytes, text_part),
+            text_part.subtype)
+    return result
+
+  def fetch(self, email_ids: Iterable[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """
+    Lazily yields a (UID, raw email) tuple for each of the given UIDs, fetching them in batches of
+    the configured size. Batches are yielded in order unless there are several workers, in which
+    case they're yielded as they arrive. The raw email is None if it couldn't be fetched, so that
+    callers can apply their usual per-email failure handling.
+    """
+    batches = util.chunks(list(email_ids), self.batch_size)
+    if self.workers > 1:
+      results = self._fetch_concurrently(batches)
+    else:
+      results = map(self._fetch_batch_or_nothing, batches)
+    for batch, raw_emails in results:
+      for email_id in batch:
+        yield email_id, raw_emails.get(email_id)
+
+  def _fetch_batch_or_nothing(self, batch: List[str]) -> Tuple[List[str], Dict[str, bytes]]:
+    # Any error fetching the batch (the connection being lost, a FETCH that the server rejects or
+    # a response that can't be parsed) only fails the batch's emails, which each come back as None.
+    try:
+      return batch, self.fetch_batch(batch)
+    except Exception as e:
+      tqdm.write(f"Couldn't fetch emails {batch}: {e.__class__.__name__}: {str(e)}")
+      return batch, {}
+
+  def _fetch_concurrently(
+      self, batches: Iterator[List[str]]) -> Iterator[Tuple[List[str], Dict[str, bytes]]]:
+    """
+    Fetches batches on worker threads, each of which leases its own connection from the pool.
+    At most two batches per worker are in flight, so that fetched emails don't pile up in memory
+    faster than the caller can process them.
+    """
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      in_flight = set()
+      for batch in batches:
+        in_flight.add(executor.submit(self._fetch_batch_or_nothing, batch))
+        if len(in_flight) < self.workers * 2:
+          continue
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+          yield future.result()
+      while in_flight:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+          yield future.result()
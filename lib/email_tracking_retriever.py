@@ -1,50 +1,172 @@
-import base64
+import collections
 import datetime
-import email
-import imaplib
-import socket
+import multiprocessing
+import threading
 from abc import ABC, abstractmethod
-from typing import Any, Callable, Optional, Tuple, TypeVar, Dict, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Hashable, Iterable, Iterator, Optional, Tuple, TypeVar, Dict, List
 
 from selenium.webdriver.chrome.webdriver import WebDriver
 from tqdm import tqdm
 
 import lib.email_auth as email_auth
-from lib import util
+from lib import pipeline, search_planner, util
+from lib.checkpoint import Checkpoint
+from lib.parsed_email import ParsedEmail, parse_email
+from lib.gmail_labels import get_processed_labels
+from lib.group_resolver import GroupResolver
+from lib.mail_backend import get_mail_backend
+from lib.mailbox_sync import MailboxSync
+from lib.parse_cache import get_content_hash, get_parse_cache
 from lib.tracking import Tracking
 
 _FuncT = TypeVar('_FuncT', bound=Callable)
 
-BASE_64_FLAG = 'Content-Transfer-Encoding: base64'
 TODAY = datetime.date.today().strftime('%Y-%m-%d')
 MAX_ATTEMPTS = 2
+# How many emails each parsing process can be given ahead of the one being processed.
+PARSE_QUEUE_DEPTH = 4
+# How many fetched emails can wait to be parsed, and how many parsed emails can wait for their
+# tracking numbers to be found.
+FETCH_BUFFER_SIZE = 32
+PARSE_BUFFER_SIZE = 8
+
+
+class EmailFields:
+  """
+  A value class that stores everything extracted from a shipping email that doesn't need a
+  browser, so that it can be extracted in a separate parsing process.
+  """
+
+  def __init__(self, to_email: str, from_email: str, date: str, price: Any, order_ids: Any,
+               group: Optional[str], reconcile: bool, items: Any, delivery_date: Any) -> None:
+    self.to_email = to_email
+    self.from_email = from_email
+    self.date = date
+    self.price = price
+    self.order_ids = order_ids
+    self.group = group
+    self.reconcile = reconcile
+    self.items = items
+    self.delivery_date = delivery_date
+
+  def __str__(self) -> str:
+    return (f'{{to: {self.to_email}, date: {self.date}, price: {self.price}, '
+            f'order_ids: {self.order_ids}, group: {self.group}, items: {self.items}, '
+            f'delivery_date: {self.delivery_date}}}')
+
+  __repr__ = __str__
+
+
+def parse_and_extract(retriever: 'EmailTrackingRetriever',
+                      raw_email: bytes) -> Tuple[ParsedEmail, EmailFields]:
+  """Decodes and parses a raw email, then extracts its fields. Runs in parsing processes."""
+  email = parse_email(raw_email)
+  return email, retriever.extract_fields(email)
 
-class EmailTrackingRetriever(ABC):
 
-  def __init__(self, config, args, driver_creator) -> None:
+class EmailTrackingRetriever(ABC):
+  # Bump this whenever a change to the retriever means it would find different trackings in the
+  # same email, so that trackings cached from earlier versions aren't used.
+  parser_version = 1
+  # Retrievers that drive a browser set this to a lock that all of their accounts share, so that
+  # only one account at a time logs in (which can wait for input) and has browsers open.
+  browser_lock: Optional[threading.Lock] = None
+
+  def __init__(self,
+               config,
+               args,
+               driver_creator,
+               checkpoint: Optional[Checkpoint] = None,
+               account: Optional[Dict[str, Any]] = None) -> None:
     self.config = config
-    self.email_config = config['email']
+    # The account whose emails are retrieved; the primary account if none is given.
+    self.email_config = account or email_auth.get_email_accounts(config)[0]
     self.args = args
+    self.group_resolver = GroupResolver(config['groups'])
     self.driver_creator = driver_creator
     self.driver = None
     self.all_email_ids = []
+    # Emails that will need to be processed again, i.e. the ones we mark as unread.
+    self.pending_email_ids = []
+    self.backend = get_mail_backend(config, account)
+    # If set, parsed emails are checkpointed so that a failed run can be resumed.
+    self.checkpoint = checkpoint
+    self.parse_cache = get_parse_cache(config)
+    # If set, processed state is kept in Gmail labels instead of in the emails' read state.
+    self.labels = get_processed_labels(config)
+    # --seen runs are backfills, so they always search the whole lookback period.
+    self.mailbox_sync = None if args.seen else MailboxSync(
+        config, f"{self.get_merchant()} shipping emails", account)
+
+  def __getstate__(self):
+    # Parsing processes only get what the extractors need; connections and drivers stay here.
+    return {'config': self.config, 'args': self.args, 'group_resolver': self.group_resolver}
 
   def back_out_of_all(self) -> None:
     """
     Called when an exception is received. If running in the (default) unseen
-    mode, then all processed emails are set to unread again.
+    mode, then all processed emails are set to unread again (or unlabeled, if
+    processed state is kept in labels).
     """
-    self.mark_emails_as_unread(self.all_email_ids)
+    if self.labels:
+      self._set_label(self.all_email_ids, self.labels.processed, False)
+    else:
+      self.mark_emails_as_unread(self.all_email_ids)
 
   def mark_emails_as_unread(self, email_ids) -> None:
-    if not self.args.seen:
-      for email_id in tqdm(email_ids, desc="Marking emails as unread...", unit="email"):
-        self.mark_as_unread(email_id)
+    """
+    Clears the Seen flag on all of the given emails, using as few STORE commands as possible.
+    """
+    if not self.args.seen and email_ids:
+      self.backend.set_seen(email_ids, False)
+
+  def mark_emails_as_read(self, email_ids) -> None:
+    """
+    Sets the Seen flag on all of the given emails. This is only needed when the backend doesn't
+    already do so, e.g. for partial fetches.
+    """
+    if not self.args.seen and email_ids:
+      self.backend.set_seen(email_ids, True)
+
+  def record_results(self, succeeded_email_ids, unfinished_email_ids) -> None:
+    """
+    Records which emails have been processed, so that the unfinished ones are found again by the
+    next run's search.
+    """
+    if self.labels:
+      self._set_label(succeeded_email_ids, self.labels.processed, True)
+      self._set_label(succeeded_email_ids, self.labels.failed, False)
+      self._set_label(unfinished_email_ids, self.labels.failed, True)
+    elif self.backend.marks_seen():
+      # Unfinished emails are all marked as unread at once.
+      self.mark_emails_as_unread(unfinished_email_ids)
+    else:
+      # Partial fetches don't mark anything as read, so only the successes need to be marked.
+      self.mark_emails_as_read(succeeded_email_ids)
+
+  def _set_label(self, email_ids, label: str, present: bool) -> None:
+    if not self.args.seen and email_ids:
+      self.backend.set_label(email_ids, label, present)
+
+  def get_state_criteria(self) -> str:
+    """
+    Returns the search key that finds unprocessed emails (or, with --seen, processed ones).
+    """
+    if self.labels:
+      return self.labels.get_search_criteria(processed=self.args.seen)
+    return '(SEEN)' if self.args.seen else '(UNSEEN)'
+
+  def get_checkpoint_key(self, email_id: str) -> str:
+    """Email IDs are only unique within an account, so checkpointed emails are keyed by both."""
+    return email_auth.qualify(email_id, self.email_config)
+
+  def get_parse_cache_version(self) -> Tuple[int, str]:
+    """The groups are part of the cache version too, as trackings are assigned groups from them."""
+    return self.parser_version, repr(self.config['groups'])
 
   def mark_as_unread(self, email_id) -> None:
-    if not self.args.seen:
-      mail = self.get_all_mail_folder()
-      mail.uid('STORE', email_id, '-FLAGS', '(\Seen)')
+    self.mark_emails_as_unread([email_id])
 
   def get_trackings(self) -> Dict[str, Tracking]:
     """
@@ -61,39 +183,92 @@ class EmailTrackingRetriever(ABC):
     if not self.all_email_ids:
       return trackings
 
-    mail = self.get_all_mail_folder()
     # Emails that throw Exceptions and can't be parsed at all.
     failed_email_ids = []
     # Incomplete tracking information from emails with handled errors.
     incomplete_trackings = []
-
-    self.driver = self.log_in_if_necessary()
+    incomplete_email_ids = []
+    succeeded_email_ids = []
+
+    # Emails parsed by a previous run that failed later on don't need to be fetched again.
+    checkpointed_email_ids = []
+    email_ids_to_fetch = []
+    for email_id in self.all_email_ids:
+      checkpointed_trackings = self.checkpoint.get_email_trackings(
+          self.get_checkpoint_key(email_id)) if self.checkpoint else None
+      if checkpointed_trackings is None:
+        email_ids_to_fetch.append(email_id)
+        continue
+      for tracking in checkpointed_trackings:
+        trackings[tracking.tracking_number] = tracking
+      checkpointed_email_ids.append(email_id)
+    if checkpointed_email_ids:
+      print(f"Reusing trackings from {len(checkpointed_email_ids)} emails in the checkpoint.")
+    succeeded_email_ids.extend(checkpointed_email_ids)
+
+    def add_trackings(email_id: str, new_trackings: List[Tracking]) -> None:
+      for new_tracking in new_trackings:
+        trackings[new_tracking.tracking_number] = new_tracking
+      succeeded_email_ids.append(email_id)
+      if self.checkpoint:
+        self.checkpoint.add_email_trackings(self.get_checkpoint_key(email_id), new_trackings)
+
+    cache_version = self.get_parse_cache_version()
+    cached_email_ids = []
+    holds_browser_lock = False
     try:
-      for email_id in tqdm(self.all_email_ids, desc="Fetching trackings", unit="email"):
-        try:
-          for attempt in range(MAX_ATTEMPTS):
-            try:
-              success, new_trackings = self.get_trackings_from_email(email_id, mail, attempt)
-            except (ConnectionError, socket.error, imaplib.IMAP4.abort):
-              tqdm.write(f"Connection lost; reconnecting (attempt {attempt + 1}).")
-              # Re-initializing the IMAP connection and retrying should fix most
-              # connection-related errors.
-              # See https://stackoverflow.com/questions/7575943/eof-error-in-imaplib
-              mail = self.get_all_mail_folder()
+      # Emails go through a pipeline of stages that run at the same time, with a bounded buffer
+      # between each: they're fetched from the server in batches (with reconnection handled by
+      # the backend), then parsed (possibly in other processes), then their tracking numbers are
+      # found here one at a time, as that can need the browser. Emails whose trackings were
+      # already found by an earlier run are only fetched, so that their content can be hashed.
+      fetch_stage = pipeline.buffered(
+          self.backend.fetch(email_ids_to_fetch), FETCH_BUFFER_SIZE, name="fetch")
+      parse_stage = pipeline.buffered(
+          self.parse_emails(fetch_stage, cache_version), PARSE_BUFFER_SIZE, name="parse")
+      try:
+        with tqdm(
+            total=len(email_ids_to_fetch), desc="Fetching trackings", unit="email") as progress:
+          for email_id, content_hash, cached_trackings, parsed in parse_stage:
+            progress.update()
+            if cached_trackings is not None:
+              add_trackings(email_id, cached_trackings)
+              cached_email_ids.append(email_id)
               continue
-            if success:
-              for new_tracking in new_trackings:
-                trackings[new_tracking.tracking_number] = new_tracking
-              break
-            elif attempt >= MAX_ATTEMPTS - 1:
-              tqdm.write(f"Failed to find tracking number from email after {MAX_ATTEMPTS} retries;"
-                         f" we got: {new_trackings}")
-              incomplete_trackings.extend(new_trackings)
-              self.mark_as_unread(email_id)
-        except Exception as e:
-          failed_email_ids.append(email_id)
-          tqdm.write(f"Unexpected error fetching tracking from email ID {email_id}: "
-                     f"{e.__class__.__name__}: {str(e)}: {util.get_traceback_lines()}")
+            # We only log in once an email needs it. Other accounts keep fetching and parsing
+            # while they wait for the browser.
+            if self.driver is None and not isinstance(parsed, Exception):
+              if self.browser_lock and not holds_browser_lock:
+                self.browser_lock.acquire()
+                holds_browser_lock = True
+              self.driver = self.log_in_if_necessary()
+            try:
+              if isinstance(parsed, Exception):
+                raise parsed
+              parsed_email, fields = parsed
+              for attempt in range(MAX_ATTEMPTS):
+                success, new_trackings = self.get_trackings_from_email(
+                    email_id, parsed_email, attempt, fields)
+                if success:
+                  add_trackings(email_id, new_trackings)
+                  self.parse_cache.put(self.get_merchant(), cache_version, content_hash,
+                                       new_trackings)
+                  break
+                elif attempt >= MAX_ATTEMPTS - 1:
+                  tqdm.write(f"Failed to find tracking number from email after {MAX_ATTEMPTS} "
+                             f"retries; we got: {new_trackings}")
+                  incomplete_trackings.extend(new_trackings)
+                  incomplete_email_ids.append(email_id)
+            except Exception as e:
+              failed_email_ids.append(email_id)
+              tqdm.write(f"Unexpected error fetching tracking from email ID {email_id}: "
+                         f"{e.__class__.__name__}: {str(e)}: {util.get_traceback_lines()}")
+      finally:
+        # Stop the earlier stages (if they're still going) before anything else uses the backend.
+        parse_stage.close()
+        fetch_stage.close()
+      if cached_email_ids:
+        print(f"Reused the trackings of {len(cached_email_ids)} emails that were parsed before.")
 
     except Exception as e:
       if not self.args.seen:
@@ -104,52 +279,42 @@ class EmailTrackingRetriever(ABC):
     finally:
       if self.driver:
         self.driver.quit()
-  
+        self.driver = None
+      if holds_browser_lock:
+        self.browser_lock.release()
+      self.parse_cache.flush()
+
+    self.pending_email_ids = incomplete_email_ids + failed_email_ids
+    self.record_results(succeeded_email_ids, self.pending_email_ids)
+    if checkpointed_email_ids and self.backend.marks_seen() and not self.labels:
+      # These weren't fetched this time, so fetching didn't mark them as read.
+      self.mark_emails_as_read(checkpointed_email_ids)
+
     if len(incomplete_trackings) > 0:
       print("Couldn't find full tracking info/matching buying group for some emails.\n"
             "Here's what we got:\n" + "\n".join([str(t) for t in incomplete_trackings]))
       if not self.args.seen:
-        print("They were already marked as unread.")
+        print("They will be retried next time.")
 
     if len(failed_email_ids) > 0:
       print(f"Errored out while retrieving {len(failed_email_ids)} trackings "
             f"with email IDs: {failed_email_ids}.")
-      if not self.args.seen:
-        print("Marking these emails as unread.")
-        self.mark_emails_as_unread(failed_email_ids)
 
     return trackings
 
   def get_buying_group(self, raw_email) -> Tuple[str, bool]:
-    raw_email = raw_email.upper()
-    for group in self.config['groups'].keys():
-      group_conf = self.config['groups'][group]
-      # An optional "except" list in the config indicates terms that we wish to avoid for this
-      # group. If a term is found that's in this list, we will not include this email as part of
-      # the group in question. This is useful when two groups share the same address.
-      if any(
-          [str(except_elem).upper() in raw_email for except_elem in group_conf.get('except', [])]):
-        continue
-
-      reconcile = bool(group_conf['reconcile']) if 'reconcile' in group_conf else True
-      group_keys = group_conf['keys']
-      if isinstance(group_keys, str):
-        group_keys = [group_keys]
-      for group_key in group_keys:
-        if str(group_key).upper() in raw_email:
-          return group, reconcile
-    return None, True
+    return self.group_resolver.get_group(raw_email)
 
   @abstractmethod
-  def get_order_ids_from_email(self, raw_email) -> Any:
+  def get_order_ids_from_email(self, email: ParsedEmail) -> Any:
     pass
 
   @abstractmethod
-  def get_price_from_email(self, raw_email) -> Any:
+  def get_price_from_email(self, email: ParsedEmail) -> Any:
     pass
 
   @abstractmethod
-  def get_tracking_numbers_from_email(self, raw_email, from_email: str,
+  def get_tracking_numbers_from_email(self, email: ParsedEmail, from_email: str,
                                       to_email: str) -> List[Tuple[str, Optional[str]]]:
     """
     Returns a potentially empty list of (tracking number, optional shipping status) tuples.
@@ -165,47 +330,128 @@ class EmailTrackingRetriever(ABC):
     pass
 
   @abstractmethod
-  def get_items_from_email(self, email_str) -> Any:
+  def get_items_from_email(self, email: ParsedEmail) -> Any:
     pass
 
   @abstractmethod
-  def get_delivery_date_from_email(self, email_str) -> Any:
+  def get_delivery_date_from_email(self, email: ParsedEmail) -> Any:
     pass
 
   # By default this does nothing, but it can be used for logging into amazon
   def log_in_if_necessary(self):
     pass
 
-  def get_trackings_from_email(self, email_id, mail, attempt: int) -> Tuple[bool, List[Tracking]]:
+  def parse_emails(
+      self,
+      fetched: Iterable[Tuple[str, Optional[bytes]]],
+      cache_version: Optional[Hashable] = None
+  ) -> Iterator[Tuple[str, Optional[str], Optional[List[Tracking]], Any]]:
     """
-    Returns a Tuple of boolean success status and tracking information for a
-    given email id. If success is True then the tracking info is complete and
-    should be used, otherwise if False then the tracking info is incomplete
-    and is only suitable for use as error output.
-    """
-    email_str = get_email_content(email_id, mail)
+    Lazily parses the fetched emails and extracts their fields, yielding an (ID, content hash,
+    cached trackings, (ParsedEmail, EmailFields)) tuple per email in order. Emails whose
+    trackings are in the parse cache for the given version aren't parsed, and emails that couldn't
+    be fetched or parsed have an exception instead of the parse result.
 
-    msg = email.message_from_string(email_str)
+    With emailParseWorkers set, that many processes parse emails ahead of the one whose tracking
+    numbers are being found, so that parsing overlaps with browser page loads and fetching.
+    """
+    workers = int(self.config.get('emailParseWorkers', 0))
+    if workers <= 0:
+      for email_id, raw_email in fetched:
+        content_hash, cached_trackings = self._get_cached_trackings(raw_email, cache_version)
+        if cached_trackings is not None:
+          yield email_id, content_hash, cached_trackings, None
+          continue
+        try:
+          if raw_email is None:
+            raise Exception("Could not fetch email from server")
+          yield email_id, content_hash, None, parse_and_extract(self, raw_email)
+        except Exception as e:
+          yield email_id, content_hash, None, e
+      return
+
+    # Parsing processes are spawned rather than forked: by now other threads (fetching, other
+    # accounts) are running, and a forked child could inherit locks that they hold.
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+      # (ID, content hash, cached trackings, future or exception) tuples, in fetch order
+      pending = collections.deque()
+      for email_id, raw_email in fetched:
+        content_hash, cached_trackings = self._get_cached_trackings(raw_email, cache_version)
+        if cached_trackings is not None:
+          pending.append((email_id, content_hash, cached_trackings, None))
+        elif raw_email is None:
+          pending.append(
+              (email_id, content_hash, None, Exception("Could not fetch email from server")))
+        else:
+          pending.append(
+              (email_id, content_hash, None, executor.submit(parse_and_extract, self, raw_email)))
+        while len(pending) > workers * PARSE_QUEUE_DEPTH:
+          yield self._get_parse_result(*pending.popleft())
+      while pending:
+        yield self._get_parse_result(*pending.popleft())
+
+  def _get_cached_trackings(
+      self, raw_email: Optional[bytes],
+      cache_version: Optional[Hashable]) -> Tuple[Optional[str], Optional[List[Tracking]]]:
+    """Returns the email's content hash and its trackings from the parse cache, if they're there."""
+    if raw_email is None:
+      return None, None
+    content_hash = get_content_hash(raw_email)
+    if cache_version is None:
+      return content_hash, None
+    return content_hash, self.parse_cache.get(self.get_merchant(), cache_version, content_hash)
+
+  @staticmethod
+  def _get_parse_result(email_id: str, content_hash: Optional[str],
+                        cached_trackings: Optional[List[Tracking]],
+                        result: Any) -> Tuple[str, Optional[str], Optional[List[Tracking]], Any]:
+    if result is None or isinstance(result, Exception):
+      return email_id, content_hash, cached_trackings, result
+    try:
+      return email_id, content_hash, cached_trackings, result.result()
+    except Exception as e:
+      return email_id, content_hash, cached_trackings, e
 
-    email_str = clean_email_content(email_str)
+  def extract_fields(self, email: ParsedEmail) -> EmailFields:
+    msg = email.message
     to_email = str(msg['To']).replace('<', '').replace('>', '') if msg['To'] else ''
     from_email = str(msg['From']).replace('<', '').replace(
         '>', '') if msg['From'] else ''  # Also has display name.
     date = datetime.datetime.strptime(
         msg['Date'], '%a, %d %b %Y %H:%M:%S %z').strftime('%Y-%m-%d') if msg['Date'] else TODAY
-    price = self.get_price_from_email(email_str)
-    order_ids = self.get_order_ids_from_email(email_str)
-    group, reconcile = self.get_buying_group(email_str)
-    tracking_nums = self.get_tracking_numbers_from_email(email_str, from_email, to_email)
+    group, reconcile = self.get_buying_group(email.content)
+    # TODO: Ideally, handle items per-tracking.
+    return EmailFields(to_email, from_email, date, self.get_price_from_email(email),
+                       self.get_order_ids_from_email(email), group, reconcile,
+                       self.get_items_from_email(email), self.get_delivery_date_from_email(email))
+
+  def get_trackings_from_email(self,
+                               email_id,
+                               email: ParsedEmail,
+                               attempt: int,
+                               fields: Optional[EmailFields] = None) -> Tuple[bool, List[Tracking]]:
+    """
+    Returns a Tuple of boolean success status and tracking information for a
+    given email id and its parsed content. If success is True then the tracking
+    info is complete and should be used, otherwise if False then the tracking
+    info is incomplete and is only suitable for use as error output. The
+    email's fields are extracted unless they've already been extracted.
+    """
+    fields = fields or self.extract_fields(email)
+    to_email = fields.to_email
+    date = fields.date
+    price = fields.price
+    order_ids = fields.order_ids
+    group = fields.group
+    items = fields.items
+    tracking_nums = self.get_tracking_numbers_from_email(email, fields.from_email, to_email)
 
     if len(tracking_nums) == 0:
       incomplete_tracking = Tracking(None, group, order_ids, price, to_email, '', date, 0.0)
       tqdm.write(f"Could not find tracking number from email {email_id} (attempt {attempt + 1}).")
       return False, [incomplete_tracking]
 
-    # TODO: Ideally, handle this per-tracking.
-    items = self.get_items_from_email(email_str)
-
     try:
       for tracking_number, shipping_status in tracking_nums:
         # Don't output common statuses in --seen mode, as this is just noise.
@@ -220,10 +466,10 @@ class EmailTrackingRetriever(ABC):
                    f"Group: {group}, Status: {shipping_status}")
 
     merchant = self.get_merchant()
-    delivery_date = self.get_delivery_date_from_email(email_str)
     trackings = [
         Tracking(tracking_number, group, order_ids, price, to_email, '', date, 0.0, items, merchant,
-                 reconcile, delivery_date) for tracking_number, shipping_status in tracking_nums
+                 fields.reconcile, fields.delivery_date)
+        for tracking_number, shipping_status in tracking_nums
     ]
     if group is None:
       tqdm.write(f"Could not find buying group from email with order ID(s) {order_ids} "
@@ -231,26 +477,25 @@ class EmailTrackingRetriever(ABC):
       return False, trackings
     return True, trackings
 
-  def get_all_mail_folder(self) -> imaplib.IMAP4_SSL:
-    mail = email_auth.email_authentication()
-    mail.select('"[Gmail]/All Mail"')
-    return mail
-
   def get_email_ids(self) -> Any:
     date_to_search = self.get_date_to_search()
-    mail = self.get_all_mail_folder()
-    subject_searches = self.get_subject_searches()
+    subject_searches = [
+        search_planner.subject_terms(search_terms) for search_terms in self.get_subject_searches()
+    ]
 
-    result = set()
-    seen_filter = '(SEEN)' if self.args.seen else '(UNSEEN)'
-    for search_terms in subject_searches:
-      search_terms = ['(SUBJECT "%s")' % phrase for phrase in search_terms]
-      status, response = mail.uid('SEARCH', None, seen_filter, f'(SINCE "{date_to_search}")',
-                                  *search_terms)
-      email_ids = response[0].decode('utf-8')
-      result.update(email_ids.split())
+    state_filter = self.get_state_criteria()
+    # All subject searches are combined into a single search.
+    email_ids = self.backend.search(
+        subject_searches, state_filter, f'(SINCE "{date_to_search}")', sync=self.mailbox_sync)
+    return set(email_ids)
 
-    return result
+  def save_sync_state(self) -> None:
+    """
+    Called once the emails found by get_trackings have been fully processed, so that the next run
+    only needs to search new emails (plus the ones that we marked as unread).
+    """
+    if self.mailbox_sync:
+      self.mailbox_sync.save(self.pending_email_ids)
 
   def get_date_to_search(self) -> str:
     if self.args.days:
@@ -263,31 +508,3 @@ class EmailTrackingRetriever(ABC):
     string_date = date.strftime("%d-%b-%Y")
     print("Searching for emails since %s" % string_date)
     return string_date
-
-
-def get_email_content(email_id, mail) -> str:
-  result, data = mail.uid("FETCH", email_id, "(RFC822)")
-  email_str = data[0][1].decode('utf-8')
-  # sometimes it's base64 decoded and we need to handle that
-  if BASE_64_FLAG in email_str:
-    # this is messy, but so is base64 / the email format so yeah
-    # '=' is padding in base64, so just keep trying until we get a valid length
-    for i in range(4):
-      repeated_equals = '=' * i
-      try:
-        email_str = str(base64.b64decode(email_str.split(BASE_64_FLAG)[-1] + repeated_equals))
-        break
-      except:
-        # possible encoding error (not sure error type), skip
-        pass
-  return email_str
-
-
-def clean_email_content(email_str) -> str:
-  email_str = email_str.replace('=3D', '=')
-  email_str = email_str.replace('=\r\n', '')
-  email_str = email_str.replace('\r\n', '')
-  email_str = email_str.replace('&amp;', '&')
-  email_str = email_str.replace(r'\r', '')
-  email_str = email_str.replace(r'\n', '')
-  return email_str
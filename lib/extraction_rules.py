@@ -0,0 +1,97 @@
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class Rule:
+  """
+  A field that a merchant's emails are searched for: each match of the pattern is a value of the
+  field called name, taken from the given group of the match (the whole match by default).
+  """
+
+  def __init__(self, name: str, pattern: str, group: int = 0) -> None:
+    self.name = name
+    self.group = group
+    self.regex = re.compile(pattern)
+    if group > self.regex.groups:
+      raise ValueError(f"Pattern for {name} has no group {group}: {pattern}")
+
+  def __str__(self) -> str:
+    return f"Rule(name={self.name}, pattern={self.regex.pattern}, group={self.group})"
+
+  __repr__ = __str__
+
+
+class RuleSet:
+  """
+  A merchant's extraction rules, declared as data rather than as code in each extractor. A field
+  can have several rules, which are tried in the order they're declared.
+
+  The rules aren't combined into a single alternation scanned once per email: re can't use the
+  literal prefixes of the rules' patterns to skip ahead through an alternation of them, so that's
+  several times slower than scanning with each rule (see benchmarks/extraction_rules.py).
+  Instead, each rule is only run when its field is first asked for, and at most once per email.
+  """
+
+  def __init__(self, name: str, rules: Iterable[Rule]) -> None:
+    # Emails cache their matches by the rule set's name.
+    self.name = name
+    self.rules = tuple(rules)
+    self.fields: Dict[str, Tuple[Rule, ...]] = {}
+    for rule in self.rules:
+      self.fields[rule.name] = self.fields.get(rule.name, ()) + (rule,)
+
+  def scan(self, text: str) -> 'Matches':
+    return Matches(self, text)
+
+  def __str__(self) -> str:
+    return f"RuleSet(name={self.name}, rules={list(self.rules)})"
+
+  __repr__ = __str__
+
+
+class Matches:
+  """The values of a rule set's fields in a text, each found when it's first asked for."""
+
+  def __init__(self, rule_set: RuleSet, text: str) -> None:
+    self.rule_set = rule_set
+    self.text = text
+    self.all_values: Dict[str, List[str]] = {}
+    self.first_values: Dict[str, Optional[str]] = {}
+
+  def _get_rules(self, name: str) -> Tuple[Rule, ...]:
+    if name not in self.rule_set.fields:
+      raise KeyError(f"No rules for {name} in {self.rule_set.name}")
+    return self.rule_set.fields[name]
+
+  def all(self, name: str) -> List[str]:
+    """Returns all of the field's values, from its rules in the order they're declared."""
+    if name not in self.all_values:
+      self.all_values[name] = [
+          match.group(rule.group)
+          for rule in self._get_rules(name)
+          for match in rule.regex.finditer(self.text)
+      ]
+    return self.all_values[name]
+
+  def first(self, name: str) -> Optional[str]:
+    """
+    Returns the field's first value from its first rule that matches, so that later rules are
+    fallbacks for earlier ones, or None if none of them match.
+    """
+    if name in self.all_values:
+      values = self.all_values[name]
+      return values[0] if values else None
+    if name not in self.first_values:
+      self.first_values[name] = None
+      for rule in self._get_rules(name):
+        match = rule.regex.search(self.text)
+        if match:
+          self.first_values[name] = match.group(rule.group)
+          break
+    return self.first_values[name]
+
+  def __str__(self) -> str:
+    return f"Matches(rule_set={self.rule_set.name}, all={self.all_values}, " \
+           f"first={self.first_values})"
+
+  __repr__ = __str__
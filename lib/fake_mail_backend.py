@@ -0,0 +1,83 @@
+import datetime
+import email.utils
+import os
+from email.message import Message
+from email.parser import BytesHeaderParser
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from lib import search_planner
+from lib.mail_backend import MailBackend
+from lib.mailbox_sync import MailboxSync
+
+HEADER_PARSER = BytesHeaderParser()
+
+
+class FakeMailBackend(MailBackend):
+  """
+  An in-memory mailbox, for trying out changes and benchmarking without a real mail account.
+  Searches are evaluated locally with the same substring matching that we use for headers.
+  """
+
+  def __init__(self, raw_emails: Dict[str, bytes]) -> None:
+    self.raw_emails = raw_emails
+    self.headers: Dict[str, Message] = {
+        email_id: HEADER_PARSER.parsebytes(raw_email) for email_id, raw_email in raw_emails.items()
+    }
+    self.seen_ids: Set[str] = set()
+    # label -> IDs of the emails with that label
+    self.labels: Dict[str, Set[str]] = {}
+
+  @classmethod
+  def from_folder(cls, folder: str) -> 'FakeMailBackend':
+    """Loads every .eml file in the folder, numbering them in filename order."""
+    raw_emails = {}
+    filenames = sorted(f for f in os.listdir(folder) if f.endswith('.eml'))
+    for i, filename in enumerate(filenames):
+      with open(os.path.join(folder, filename), 'rb') as stream:
+        raw_emails[str(i + 1)] = stream.read()
+    return cls(raw_emails)
+
+  def search(self,
+             term_lists: Sequence[search_planner.SearchTerms],
+             *criteria: str,
+             sync: Optional[MailboxSync] = None) -> List[str]:
+    parsed_criteria = [search_planner.parse_criteria(criterion) for criterion in criteria]
+    return [
+        email_id for email_id, headers in self.headers.items() if all(
+            self._matches(email_id, headers, *criterion) for criterion in parsed_criteria) and any(
+                search_planner.matches(headers, terms) for terms in term_lists)
+    ]
+
+  def _matches(self, email_id: str, headers: Message, negated: bool, key: str,
+               argument: Optional[str]) -> bool:
+    if key in ('SEEN', 'UNSEEN'):
+      result = (email_id in self.seen_ids) == (key == 'SEEN')
+    elif key == 'SINCE':
+      since = datetime.datetime.strptime(argument, '%d-%b-%Y').date()
+      date = email.utils.parsedate_to_datetime(headers['Date']) if headers['Date'] else None
+      result = date is None or date.date() >= since
+    elif key == 'X-GM-LABELS':
+      result = email_id in self.labels.get(argument, set())
+    else:
+      result = search_planner.matches(headers, [(key, argument or '')])
+    return result != negated
+
+  def fetch(self, email_ids: Iterable[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+    for email_id in email_ids:
+      self.seen_ids.add(email_id)
+      yield email_id, self.raw_emails.get(email_id)
+
+  def marks_seen(self) -> bool:
+    return True
+
+  def set_seen(self, email_ids: Iterable[str], seen: bool) -> None:
+    if seen:
+      self.seen_ids.update(email_ids)
+    else:
+      self.seen_ids.difference_update(email_ids)
+
+  def set_label(self, email_ids: Iterable[str], label: str, present: bool) -> None:
+    if present:
+      self.labels.setdefault(label, set()).update(email_ids)
+    else:
+      self.labels.get(label, set()).difference_update(email_ids)
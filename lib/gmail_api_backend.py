@@ -0,0 +1,180 @@
+import base64
+import datetime
+from email.message import Message
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from tqdm import tqdm
+
+import lib.email_auth as email_auth
+from lib import search_planner, util
+from lib.email_cache import get_email_cache
+from lib.mail_backend import MailBackend
+from lib.mailbox_sync import MailboxSync
+
+# The Gmail API accepts at most 100 requests per batch and 1000 IDs per batchModify.
+MAX_FETCH_BATCH_SIZE = 100
+MAX_MODIFY_BATCH_SIZE = 1000
+# Message IDs never change, so each account's emails share one cache namespace.
+CACHE_MAILBOX = 'gmail-api'
+CACHE_UIDVALIDITY = '0'
+FETCH_ERRORS = (HttpError, *email_auth.CONNECTION_ERRORS)
+
+
+def to_gmail_query(term_lists: Sequence[search_planner.SearchTerms],
+                   criteria: Iterable[str]) -> str:
+  """Translates the IMAP search keys and term lists that we search with into a Gmail query."""
+  parts = []
+  for criterion in criteria:
+    negated, key, argument = search_planner.parse_criteria(criterion)
+    if key in ('SEEN', 'UNSEEN'):
+      part = 'is:read' if key == 'SEEN' else 'is:unread'
+    elif key == 'SINCE':
+      date = datetime.datetime.strptime(argument, '%d-%b-%Y')
+      part = f'after:{date.strftime("%Y/%m/%d")}'
+    elif key == 'X-GM-LABELS':
+      part = f'label:{search_planner.quote(argument)}'
+    elif key in ('SUBJECT', 'FROM', 'TO'):
+      part = f'{key.lower()}:{search_planner.quote(argument)}'
+    else:
+      raise Exception(f"Can't translate IMAP search criteria {criterion} into a Gmail query")
+    parts.append(f'-{part}' if negated else part)
+
+  alternatives = [
+      '(' + ' '.join(f'{field.lower()}:{search_planner.quote(phrase)}'
+                     for field, phrase in terms) + ')'
+      for terms in term_lists
+  ]
+  if alternatives:
+    parts.append('(' + ' OR '.join(alternatives) + ')')
+  return ' '.join(parts)
+
+
+class GmailApiBackend(MailBackend):
+  """
+  Talks to Gmail over its HTTP API, which fetches up to 100 raw emails per batch request. Uses the
+  account's OAuth credentials. Email IDs are Gmail message IDs rather than IMAP UIDs, so searches
+  can't be incremental.
+
+  Searches don't find quite the same emails as IMAP's: Gmail matches a query's phrases as whole
+  words, ignoring punctuation, where IMAP SEARCH matches substrings. Emails that Gmail finds are
+  checked against the terms locally, the way the other backends match them, so no extra emails
+  are found; but emails whose terms are only part of longer words aren't found at all.
+  """
+
+  def __init__(self, config, account: Optional[Dict[str, Any]] = None) -> None:
+    self.service = build('gmail', 'v1', credentials=email_auth.get_oauth_credentials(account))
+    self.cache = get_email_cache(config)
+    self.cache_mailbox = email_auth.qualify(CACHE_MAILBOX, account)
+    # label name -> label ID
+    self.label_ids: Dict[str, str] = {}
+
+  def search(self,
+             term_lists: Sequence[search_planner.SearchTerms],
+             *criteria: str,
+             sync: Optional[MailboxSync] = None) -> List[str]:
+    messages = self.service.users().messages()
+    request = messages.list(userId='me', q=to_gmail_query(term_lists, criteria), maxResults=500)
+    email_ids = []
+    while request is not None:
+      response = request.execute()
+      email_ids.extend(message['id'] for message in response.get('messages', []))
+      request = messages.list_next(request, response)
+    if not term_lists:
+      return email_ids
+    return self._filter_by_terms(email_ids, term_lists)
+
+  def _filter_by_terms(self, email_ids: List[str],
+                       term_lists: Sequence[search_planner.SearchTerms]) -> List[str]:
+    """Returns the emails whose headers match any of the term lists, keeping the given order."""
+    fields = sorted({field.capitalize() for terms in term_lists for field, _ in terms})
+    headers: Dict[str, Message] = {}
+
+    def on_response(email_id, response, exception):
+      if exception:
+        tqdm.write(f"Couldn't fetch the headers of email {email_id}: "
+                   f"{exception.__class__.__name__}: {str(exception)}")
+        return
+      message = Message()
+      for header in response['payload'].get('headers', []):
+        message[header['name']] = header['value']
+      headers[email_id] = message
+
+    for batch_ids in util.chunks(email_ids, MAX_FETCH_BATCH_SIZE):
+      batch = self.service.new_batch_http_request(callback=on_response)
+      for email_id in batch_ids:
+        batch.add(
+            self.service.users().messages().get(
+                userId='me', id=email_id, format='metadata', metadataHeaders=fields),
+            request_id=email_id)
+      batch.execute()
+    # Emails whose headers couldn't be fetched are kept, rather than risk missing them.
+    return [
+        email_id for email_id in email_ids if email_id not in headers or any(
+            search_planner.matches(headers[email_id], terms) for terms in term_lists)
+    ]
+
+  def fetch(self, email_ids: Iterable[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+    for batch in util.chunks(list(email_ids), MAX_FETCH_BATCH_SIZE):
+      try:
+        raw_emails = self._fetch_batch(batch)
+      except FETCH_ERRORS as e:
+        tqdm.write(f"Couldn't fetch emails {batch}: {e.__class__.__name__}: {str(e)}")
+        raw_emails = {}
+      for email_id in batch:
+        yield email_id, raw_emails.get(email_id)
+
+  def _fetch_batch(self, email_ids: List[str]) -> Dict[str, bytes]:
+    result = {}
+    for email_id in email_ids:
+      raw_email = self.cache.get((self.cache_mailbox, CACHE_UIDVALIDITY, email_id, 'RAW'))
+      if raw_email is not None:
+        result[email_id] = raw_email
+    missing_ids = [email_id for email_id in email_ids if email_id not in result]
+    if not missing_ids:
+      return result
+
+    def on_response(email_id, response, exception):
+      if exception:
+        tqdm.write(f"Couldn't fetch email {email_id}: {exception.__class__.__name__}: "
+                   f"{str(exception)}")
+        return
+      raw_email = base64.urlsafe_b64decode(response['raw'])
+      self.cache.put((self.cache_mailbox, CACHE_UIDVALIDITY, email_id, 'RAW'), raw_email)
+      result[email_id] = raw_email
+
+    batch = self.service.new_batch_http_request(callback=on_response)
+    for email_id in missing_ids:
+      batch.add(
+          self.service.users().messages().get(userId='me', id=email_id, format='raw'),
+          request_id=email_id)
+    batch.execute()
+    return result
+
+  def marks_seen(self) -> bool:
+    return False
+
+  def set_seen(self, email_ids: Iterable[str], seen: bool) -> None:
+    # Read state is the UNREAD system label.
+    self._modify(email_ids, 'UNREAD', not seen)
+
+  def set_label(self, email_ids: Iterable[str], label: str, present: bool) -> None:
+    label_id = self._get_label_id(label, create=present)
+    if label_id:
+      self._modify(email_ids, label_id, present)
+
+  def _modify(self, email_ids: Iterable[str], label_id: str, present: bool) -> None:
+    for batch in util.chunks(list(email_ids), MAX_MODIFY_BATCH_SIZE):
+      body = {'ids': batch, 'addLabelIds' if present else 'removeLabelIds': [label_id]}
+      self.service.users().messages().batchModify(userId='me', body=body).execute()
+
+  def _get_label_id(self, name: str, create: bool) -> Optional[str]:
+    if name not in self.label_ids:
+      response = self.service.users().labels().list(userId='me').execute()
+      for label in response.get('labels', []):
+        self.label_ids[label['name']] = label['id']
+    if name not in self.label_ids and create:
+      label = self.service.users().labels().create(userId='me', body={'name': name}).execute()
+      self.label_ids[name] = label['id']
+    return self.label_ids.get(name)
@@ -0,0 +1,34 @@
+from typing import Optional
+
+from lib import search_planner
+
+
+class ProcessedLabels:
+  """
+  Gmail labels that record which emails have been processed (and which couldn't be), as an
+  alternative to tracking that with their read state. Emails are then fetched without being marked
+  as read, and searches exclude processed emails on the server with X-GM-LABELS, so reading our own
+  emails doesn't affect what gets processed.
+  """
+
+  def __init__(self, processed: str, failed: str) -> None:
+    self.processed = processed
+    self.failed = failed
+
+  def get_search_criteria(self, processed: bool = False) -> str:
+    """Returns an IMAP search key that matches emails that are (or aren't) labeled as processed."""
+    criteria = f'X-GM-LABELS {search_planner.quote(self.processed)}'
+    return f'({criteria})' if processed else f'(NOT {criteria})'
+
+  def __str__(self) -> str:
+    return f'{{processed: {self.processed}, failed: {self.failed}}}'
+
+  __repr__ = __str__
+
+
+def get_processed_labels(config) -> Optional[ProcessedLabels]:
+  """Returns the labels configured with emailProcessedLabel, or None to use read state instead."""
+  processed = config.get('emailProcessedLabel')
+  if not processed:
+    return None
+  return ProcessedLabels(processed, config.get('emailFailedLabel', f'{processed}/Failed'))
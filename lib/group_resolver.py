@@ -0,0 +1,84 @@
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+GroupResult = Tuple[Optional[str], bool]
+# With fewer terms than this, searching for each one is faster than a pass of the automaton, which
+# costs about as much as searching for 20 terms.
+AUTOMATON_MIN_TERMS = 20
+
+
+def _build_automaton(terms: Set[str]):
+  """
+  Returns an Aho-Corasick automaton that finds all of the terms in a single pass, or None if
+  there are too few terms for it to be worthwhile or pyahocorasick isn't installed.
+  """
+  if len(terms) < AUTOMATON_MIN_TERMS:
+    return None
+  try:
+    import ahocorasick
+  except ImportError:
+    return None
+  automaton = ahocorasick.Automaton()
+  for term in terms:
+    automaton.add_word(term, term)
+  automaton.make_automaton()
+  return automaton
+
+
+class GroupResolver:
+  """
+  Finds the buying group that an email or a shipping address belongs to, from the groups' keys and
+  optional "except" terms in the config. Groups are tried in config order: the first one with a
+  key in the text and none of its except terms wins. Matching is case-insensitive.
+
+  The terms are upper-cased once, up front, and if there are many of them and pyahocorasick is
+  installed, all of them are found with a single pass over the text instead of a substring search
+  per term.
+  """
+
+  def __init__(self, groups_config: Dict[str, Any]) -> None:
+    self.groups_config = groups_config
+    # (group, reconcile, keys, except terms) tuples, in config order
+    self.groups: List[Tuple[str, bool, List[str], List[str]]] = []
+    for group, group_conf in groups_config.items():
+      group_keys = group_conf['keys']
+      if isinstance(group_keys, str):
+        group_keys = [group_keys]
+      reconcile = bool(group_conf['reconcile']) if 'reconcile' in group_conf else True
+      self.groups.append((group, reconcile, [str(key).upper() for key in group_keys],
+                          [str(term).upper() for term in group_conf.get('except', [])]))
+    self.automaton = _build_automaton(
+        {term for _, _, keys, except_terms in self.groups for term in keys + except_terms})
+    # Addresses repeat across a report's rows, so their groups are only looked up once.
+    self.address_groups: Dict[str, GroupResult] = {}
+
+  def __reduce__(self):
+    # Parsing processes rebuild the automaton rather than unpickling it.
+    return GroupResolver, (self.groups_config,)
+
+  def get_group(self, text: str) -> GroupResult:
+    """
+    Returns the text's group (or None) and whether that group's orders should be reconciled.
+    """
+    text = text.upper()
+    if self.automaton is not None:
+      found_terms = {term for _, term in self.automaton.iter(text)}
+      contains: Callable[[str], bool] = found_terms.__contains__
+    else:
+      contains = text.__contains__
+
+    for group, reconcile, keys, except_terms in self.groups:
+      # An except term indicates that the text isn't for this group, which is useful when two
+      # groups share the same address.
+      if any(contains(term) for term in except_terms):
+        continue
+      if any(contains(key) for key in keys):
+        return group, reconcile
+    return None, True
+
+  def get_address_group(self, address: str) -> GroupResult:
+    """Like get_group, but memoized, for short texts that are looked up repeatedly."""
+    result = self.address_groups.get(address)
+    if result is None:
+      result = self.get_group(address)
+      self.address_groups[address] = result
+    return result
@@ -8,12 +8,10 @@ import re
 import sys
 import time
 import traceback
-from imaplib import IMAP4_SSL
 from typing import Any, Tuple, Dict, List, Iterable
 
 import aiohttp
 import requests
-from bs4 import BeautifulSoup, Tag
 from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver import ActionChains
 from selenium.webdriver.chrome.webdriver import WebDriver
@@ -22,8 +20,13 @@ from selenium.webdriver.support.ui import Select
 from tqdm import tqdm
 
 import lib.email_auth as email_auth
-from lib import util, email_tracking_retriever
+from lib import util
 from lib.archive_manager import ArchiveManager
+from lib.email_fetcher import EmailFetcher
+from lib.html_dom import HTML_PARSER, HtmlNode
+from lib.mailbox_sync import MailboxSync
+from lib.object_retriever import ObjectRetriever
+from lib.parsed_email import parse_email
 from lib.tracking import Tracking
 
 LOGIN_EMAIL_FIELD = "fldEmail"
@@ -57,6 +60,8 @@ YRCW_CSV_URL = "https://csv.yrcwtech.com/"
 
 MAX_UPLOAD_ATTEMPTS = 10
 
+BFMR_COSTS_FILENAME = "bfmr_costs.pickle"
+
 TrackingInfo = Tuple[str, float, str]
 TrackingTuple = Tuple[str]
 TrackingInfoDict = Dict[TrackingTuple, TrackingInfo]
@@ -65,7 +70,7 @@ PoCostDict = Dict[str, float]
 ReconResult = Tuple[TrackingInfoDict, PoCostDict]
 
 
-def fill_busted_bfmr_costs(result: TrackingInfoDict, table: Tag, date: str):
+def fill_busted_bfmr_costs(result: TrackingInfoDict, table: HtmlNode, date: str):
   trs = table.find_all('tr')
   # busted-ass html doesn't close the <tr> tags until the end
   tds = trs[1].find_all('td')
@@ -73,21 +78,21 @@ def fill_busted_bfmr_costs(result: TrackingInfoDict, table: Tag, date: str):
   tds = tds[:-2]
 
   for i in range(len(tds) // 5):
-    tracking = tds[i * 5].getText().upper().strip()
-    total_text = tds[i * 5 + 4].getText()
+    tracking = tds[i * 5].text.upper().strip()
+    total_text = tds[i * 5 + 4].text
     total = float(total_text.replace(',', '').replace('$', ''))
     previous_total = result[(tracking,)][1] if (tracking,) in result else 0.0
     result[(tracking,)] = ('bfmr', previous_total + total, date)
 
 
-def fill_standard_bfmr_costs(result: TrackingInfoDict, table: Tag, date: str):
+def fill_standard_bfmr_costs(result: TrackingInfoDict, table: HtmlNode, date: str):
   rows = table.find_all('tr')[1:]  # skip the header
   for row in rows:
     tds = row.find_all('td')
     if len(tds) != 5:
       continue
-    tracking = tds[0].getText().upper().strip()
-    total = float(tds[4].getText().strip().replace(',', '').replace('$', ''))
+    tracking = tds[0].text.upper().strip()
+    total = float(tds[4].text.strip().replace(',', '').replace('$', ''))
     previous_total = result[(tracking,)][1] if (tracking,) in result else 0.0
     result[(tracking,)] = ('bfmr', previous_total + total, date)
 
@@ -98,7 +103,7 @@ def add_bfmr_cost_if_nonempty(result: TrackingInfoDict, tracking: str, cost: flo
     result[(tracking,)] = ('bfmr', previous_total + cost, date)
 
 
-def fill_2020_12_22_bfmr_costs(result: TrackingInfoDict, table: Tag, date: str):
+def fill_2020_12_22_bfmr_costs(result: TrackingInfoDict, table: HtmlNode, date: str):
   rows = table.find_all('tr')[1:]
   tracking = rows[0].text.strip()
   if '$' in tracking:  # old format, we can quit
@@ -118,6 +123,29 @@ def fill_2020_12_22_bfmr_costs(result: TrackingInfoDict, table: Tag, date: str):
   add_bfmr_cost_if_nonempty(result, tracking, cost_for_tracking, date)
 
 
+def get_bfmr_costs_from_email(raw_email: bytes) -> TrackingInfoDict:
+  result: TrackingInfoDict = {}
+  # The busted format relies on how html.parser nests unclosed <tr>s, which other parsers close.
+  parsed_email = parse_email(raw_email, HTML_PARSER)
+  msg = parsed_email.message
+  date = datetime.datetime.strptime(
+      msg['Date'], '%a, %d %b %Y %H:%M:%S %z').strftime('%Y-%m-%d') if msg['Date'] else ''
+  try:
+    body = parsed_email.dom.find(id='email_body')
+    if not body:
+      return result
+    tables = body.find_all('table')
+    if not tables or len(tables) < 2:
+      return result
+    table = tables[1]
+    fill_busted_bfmr_costs(result, table, date)
+    fill_standard_bfmr_costs(result, table, date)
+    fill_2020_12_22_bfmr_costs(result, table, date)
+  except:
+    tqdm.write(f"Error checking BFMR email with date {date}, ignoring...")
+  return result
+
+
 def clean_csv_tracking(tracking: str) -> str:
   return re.sub(r'[^0-9A-Z,]', '', tracking.upper())
 
@@ -701,11 +729,11 @@ class GroupSiteManager:
       print("Fetching 2FA code from email ...")
 
       # get the email client and search for the code
-      mail = self._get_all_mail_folder()
-      _, email_ids = mail.uid('SEARCH', None, '(SUBJECT "Passcode for")')
-      last_id = email_ids[0].split()[-1]
-      _, data = mail.uid("FETCH", last_id, "(RFC822)")
-      msg = email.message_from_string(str(data[0][1], 'utf-8'))
+      _, email_ids = email_auth.run_in_all_mail(
+          lambda mail: mail.uid('SEARCH', None, '(SUBJECT "Passcode for")'))
+      last_id = email_ids[0].decode('utf-8').split()[-1]
+      raw_email = EmailFetcher(self.config).fetch_batch([last_id])[last_id]
+      msg = email.message_from_string(str(raw_email, 'utf-8'))
       subject = msg['Subject']
       pattern = r'Passcode for .*(\d{3}-\d{3})'
       code = re.match(pattern, subject).group(1).replace('-', '')
@@ -731,38 +759,36 @@ class GroupSiteManager:
     time.sleep(2)
     return driver
 
-  def _get_all_mail_folder(self) -> IMAP4_SSL:
-    mail = email_auth.email_authentication()
-    mail.select('"[Gmail]/All Mail"')
-    return mail
-
   def _get_bfmr_costs(self) -> TrackingInfoDict:
-    mail = self._get_all_mail_folder()
-    status, response = mail.uid('SEARCH', None, 'SUBJECT "Payment Sent"', 'SINCE "01-Aug-2019"',
-                                'FROM "*@buyformeretail.com"')
-    email_ids = response[0].decode('utf-8').split()
+    # Each email's costs are stored, so that we only need to fetch and parse new emails.
+    object_retriever = ObjectRetriever(self.config)
+    # map of {email_id: TrackingInfoDict}
+    email_id_dict: Dict[str, TrackingInfoDict] = object_retriever.load(BFMR_COSTS_FILENAME)
+    mailbox_sync = MailboxSync(self.config, "BFMR check-in emails")
+    email_ids = email_auth.run_in_all_mail(
+        lambda mail: mailbox_sync.search(mail, [[('SUBJECT', 'Payment Sent')]],
+                                         'SINCE "01-Aug-2019"', 'FROM "*@buyformeretail.com"'))
+    new_email_ids = [email_id for email_id in email_ids if email_id not in email_id_dict]
+
+    fetcher = EmailFetcher(self.config)
+    for email_id, raw_email in tqdm(
+        fetcher.fetch(new_email_ids),
+        total=len(new_email_ids),
+        desc='Fetching BFMR check-ins',
+        unit='email'):
+      if raw_email is None:
+        tqdm.write(f"Could not fetch BFMR email with ID {email_id}, ignoring...")
+        continue
+      email_id_dict[email_id] = get_bfmr_costs_from_email(raw_email)
+
+    if new_email_ids:
+      object_retriever.flush(email_id_dict, BFMR_COSTS_FILENAME)
+    mailbox_sync.save([email_id for email_id in email_ids if email_id not in email_id_dict])
+
+    # Merge the emails' costs in the order that they arrived.
     result: TrackingInfoDict = {}
-
-    for email_id in tqdm(email_ids, desc='Fetching BFMR check-ins', unit='email'):
-      email_str = email_tracking_retriever.get_email_content(email_id, mail)
-      msg = email.message_from_string(email_str)
-      date = datetime.datetime.strptime(
-          msg['Date'], '%a, %d %b %Y %H:%M:%S %z').strftime('%Y-%m-%d') if msg['Date'] else ''
-      try:
-        email_str = email_tracking_retriever.clean_email_content(email_str)
-        soup = BeautifulSoup(email_str, features="html.parser")
-
-        body = soup.find(id='email_body')
-        if not body:
-          continue
-        tables = body.find_all('table')
-        if not tables or len(tables) < 2:
-          continue
-        table = tables[1]
-        fill_busted_bfmr_costs(result, table, date)
-        fill_standard_bfmr_costs(result, table, date)
-        fill_2020_12_22_bfmr_costs(result, table, date)
-      except:
-        tqdm.write(f"Error checking BFMR email with date {date}, ignoring...")
-
+    for email_id in mailbox_sync.get_all_matched_ids():
+      for tracking_tuple, (_, cost, date) in email_id_dict.get(email_id, {}).items():
+        previous_total = result[tracking_tuple][1] if tracking_tuple in result else 0.0
+        result[tracking_tuple] = ('bfmr', previous_total + cost, date)
     return result
@@ -0,0 +1,234 @@
+import functools
+import re
+from abc import ABC, abstractmethod
+from typing import List, Optional, Sequence
+
+from bs4 import BeautifulSoup
+
+# The parsers that we know how to use, fastest first.
+SELECTOLAX = 'selectolax'
+LXML = 'lxml'
+HTML_PARSER = 'html.parser'
+PARSERS = (SELECTOLAX, LXML, HTML_PARSER)
+
+# Fragments longer than this aren't cut, as they'd save little parsing.
+MAX_FRAGMENT_LENGTH = 64 * 1024
+
+
+class HtmlNode(ABC):
+  """
+  The small subset of the BeautifulSoup API that our email parsers use, so that they can run on
+  whichever HTML parser is installed. Matching follows BeautifulSoup: class_ matches any one of
+  an element's classes, and text matches elements whose entire text is exactly that string.
+  """
+
+  @abstractmethod
+  def find(self,
+           tag: Optional[str] = None,
+           id: Optional[str] = None,
+           class_: Optional[str] = None,
+           text: Optional[str] = None) -> Optional['HtmlNode']:
+    """Returns the first matching descendant, or None if there isn't one."""
+    pass
+
+  @abstractmethod
+  def find_all(self,
+               tag: Optional[str] = None,
+               id: Optional[str] = None,
+               class_: Optional[str] = None,
+               text: Optional[str] = None) -> List['HtmlNode']:
+    """Returns the matching descendants in document order."""
+    pass
+
+  @property
+  @abstractmethod
+  def text(self) -> str:
+    """The text of the node and all of its descendants."""
+    pass
+
+  @property
+  @abstractmethod
+  def parent(self) -> Optional['HtmlNode']:
+    pass
+
+
+class SoupNode(HtmlNode):
+  """A node parsed by BeautifulSoup, with either the lxml or the pure-Python tree builder."""
+
+  def __init__(self, tag) -> None:
+    self.tag = tag
+
+  @staticmethod
+  def _filters(id: Optional[str], class_: Optional[str], text: Optional[str]):
+    filters = {}
+    if id is not None:
+      filters['id'] = id
+    if class_ is not None:
+      filters['class_'] = class_
+    if text is not None:
+      filters['string'] = text
+    return filters
+
+  def find(self, tag=None, id=None, class_=None, text=None) -> Optional[HtmlNode]:
+    result = self.tag.find(tag, **self._filters(id, class_, text))
+    return SoupNode(result) if result is not None else None
+
+  def find_all(self, tag=None, id=None, class_=None, text=None) -> List[HtmlNode]:
+    results = self.tag.find_all(tag, **self._filters(id, class_, text))
+    return [SoupNode(result) for result in results]
+
+  @property
+  def text(self) -> str:
+    return self.tag.get_text()
+
+  @property
+  def parent(self) -> Optional[HtmlNode]:
+    return SoupNode(self.tag.parent) if self.tag.parent is not None else None
+
+
+class SelectolaxNode(HtmlNode):
+  """
+  A node parsed by selectolax's Lexbor backend, whose C parser builds the whole tree several
+  times faster than BeautifulSoup. Queries are translated into CSS selectors.
+  """
+
+  def __init__(self, node) -> None:
+    self.node = node
+
+  @staticmethod
+  def _selector(tag: Optional[str], id: Optional[str], class_: Optional[str]) -> str:
+    selector = tag or '*'
+    if id is not None:
+      selector += f'[id="{id}"]'
+    if class_ is not None:
+      selector += f'[class~="{class_}"]'
+    return selector
+
+  def find(self, tag=None, id=None, class_=None, text=None) -> Optional[HtmlNode]:
+    if text is None:
+      result = self.node.css_first(self._selector(tag, id, class_))
+      return SelectolaxNode(result) if result is not None else None
+    results = self.find_all(tag, id, class_, text)
+    return results[0] if results else None
+
+  def find_all(self, tag=None, id=None, class_=None, text=None) -> List[HtmlNode]:
+    return [
+        SelectolaxNode(result)
+        for result in self.node.css(self._selector(tag, id, class_))
+        if text is None or result.text(deep=True) == text
+    ]
+
+  @property
+  def text(self) -> str:
+    return self.node.text(deep=True)
+
+  @property
+  def parent(self) -> Optional[HtmlNode]:
+    return SelectolaxNode(self.node.parent) if self.node.parent is not None else None
+
+
+def _get_default_parser() -> str:
+  try:
+    import selectolax.lexbor
+    return SELECTOLAX
+  except ImportError:
+    pass
+  try:
+    import lxml
+    return LXML
+  except ImportError:
+    return HTML_PARSER
+
+
+# The fastest parser that's installed; html.parser is always available.
+DEFAULT_PARSER = _get_default_parser()
+
+
+def parse_html(content: str, parser: Optional[str] = None) -> HtmlNode:
+  """
+  Parses the HTML with the given parser, or the fastest installed one if none is given. Parsers
+  can disagree about malformed HTML, so code that relies on how html.parser recovers from it (e.g.
+  from unclosed tags) should ask for html.parser explicitly.
+  """
+  parser = parser or DEFAULT_PARSER
+  if parser == SELECTOLAX:
+    from selectolax.lexbor import LexborHTMLParser
+    return SelectolaxNode(LexborHTMLParser(content).root)
+  if parser in (LXML, HTML_PARSER):
+    return SoupNode(BeautifulSoup(content, features=parser))
+  raise Exception(f"Unknown HTML parser {parser}; expected one of {', '.join(PARSERS)}")
+
+
+TAG_NAME_REGEX = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)')
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tag_regex(tag: str):
+  """Matches the start of the tag's start and end tags, with the slash captured for end tags."""
+  return re.compile(f'<(/?){re.escape(tag)}[\\s>/]', re.IGNORECASE)
+
+
+class Anchor:
+  """
+  Marks the part of an email's HTML that an extractor needs, so that only that fragment has to be
+  parsed. With levels=0, that's the element (of the given tag, or any) whose start tag contains
+  the text, e.g. a class name. Otherwise, it's the levels'th element of the given tag that encloses
+  the text, e.g. the table around a heading.
+  """
+
+  def __init__(self, text: str, tag: Optional[str] = None, levels: int = 0) -> None:
+    if levels > 0 and tag is None:
+      raise Exception(f"Anchor {text} needs a tag to find the elements that enclose it")
+    self.text = text
+    self.tag = tag
+    self.levels = levels
+
+  def __str__(self) -> str:
+    return f'{{text: {self.text}, tag: {self.tag}, levels: {self.levels}}}'
+
+  __repr__ = __str__
+
+  def cut(self, content: str, index: int) -> Optional[str]:
+    """
+    Returns the HTML of the anchored element around the text at the index, or None if the element
+    can't be found within MAX_FRAGMENT_LENGTH of it.
+    """
+    tag, levels = self.tag, self.levels
+    if levels == 0:
+      tag_start = content.rfind('<', 0, index)
+      if tag_start < 0 or '>' in content[tag_start:index]:
+        return None  # not in a start tag
+      tag_match = TAG_NAME_REGEX.match(content, tag_start)
+      if not tag_match or (tag is not None and tag_match.group(1).lower() != tag):
+        return None
+      tag, levels = tag_match.group(1), 1
+
+    # Elements opened before the text and not closed by then enclose it; the innermost is last.
+    tag_regex = _get_tag_regex(tag.lower())
+    open_starts = []
+    for match in tag_regex.finditer(content, max(0, index - MAX_FRAGMENT_LENGTH), index):
+      if not match.group(1):
+        open_starts.append(match.start())
+      elif open_starts:
+        open_starts.pop()
+    if len(open_starts) < levels:
+      return None
+    start = open_starts[-levels]
+    depth = levels
+    for match in tag_regex.finditer(content, index, start + MAX_FRAGMENT_LENGTH):
+      depth += -1 if match.group(1) else 1
+      if depth == 0:
+        return content[start:content.find('>', match.end() - 1) + 1]
+    return None
+
+
+def cut_fragment(content: str, anchors: Sequence[Anchor]) -> Optional[str]:
+  """
+  Returns the fragment marked by the first of the anchors whose text is in the content, or None if
+  none of them are, or that anchor's element can't be cut out (e.g. it's too long).
+  """
+  for anchor in anchors:
+    index = content.find(anchor.text)
+    if index >= 0:
+      return anchor.cut(content, index)
+  return None
@@ -0,0 +1,99 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import lib.email_auth as email_auth
+from lib import search_planner
+from lib.email_fetcher import EmailFetcher, to_uid_sets
+from lib.mailbox_sync import MailboxSync
+
+
+class MailBackend(ABC):
+  """
+  The mailbox operations that the tracking retrievers need: searching, fetching raw emails and
+  changing their read state and labels. Searches are expressed as IMAP search keys, which
+  non-IMAP backends translate.
+  """
+
+  @abstractmethod
+  def search(self,
+             term_lists: Sequence[search_planner.SearchTerms],
+             *criteria: str,
+             sync: Optional[MailboxSync] = None) -> List[str]:
+    """
+    Returns the IDs of emails matching all of the criteria and any of the term lists. Backends
+    that support it only search what has changed since the given sync's saved state.
+    """
+    pass
+
+  @abstractmethod
+  def fetch(self, email_ids: Iterable[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """
+    Lazily yields an (ID, raw email) tuple for each of the given IDs, with None as the raw email
+    if it couldn't be fetched.
+    """
+    pass
+
+  @abstractmethod
+  def marks_seen(self) -> bool:
+    """Whether fetching an email marks it as read."""
+    pass
+
+  @abstractmethod
+  def set_seen(self, email_ids: Iterable[str], seen: bool) -> None:
+    pass
+
+  @abstractmethod
+  def set_label(self, email_ids: Iterable[str], label: str, present: bool) -> None:
+    pass
+
+
+class ImapBackend(MailBackend):
+  """Talks to Gmail over IMAP, using the account's session pool and the batched email fetcher."""
+
+  def __init__(self, config, account: Optional[Dict[str, Any]] = None) -> None:
+    self.fetcher = EmailFetcher(config, account)
+    self.pool = email_auth.get_session_pool(account)
+
+  def search(self,
+             term_lists: Sequence[search_planner.SearchTerms],
+             *criteria: str,
+             sync: Optional[MailboxSync] = None) -> List[str]:
+    if sync:
+      return self.pool.run(lambda mail: sync.search(mail, term_lists, *criteria))
+    return self.pool.run(lambda mail: search_planner.search(mail, term_lists, *criteria))
+
+  def fetch(self, email_ids: Iterable[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+    return self.fetcher.fetch(email_ids)
+
+  def marks_seen(self) -> bool:
+    return self.fetcher.marks_seen()
+
+  def set_seen(self, email_ids: Iterable[str], seen: bool) -> None:
+    self._store(email_ids, '+FLAGS' if seen else '-FLAGS', '(\\Seen)')
+
+  def set_label(self, email_ids: Iterable[str], label: str, present: bool) -> None:
+    self._store(email_ids, '+X-GM-LABELS' if present else '-X-GM-LABELS',
+                f'({search_planner.quote(label)})')
+
+  def _store(self, email_ids: Iterable[str], command: str, value: str) -> None:
+    """Runs a UID STORE command on all of the given emails, using as few commands as possible."""
+    for uid_set in to_uid_sets(email_ids):
+      self.pool.run(lambda mail: mail.uid('STORE', uid_set, command, value))
+
+
+def get_mail_backend(config, account: Optional[Dict[str, Any]] = None) -> MailBackend:
+  """
+  Returns the backend configured with mailBackend: "imap" (the default), "gmail-api", or "fake",
+  which reads .eml files from the fakeMailFolder folder instead of a real mailbox. Real backends
+  use the given account, or the primary account if none is given.
+  """
+  backend = config.get('mailBackend', 'imap')
+  if backend == 'imap':
+    return ImapBackend(config, account)
+  if backend == 'gmail-api':
+    from lib.gmail_api_backend import GmailApiBackend
+    return GmailApiBackend(config, account)
+  if backend == 'fake':
+    from lib.fake_mail_backend import FakeMailBackend
+    return FakeMailBackend.from_folder(config['fakeMailFolder'])
+  raise Exception(f"Unknown mail backend {backend}; expected imap, gmail-api or fake")
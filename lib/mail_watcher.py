@@ -0,0 +1,101 @@
+import re
+import time
+from imaplib import IMAP4
+from typing import Any, Dict, Optional
+
+import lib.email_auth as email_auth
+
+EXISTS_REGEX = re.compile(rb'^\* \d+ EXISTS')
+# Servers may drop IDLE connections after 30 minutes (RFC 2177), so IDLE is restarted before then.
+IDLE_RESTART_SECONDS = 25 * 60
+# How often we check for new mail if the server doesn't support IDLE.
+POLL_INTERVAL_SECONDS = 30
+RECONNECT_DELAY_SECONDS = 10
+
+
+class MailWatcher:
+  """
+  Waits for new emails in All Mail using IMAP IDLE (or NOOP polling if the server doesn't support
+  it). The watcher uses its own connection, since a connection can't be used for anything else
+  while it's idling. Watches the given account, or the primary account if none is given.
+  """
+
+  def __init__(self, account: Optional[Dict[str, Any]] = None) -> None:
+    self.account = account
+    self.mail: Optional[email_auth.ImapConnection] = None
+
+  def wait_for_new_mail(self) -> None:
+    """
+    Blocks until at least one new email has arrived. If the connection is lost, this returns after
+    a short delay, since emails may have arrived while we were disconnected.
+    """
+    while True:
+      try:
+        if self.mail is None:
+          self.mail = email_auth.all_mail_authentication(self.account)
+          # Discard the message count reported when selecting the folder.
+          self.mail.response('EXISTS')
+        if 'IDLE' in self.mail.capabilities:
+          has_new_mail = self._idle(IDLE_RESTART_SECONDS)
+        else:
+          has_new_mail = self._poll(POLL_INTERVAL_SECONDS)
+        if has_new_mail:
+          return
+      except (IMAP4.error, *email_auth.CONNECTION_ERRORS) as e:
+        print(f"Lost the connection watching for new emails ({e.__class__.__name__}: {str(e)}); "
+              "reconnecting.")
+        self.close()
+        time.sleep(RECONNECT_DELAY_SECONDS)
+        return
+
+  def _idle(self, timeout: float) -> bool:
+    """
+    Idles for up to timeout seconds, returning whether the server reported new emails. imaplib has
+    no IDLE support, so the command is sent by hand, and ended by sending DONE once new emails are
+    reported or the timeout passes. Everything happens on this thread, as the connection's socket
+    (and its compression streams) can't be used from two threads at once.
+    """
+    mail = self.mail
+    tag = mail._new_tag()
+    has_new_mail = False
+    # When we stop idling, once the server has accepted the command.
+    deadline: Optional[float] = None
+    done_sent = False
+
+    mail.send(tag + b' IDLE\r\n')
+    try:
+      while True:
+        if deadline is not None and not done_sent:
+          # Emails that arrived since our last command may already have been reported, in which
+          # case there's no need to wait.
+          if has_new_mail or not mail.wait_for_data(deadline - time.monotonic()):
+            mail.send(b'DONE\r\n')
+            done_sent = True
+        line = mail.readline()
+        if not line:
+          raise IMAP4.abort("socket closed while idling")
+        if line.startswith(tag):
+          if not line.startswith(tag + b' OK'):
+            raise IMAP4.error(f"IDLE failed: {line.decode('utf-8', errors='replace')}")
+          break
+        if line.startswith(b'+'):
+          deadline = time.monotonic() + timeout
+        elif EXISTS_REGEX.match(line):
+          has_new_mail = True
+    finally:
+      mail.tagged_commands.pop(tag, None)
+    return has_new_mail
+
+  def _poll(self, interval: float) -> bool:
+    time.sleep(interval)
+    self.mail.noop()
+    _, exists = self.mail.response('EXISTS')
+    return bool(exists and exists[0])
+
+  def close(self) -> None:
+    if self.mail is not None:
+      try:
+        self.mail.logout()
+      except Exception:
+        pass
+      self.mail = None
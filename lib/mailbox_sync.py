@@ -0,0 +1,175 @@
+import argparse
+import datetime
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set
+
+import lib.email_auth as email_auth
+from lib import search_planner
+from lib.email_fetcher import to_uid_sets
+from lib.object_retriever import ObjectRetriever
+
+SYNC_STATE_FILENAME = "mailbox_sync.pickle"
+SINCE_REGEX = re.compile(r'\bSINCE "([^"]+)"')
+
+
+class SyncState:
+  """
+  A value class that stores how far a single mailbox consumer has gotten through the mailbox.
+  """
+
+  def __init__(self,
+               uidvalidity: int,
+               last_uid: int,
+               modseq: Optional[int] = None,
+               pending_uids: Iterable[str] = (),
+               matched_uids: Iterable[str] = (),
+               since: Optional[datetime.date] = None) -> None:
+    self.uidvalidity = uidvalidity
+    # All UIDs up to and including this one have been searched.
+    self.last_uid = last_uid
+    # The HIGHESTMODSEQ of the mailbox at the time of the search, if the server supports CONDSTORE.
+    self.modseq = modseq
+    # UIDs that were matched but couldn't be processed, and so need to be searched again.
+    self.pending_uids = set(pending_uids)
+    # All UIDs that have been matched by this consumer's searches.
+    self.matched_uids = set(matched_uids)
+    # The date that the searches of all UIDs up to last_uid reached back to, or None if they
+    # weren't restricted by date.
+    self.since = since
+
+  def __str__(self) -> str:
+    return (f'{{uidvalidity: {self.uidvalidity}, last_uid: {self.last_uid}, '
+            f'modseq: {self.modseq}, pending: {len(self.pending_uids)}, '
+            f'matched: {len(self.matched_uids)}, since: {self.since}}}')
+
+  __repr__ = __str__
+
+
+class MailboxSync:
+  """
+  Makes a consumer's mailbox searches incremental by persisting the UIDVALIDITY and the highest
+  UID that the consumer has searched (plus the HIGHESTMODSEQ, if the server supports CONDSTORE).
+
+  Later searches are restricted to new UIDs, the consumer's pending UIDs and (with CONDSTORE)
+  emails whose flags have changed since. We fall back to a full search if the mailbox's
+  UIDVALIDITY has changed, if there's no saved state, if the search reaches further back (with
+  its SINCE date) than the saved state's searches did, e.g. with a larger --days, or if
+  --full-scan is passed.
+  """
+
+  def __init__(self, config, name: str, account: Optional[Dict[str, Any]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Mailbox sync')
+    parser.add_argument("--full-scan", action="store_true")
+    self.args, _ = parser.parse_known_args()
+
+    self.name = email_auth.qualify(name, account)
+    self.retriever = ObjectRetriever(config)
+    self.pool = email_auth.get_session_pool(account)
+    states: Dict[str, SyncState] = self.retriever.load(SYNC_STATE_FILENAME)
+    self.state: Optional[SyncState] = states.get(self.name)
+    # The mailbox status and matches of the latest search, to be saved by save().
+    self.status: Optional[Dict[str, int]] = None
+    self.matched_uids: Set[str] = set()
+    self.since: Optional[datetime.date] = None
+
+  def _get_incremental_criteria(self, status: Dict[str, int],
+                                since: Optional[datetime.date]) -> Optional[List[str]]:
+    """
+    Returns the criteria that restrict a search (since the given date) to what has changed since
+    the saved state, an empty list if a full search is needed, or None if nothing can have
+    changed.
+    """
+    state = self.state
+    if self.args.full_scan or not state or state.uidvalidity != status['UIDVALIDITY']:
+      return []
+    # States saved before the date was recorded may not reach back far enough.
+    if not hasattr(state, 'since') or not _reaches_back_to(state.since, since):
+      return []
+
+    uids = list(state.pending_uids)
+    # "N:*" always matches the highest UID even if it's below N, so only add the range if there
+    # are new emails.
+    new_uid_range = f'{state.last_uid + 1}:*' if status['UIDNEXT'] > state.last_uid + 1 else None
+    uid_criteria = []
+    if uids:
+      uid_criteria.append(f'(UID {",".join(to_uid_sets(uids, max_ranges=len(uids)))})')
+    if new_uid_range:
+      uid_criteria.append(f'(UID {new_uid_range})')
+    if state.modseq and 'HIGHESTMODSEQ' in status:
+      if status['HIGHESTMODSEQ'] > state.modseq:
+        uid_criteria.append(f'(MODSEQ {state.modseq + 1})')
+
+    if not uid_criteria:
+      return None
+    return [search_planner.or_criteria(uid_criteria)]
+
+  def search(self, mail, term_lists: Sequence[search_planner.SearchTerms], *criteria:
+             str) -> List[str]:
+    """
+    Like search_planner.search, but only searches what has changed since the saved state.
+    """
+    self.status = self.pool.get_mailbox_status()
+    since = _get_since(criteria)
+    incremental_criteria = self._get_incremental_criteria(self.status, since)
+    if incremental_criteria is None:
+      email_ids = []
+    else:
+      if incremental_criteria:
+        print(f"Searching {self.name} incrementally (pass --full-scan to search everything)")
+      email_ids = search_planner.search(mail, term_lists, *criteria, *incremental_criteria)
+    self.matched_uids = set(email_ids)
+    # Older UIDs were searched back to the saved state's date, and new ones back to this search's.
+    self.since = since if incremental_criteria == [] else _later(self.state.since, since)
+    return email_ids
+
+  def get_all_matched_ids(self) -> List[str]:
+    """
+    Returns the UIDs matched by the latest search plus all UIDs matched by previous searches,
+    i.e. what a full search would have returned, in ascending order.
+    """
+    matched_uids = set(self.matched_uids)
+    if self.state and self.status and self.state.uidvalidity == self.status['UIDVALIDITY']:
+      matched_uids.update(self.state.matched_uids)
+    return sorted(matched_uids, key=int)
+
+  def save(self, pending_uids: Iterable[str] = ()) -> None:
+    """
+    Records that everything matched by the latest search has been processed, except for the given
+    pending UIDs, which will be searched again next time.
+    """
+    if not self.status:
+      return
+    state = SyncState(self.status['UIDVALIDITY'], self.status['UIDNEXT'] - 1,
+                      self.status.get('HIGHESTMODSEQ'), pending_uids, self.get_all_matched_ids(),
+                      self.since)
+    states: Dict[str, SyncState] = self.retriever.load(SYNC_STATE_FILENAME)
+    states[self.name] = state
+    self.retriever.flush(states, SYNC_STATE_FILENAME)
+    self.state = state
+    # Later searches by this process (e.g. in watch mode) can be incremental again.
+    self.args.full_scan = False
+
+
+def _get_since(criteria: Iterable[str]) -> Optional[datetime.date]:
+  """Returns the date that the search criteria reach back to, or None if there isn't one."""
+  dates = [
+      datetime.datetime.strptime(date, '%d-%b-%Y').date()
+      for criterion in criteria
+      for date in SINCE_REGEX.findall(criterion)
+  ]
+  # The criteria are ANDed, so the latest date is the one that counts.
+  return max(dates) if dates else None
+
+
+def _reaches_back_to(searched_since: Optional[datetime.date],
+                     since: Optional[datetime.date]) -> bool:
+  """Returns whether a search back to searched_since covers a search back to since."""
+  return searched_since is None or (since is not None and searched_since <= since)
+
+
+def _later(first: Optional[datetime.date],
+           second: Optional[datetime.date]) -> Optional[datetime.date]:
+  """Returns the later of two dates, where None means no date restriction at all."""
+  if first is None or second is None:
+    return first or second
+  return max(first, second)
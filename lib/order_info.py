@@ -3,11 +3,10 @@ import re
 from tqdm import tqdm
 
 import lib.email_auth as email_auth
-from bs4 import BeautifulSoup
-
-from lib import email_tracking_retriever
 from lib.debounce import debounce
+from lib.email_fetcher import EmailFetcher
 from lib.object_retriever import ObjectRetriever
+from lib.parsed_email import ParsedEmail, parse_email
 from typing import Dict, Optional, Tuple
 from math import isclose
 
@@ -42,12 +41,7 @@ class OrderInfoRetriever:
   def __init__(self, config) -> None:
     self.retriever = ObjectRetriever(config)
     self.orders_dict = self.retriever.load(ORDERS_FILENAME)
-    self.mail = self.load_mail()
-
-  def load_mail(self):
-    mail = email_auth.email_authentication()
-    mail.select('"[Gmail]/All Mail"')
-    return mail
+    self.fetcher = EmailFetcher(config)
 
   @debounce(5)
   def flush(self) -> None:
@@ -74,11 +68,15 @@ class OrderInfoRetriever:
 
   def load_order_total_bb(self, order_id: str) -> Dict[str, OrderInfo]:
     from_email = 'BestBuyInfo@emailinfo.bestbuy.com'
-    email_id, email_str = self.get_relevant_raw_email_data(order_id, from_email)
-    if not email_str:
+    email_id, email = self.get_relevant_raw_email_data(order_id, from_email)
+    if not email:
       print("Could not find email for order ID %s" % order_id)
       return {}
+    return self.get_bb_order_total_from_email(order_id, email_id, email)
 
+  def get_bb_order_total_from_email(self, order_id: str, email_id: str,
+                                    email: ParsedEmail) -> Dict[str, OrderInfo]:
+    email_str = email.content
     regex_subtotal = r'Subtotal[^\$]*\$([\d,]+\.[\d]{2})'
     regex_tax = r'Tax[^\$]*\$([\d,]+\.[\d]{2})'
     subtotal_match = re.search(regex_subtotal, email_str)
@@ -92,11 +90,15 @@ class OrderInfoRetriever:
     return {order_id: OrderInfo(email_id, subtotal + tax)}
 
   def load_order_total_amazon(self, order_id: str) -> Dict[str, OrderInfo]:
-    email_id, email_str = self.get_relevant_raw_email_data(order_id, 'auto-confirm@amazon.com')
-    if not email_str:
+    email_id, email = self.get_relevant_raw_email_data(order_id, 'auto-confirm@amazon.com')
+    if not email:
       tqdm.write(f"Could not find email for order ID {order_id}.")
       return {}
+    return self.get_amazon_order_totals_from_email(email_id, email)
 
+  def get_amazon_order_totals_from_email(self, email_id: str,
+                                         email: ParsedEmail) -> Dict[str, OrderInfo]:
+    email_str = email.content
     regex_pretax = r'Total Before Tax:[^$]*\$([\d,]+\.\d{2})'
     regex_est_tax = r'Estimated Tax:[^$]*\$([\d,]+\.\d{2})'
     regex_order_total = r'Order Total:[^$]*\$([\d,]+\.\d{2})'
@@ -117,7 +119,7 @@ class OrderInfoRetriever:
       return dict(zip(orders, order_infos))
     else:
       # personal emails might not have the regexes, need to do something different
-      personal_result = self.get_personal_amazon_totals(email_id, email_str, orders)
+      personal_result = self.get_personal_amazon_totals(email_id, email, orders)
       if personal_result:
         return personal_result
       else:
@@ -128,9 +130,10 @@ class OrderInfoRetriever:
         order_infos = [OrderInfo(email_id, t) for t in overall_totals]
         return dict(zip(orders, order_infos))
 
-  def get_relevant_raw_email_data(self, order_id: str, from_email: str) -> Tuple[Optional[str], Optional[str]]:
-    status, search_result = self.mail.uid('SEARCH', None, f'BODY "{order_id}"',
-                                          f'FROM "{from_email}"')
+  def get_relevant_raw_email_data(self, order_id: str,
+                                  from_email: str) -> Tuple[Optional[str], Optional[ParsedEmail]]:
+    status, search_result = email_auth.run_in_all_mail(
+        lambda mail: mail.uid('SEARCH', None, f'BODY "{order_id}"', f'FROM "{from_email}"'))
     email_id = search_result[0]
     if not email_id:
       return None, None
@@ -139,15 +142,17 @@ class OrderInfoRetriever:
     if not email_ids:
       return None, None
 
-    email_str = email_tracking_retriever.get_email_content(email_ids[0], self.mail)
-    email_str = email_str.replace('\r\n', '')
-    return email_ids[0], email_str
+    raw_email = self.fetcher.fetch_batch(email_ids[:1]).get(email_ids[0])
+    if raw_email is None:
+      return None, None
+
+    return email_ids[0], parse_email(raw_email)
 
-  def get_personal_amazon_totals(self, email_id, email_str, orders) -> Dict[str, OrderInfo]:
-    soup = BeautifulSoup(email_str, features="html.parser")
+  def get_personal_amazon_totals(self, email_id, email: ParsedEmail,
+                                 orders) -> Dict[str, OrderInfo]:
     prices = [
-        elem.getText().strip().replace(',', '').replace('$', '')
-        for elem in soup.find_all('td', {"class": "price"})
+        elem.text.strip().replace(',', '').replace('$', '')
+        for elem in email.dom.find_all('td', class_="price")
     ]
     prices = [float(price) for price in prices if price]
 
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import pickle
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from lib.object_retriever import OUTPUT_FOLDER
+from lib.tracking import Tracking
+
+PARSE_CACHE_FILENAME = "parse_cache.pickle"
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def get_content_hash(raw_email: bytes) -> str:
+  return hashlib.sha256(raw_email).hexdigest()
+
+
+class ParseCache:
+  """
+  A local cache of the trackings that were successfully extracted from each email, keyed by the
+  hash of the email's content, so that emails seen again (e.g. on --seen reruns, or when other
+  emails in a run failed) aren't parsed again and their tracking pages aren't loaded again.
+
+  Each parser's entries are stored with its version, which should change whenever the parser
+  would extract something different from the same email; a parser whose version doesn't match
+  its stored entries starts over without them, leaving other parsers' entries alone. Each parser
+  keeps at most max_entries entries, dropping the oldest first.
+  """
+
+  def __init__(self, max_entries: int, filename: str = PARSE_CACHE_FILENAME) -> None:
+    self.max_entries = max_entries
+    self.path = os.path.join(OUTPUT_FOLDER, filename)
+    self.lock = threading.Lock()
+    # parser -> (version, content hash -> trackings)
+    self.parsers: Dict[str, Tuple[Hashable, Dict[str, List[Tracking]]]] = {}
+    self.dirty = False
+    if self.enabled() and os.path.exists(self.path):
+      try:
+        with open(self.path, 'rb') as stream:
+          self.parsers = pickle.load(stream)
+      except Exception as e:
+        print(f"Couldn't load the parse cache, starting over: {e}")
+
+  def enabled(self) -> bool:
+    return self.max_entries > 0
+
+  def _get_entries(self, parser: str, version: Hashable) -> Dict[str, List[Tracking]]:
+    """Returns the parser's entries for its current version. Needs the lock."""
+    if parser not in self.parsers or self.parsers[parser][0] != version:
+      self.parsers[parser] = (version, {})
+      self.dirty = True
+    return self.parsers[parser][1]
+
+  def get(self, parser: str, version: Hashable, content_hash: str) -> Optional[List[Tracking]]:
+    if not self.enabled():
+      return None
+    with self.lock:
+      return self._get_entries(parser, version).get(content_hash)
+
+  def put(self, parser: str, version: Hashable, content_hash: str,
+          trackings: List[Tracking]) -> None:
+    if not self.enabled():
+      return
+    with self.lock:
+      entries = self._get_entries(parser, version)
+      entries[content_hash] = trackings
+      while len(entries) > self.max_entries:
+        del entries[next(iter(entries))]
+      self.dirty = True
+
+  def flush(self) -> None:
+    """Writes the cache atomically, if anything has changed since it was last written."""
+    with self.lock:
+      if not self.dirty:
+        return
+      if not os.path.exists(OUTPUT_FOLDER):
+        os.mkdir(OUTPUT_FOLDER)
+      tmp_path = f"{self.path}.tmp"
+      with open(tmp_path, 'wb') as stream:
+        pickle.dump(self.parsers, stream)
+      os.replace(tmp_path, self.path)
+      self.dirty = False
+
+
+_parse_cache: Optional[ParseCache] = None
+_parse_cache_lock = threading.Lock()
+
+
+def get_parse_cache(config: Dict[str, Any]) -> ParseCache:
+  """
+  Returns the process-wide parse cache, which keeps at most parseCacheEntries entries per parser
+  (set in the config; 0 disables it).
+  """
+  global _parse_cache
+  with _parse_cache_lock:
+    if not _parse_cache:
+      _parse_cache = ParseCache(int(config.get('parseCacheEntries', DEFAULT_MAX_ENTRIES)))
+    return _parse_cache
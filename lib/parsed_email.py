@@ -0,0 +1,67 @@
+from email.message import Message
+from typing import Dict, Optional, Tuple
+
+from lib.email_decoder import DecodedEmail, decode_email
+from lib.extraction_rules import Matches, RuleSet
+from lib.html_dom import Anchor, HtmlNode, cut_fragment, parse_html
+
+
+class ParsedEmail(DecodedEmail):
+  """
+  A decoded email that's passed through every extractor, so that its DOM is built at most once:
+  the first time an extractor asks for it, rather than once per extractor.
+
+  Extractors that only need one part of the email can ask for the DOM of just that fragment
+  instead, which is much cheaper to build than the whole email's. The same goes for the matches
+  of a merchant's extraction rules, which extractors share.
+  """
+
+  # Whether fragments are cut out at all; benchmarks turn this off to compare.
+  cut_fragments = True
+
+  def __init__(self, message: Message, content: str, parser: Optional[str] = None) -> None:
+    super().__init__(message, content)
+    # The HTML parser that builds the DOM; the fastest installed one if None.
+    self.parser = parser
+    self._dom: Optional[HtmlNode] = None
+    self._fragment_doms: Dict[Tuple[Anchor, ...], HtmlNode] = {}
+    self._matches: Dict[str, Matches] = {}
+
+  def __getstate__(self):
+    # Emails are sent back from parsing processes without their DOM, which is only needed for
+    # extracting fields.
+    state = self.__dict__.copy()
+    state['_dom'] = None
+    state['_fragment_doms'] = {}
+    return state
+
+  @property
+  def dom(self) -> HtmlNode:
+    """The DOM of the email's content, built on first use."""
+    if self._dom is None:
+      self._dom = parse_html(self.content, self.parser)
+    return self._dom
+
+  def fragment_dom(self, anchors: Tuple[Anchor, ...]) -> HtmlNode:
+    """
+    The DOM of the fragment marked by the first of the anchors that's in the email, or of the
+    whole email if none are (or the DOM has already been built anyway).
+    """
+    if self._dom is not None or not self.cut_fragments:
+      return self.dom
+    if anchors not in self._fragment_doms:
+      fragment = cut_fragment(self.content, anchors)
+      self._fragment_doms[anchors] = self.dom if fragment is None else parse_html(
+          fragment, self.parser)
+    return self._fragment_doms[anchors]
+
+  def matches(self, rule_set: RuleSet) -> Matches:
+    """The matches of the rule set's rules in the email's content."""
+    if rule_set.name not in self._matches:
+      self._matches[rule_set.name] = rule_set.scan(self.content)
+    return self._matches[rule_set.name]
+
+
+def parse_email(raw_email: bytes, parser: Optional[str] = None) -> ParsedEmail:
+  decoded_email = decode_email(raw_email)
+  return ParsedEmail(decoded_email.message, decoded_email.content, parser)
@@ -0,0 +1,67 @@
+import queue
+import threading
+from typing import Iterable, Iterator, Optional, TypeVar
+
+_T = TypeVar('_T')
+
+# How often a producer that's waiting for room in its buffer checks whether it's been stopped.
+STOP_POLL_SECONDS = 0.1
+
+
+class _End:
+  """Put in a stage's buffer after its last item, with the exception that ended it, if any."""
+
+  def __init__(self, error: Optional[BaseException]) -> None:
+    self.error = error
+
+
+def buffered(items: Iterable[_T], size: int, name: str) -> Iterator[_T]:
+  """
+  Runs a pipeline stage: produces the items in a separate thread, up to size of them ahead of the
+  consumer, so that producing them (e.g. fetching or parsing emails) overlaps with whatever the
+  consumer does with them. Items are yielded in order, and an exception raised while producing
+  them is raised to the consumer once it gets that far.
+
+  Closing the returned generator (or the consumer stopping early) stops the producer thread, which
+  then closes the items if they're a generator, so that stages can be chained.
+  """
+  buffer: 'queue.Queue' = queue.Queue(maxsize=size)
+  stopped = threading.Event()
+
+  def put(item) -> bool:
+    """Waits for room in the buffer, returning False if the stage was stopped in the meantime."""
+    while not stopped.is_set():
+      try:
+        buffer.put(item, timeout=STOP_POLL_SECONDS)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def produce() -> None:
+    iterator = iter(items)
+    try:
+      for item in iterator:
+        if not put(item):
+          return
+      put(_End(None))
+    except BaseException as e:
+      put(_End(e))
+    finally:
+      close = getattr(iterator, 'close', None)
+      if close:
+        close()
+
+  thread = threading.Thread(target=produce, name=name, daemon=True)
+  thread.start()
+  try:
+    while True:
+      item = buffer.get()
+      if isinstance(item, _End):
+        if item.error:
+          raise item.error
+        return
+      yield item
+  finally:
+    stopped.set()
+    thread.join()
@@ -0,0 +1,105 @@
+import email
+import email.header
+import re
+from email.message import Message
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+# A list of (header field, phrase) pairs that must all match, e.g.
+# [('SUBJECT', 'Your Amazon.com order'), ('SUBJECT', 'has shipped')]
+SearchTerms = Sequence[Tuple[str, str]]
+
+_T = TypeVar('_T')
+
+WHITESPACE_REGEX = re.compile(r'\s+')
+# A single search key with an optional NOT and an optional quoted argument, e.g. '(UNSEEN)' or
+# '(NOT X-GM-LABELS "Processed")'.
+CRITERIA_REGEX = re.compile(r'^\(?(NOT )?([A-Z-]+)(?: "((?:[^"\\]|\\.)*)")?\)?$')
+ESCAPE_REGEX = re.compile(r'\\(.)')
+
+
+def subject_terms(phrases: Iterable[str]) -> List[Tuple[str, str]]:
+  return [('SUBJECT', phrase) for phrase in phrases]
+
+
+def quote(phrase: str) -> str:
+  """Quotes a phrase as an IMAP string."""
+  return '"' + phrase.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def parse_criteria(criteria: str) -> Tuple[bool, str, Optional[str]]:
+  """
+  Parses a simple search key into (negated, key, argument), so that backends that don't speak IMAP
+  can interpret the criteria that we search with.
+  """
+  match = CRITERIA_REGEX.match(criteria.strip())
+  if not match:
+    raise Exception(f"Can't interpret IMAP search criteria {criteria}")
+  negated, key, argument = match.groups()
+  return bool(negated), key, ESCAPE_REGEX.sub(r'\1', argument) if argument is not None else None
+
+
+def to_criteria(terms: SearchTerms) -> str:
+  """Compiles a list of terms into a single parenthesized IMAP search key that ANDs them."""
+  return '(' + ' '.join(f'{field} {quote(phrase)}' for field, phrase in terms) + ')'
+
+
+def or_criteria(criteria: Sequence[str]) -> str:
+  """
+  Combines IMAP search keys with a balanced tree of the binary OR operator, so that the server
+  can evaluate any number of alternatives in a single search.
+  """
+  if len(criteria) == 1:
+    return criteria[0]
+  middle = len(criteria) // 2
+  return f'(OR {or_criteria(criteria[:middle])} {or_criteria(criteria[middle:])})'
+
+
+def compile_search(term_lists: Sequence[SearchTerms]) -> str:
+  return or_criteria([to_criteria(terms) for terms in term_lists])
+
+
+def search(mail, term_lists: Sequence[SearchTerms], *criteria: str) -> List[str]:
+  """
+  Returns the UIDs of emails matching the given criteria and any of the term lists, using one
+  UID SEARCH command instead of one per term list.
+  """
+  status, response = mail.uid('SEARCH', None, *criteria, compile_search(term_lists))
+  return response[0].decode('utf-8').split()
+
+
+def _normalize(text: str) -> str:
+  return WHITESPACE_REGEX.sub(' ', text).strip().lower()
+
+
+def _decode_header(value) -> str:
+  if value is None:
+    return ''
+  try:
+    return str(email.header.make_header(email.header.decode_header(str(value))))
+  except Exception:
+    return str(value)
+
+
+def matches(headers: Message, terms: SearchTerms) -> bool:
+  """A cheap local equivalent of an IMAP header search: case-insensitive substring matches."""
+  for field, phrase in terms:
+    if _normalize(phrase) not in _normalize(_decode_header(headers[field])):
+      return False
+  return True
+
+
+def categorize(raw_headers: Dict[str, bytes], categories: Sequence[Tuple[SearchTerms, _T]],
+               default: _T) -> Dict[str, _T]:
+  """
+  Maps each email's raw headers to the value of the last category whose terms match them, or to
+  the default if none do. This is how the results of a combined search are mapped back to the
+  individual searches that would have found them.
+  """
+  result = {}
+  for email_id, header_bytes in raw_headers.items():
+    headers = email.message_from_bytes(header_bytes)
+    result[email_id] = default
+    for terms, value in categories:
+      if matches(headers, terms):
+        result[email_id] = value
+  return result
@@ -1,5 +1,4 @@
 import argparse
-import email
 from typing import List, Dict
 
 from tenacity import retry, stop_after_attempt, wait_exponential
@@ -9,13 +8,14 @@ import datetime
 
 from functools import cmp_to_key
 
-from lib import util
 from lib.amazon_tracking_retriever import AmazonTrackingRetriever
 from lib.cancelled_items_retriever import CancelledItemsRetriever
 from lib.config import open_config
 from lib.debounce import debounce
+from lib.email_fetcher import EmailFetcher
 from lib.object_retriever import ObjectRetriever
 from lib.objects_to_sheet import ObjectsToSheet
+from lib.parsed_email import parse_email
 from lib.tracking import convert_int_to_date
 from lib.tracking_output import TrackingOutput
 
@@ -49,34 +49,20 @@ class EmailToOrders:
   def flush(self):
     self.retriever.flush(self.email_to_orders, EMAIL_TO_ORDERS_FILENAME)
 
-  def get_orders(self, mail, email_id):
-    if email_id not in self.email_to_orders:
-      for attempt in range(3):
-        try:
-          _, data = mail.uid("FETCH", email_id, "(RFC822)")
-          break
-        except:
-          tqdm.write(
-              f"Got exception, attempting retry up to 3 times...\n{util.get_traceback_lines()}")
-          mail = email_auth.email_authentication()
-          mail.select('"[Gmail]/All Mail"')
-      else:
-        raise Exception("Exceeded retry limit")
-
-      msg = email.message_from_string(str(data[0][1], 'utf-8'))
-      date = datetime.datetime.strptime(msg['Date'],
-                                        '%a, %d %b %Y %H:%M:%S %z').strftime('%Y-%m-%d')
-      to_email = str(msg['To']).replace('<', '').replace('>', '')
-      raw_email = str(data[0][1]).replace("=3D", "=").replace('=\\r\\n',
-                                                              '').replace('\\r\\n',
-                                                                          '').replace('&amp;', '&')
-      order_ids = AmazonTrackingRetriever.get_order_ids_from_email(AmazonTrackingRetriever,
-                                                                   raw_email)
-      self.email_to_orders[email_id] = [
-          Order(order_id, date, to_email, False) for order_id in order_ids
-      ]
-      self.flush()
-    return self.email_to_orders[email_id]
+  def get_orders(self, email_id) -> List[Order]:
+    return self.email_to_orders.get(email_id, [])
+
+  def add_orders(self, email_id, raw_email: bytes) -> None:
+    email = parse_email(raw_email)
+    msg = email.message
+    date = datetime.datetime.strptime(msg['Date'],
+                                      '%a, %d %b %Y %H:%M:%S %z').strftime('%Y-%m-%d')
+    to_email = str(msg['To']).replace('<', '').replace('>', '')
+    order_ids = AmazonTrackingRetriever.get_order_ids_from_email(AmazonTrackingRetriever, email)
+    self.email_to_orders[email_id] = [
+        Order(order_id, date, to_email, False) for order_id in order_ids
+    ]
+    self.flush()
 
 
 def order_from_row(header, row):
@@ -99,15 +85,24 @@ def get_email_ids(mail, args):
 
 
 def get_order_ids_to_orders(args):
-  mail = email_auth.email_authentication()
-  mail.select('"[Gmail]/All Mail"')
-  email_ids = get_email_ids(mail, args)
+  email_ids = email_auth.run_in_all_mail(lambda mail: get_email_ids(mail, args))
 
   config = open_config()
   email_to_orders = EmailToOrders(config)
+  new_email_ids = [
+      email_id for email_id in email_ids if email_id not in email_to_orders.email_to_orders
+  ]
+  fetcher = EmailFetcher(config)
+  for email_id, raw_email in tqdm(
+      fetcher.fetch(new_email_ids), total=len(new_email_ids), desc="Fetching orders",
+      unit="email"):
+    if raw_email is None:
+      raise Exception(f"Could not fetch email with ID {email_id}")
+    email_to_orders.add_orders(email_id, raw_email)
+
   result = {}
-  for email_id in tqdm(email_ids, desc="Fetching orders", unit="email"):
-    for order in email_to_orders.get_orders(mail, email_id):
+  for email_id in email_ids:
+    for order in email_to_orders.get_orders(email_id):
       result[order.order_id] = order
 
   return result